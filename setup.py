@@ -26,6 +26,10 @@ setuptools.setup(
     package_dir={"": "src"},
     packages=setuptools.find_namespace_packages(where="src"),
     install_requires=requirements,
-    extras_require={"tests": ["pytest", "pytest-cov", "pytest-env", "moto"]},
+    extras_require={
+        "tests": ["pytest", "pytest-cov", "pytest-env", "moto", "cfn-lint>=0.79,<1"],
+        # lint uses the rules api of cfn-lint 0.x, 1.x removed cfnlint.core
+        "lint": ["cfn-lint>=0.79,<1"],
+    },
     entry_points={"console_scripts": ["tchotcho = tchotcho.__main__:cli"]},
 )
@@ -1,5 +1,19 @@
-from tchotcho.action.key import KeyManager  # noqa
-from tchotcho.action.stack import StackManager  # noqa
-from tchotcho.action.spot import SpotManager  # noqa
-from tchotcho.action.info import InfoManager  # noqa
-from tchotcho.action.shell import ShellManager  # noqa
+import importlib
+
+# managers are imported on first access, see tchotcho.__main__
+_MANAGERS = {
+    "KeyManager": "tchotcho.action.key",
+    "StackManager": "tchotcho.action.stack",
+    "SpotManager": "tchotcho.action.spot",
+    "InfoManager": "tchotcho.action.info",
+    "ShellManager": "tchotcho.action.shell",
+    "PlacementManager": "tchotcho.action.place",
+}
+
+__all__ = list(_MANAGERS)
+
+
+def __getattr__(name):
+    if name in _MANAGERS:
+        return getattr(importlib.import_module(_MANAGERS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
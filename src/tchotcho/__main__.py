@@ -1,18 +1,89 @@
-from tchotcho.action.key import key as key_group
-from tchotcho.action.stack import stack as stack_group
-from tchotcho.action.spot import spot as spot_group
-from tchotcho.action.info import info as info_group
-from tchotcho.action.shell import shell as shell_group
+import importlib
+import json
+import sys
+
 import click
 
+# name: (module:attribute, short help) the module is only imported when the
+# command is invoked
+SUBCOMMANDS = {
+    "cache": ("tchotcho.action.cache:cache", "Inspect and clear the local cache"),
+    "info": ("tchotcho.action.info:info", "Instance and AMI catalog"),
+    "key": ("tchotcho.action.key:key", "Manage EC2 key pairs"),
+    "place": ("tchotcho.action.place:place", "Find the cheapest GPU placement"),
+    "shell": ("tchotcho.action.shell:shell", "Run rsync and ssh against an instance"),
+    "spot": ("tchotcho.action.spot:spot", "Spot prices"),
+    "stack": ("tchotcho.action.stack:stack", "Manage cloudformation stacks"),
+}
+
+
+class LazyGroup(click.Group):
+    def __init__(self, *args, lazy_subcommands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands:
+            return self._load(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def _load(self, cmd_name):
+        path, _ = self.lazy_subcommands[cmd_name]
+        module, attr = path.split(":")
+        return getattr(importlib.import_module(module), attr)
+
+    def invoke(self, ctx):
+        try:
+            return super().invoke(ctx)
+        except Exception as ex:
+            # AwsError is a botocore ClientError, only loaded with a command
+            errors = sys.modules.get("tchotcho.errors")
+            if errors is not None and isinstance(ex, errors.AwsError):
+                raise click.ClickException(str(ex))
+            raise
+
+    def format_commands(self, ctx, formatter):
+        # use the static help so --help does not import every command
+        rows = [(k, v[1]) for k, v in self.lazy_subcommands.items()]
+        rows += [(k, v.get_short_help_str()) for k, v in self.commands.items()]
+        rows.sort()
+        if rows:
+            with formatter.section("Commands"):
+                formatter.write_dl(rows)
+
+
+def _print_aws_stats():
+    # only if a command used AWS, importing boto3 here would be wasted
+    if "tchotcho.aws" in sys.modules:
+        stats = sys.modules["tchotcho.aws"].get_pool().stats()
+        click.echo(f"AWS clients: {json.dumps(stats)}", err=True)
+
 
-@click.group()
-def cli():
-    ...
+@click.group(cls=LazyGroup, lazy_subcommands=SUBCOMMANDS)
+@click.option(
+    "--aws-stats/--no-aws-stats", default=False,
+    help="Print the AWS clients and connections created on exit",
+)
+@click.option(
+    "--cache/--no-cache", default=True,
+    help="Use cached AWS answers, --no-cache refetches and refreshes them",
+)
+@click.option(
+    "--invalidate", multiple=True, metavar="NAMESPACE",
+    help="Drop a cache namespace before running e.g. spot, repeat for more",
+)
+@click.pass_context
+def cli(ctx, aws_stats, cache, invalidate):
+    if aws_stats:
+        ctx.call_on_close(_print_aws_stats)
+    if not cache:
+        from tchotcho.config import get_settings
 
+        get_settings().CACHE_ENABLED = False
+    if invalidate:
+        from tchotcho.cache import invalidate as invalidate_cache
 
-cli.add_command(key_group)
-cli.add_command(stack_group)
-cli.add_command(spot_group)
-cli.add_command(info_group)
-cli.add_command(shell_group)
+        invalidate_cache(invalidate)
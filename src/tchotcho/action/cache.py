@@ -0,0 +1,27 @@
+import click
+
+from tchotcho import cache as _cache
+
+
+@click.group()
+def cache():
+    ...
+
+
+@cache.command(name="list")
+def _list():
+    """Show the entries and size of every cache namespace"""
+    ret = _cache.namespaces()
+    if not ret:
+        click.echo("Cache is empty!")
+        return
+    for name, (entries, size) in ret.items():
+        click.echo(f"{name}: {entries} entries, {size / 1024:.1f} KiB")
+
+
+@cache.command()
+@click.option("--namespace", multiple=True, help="Namespace to clear, default all")
+def clear(namespace):
+    """Remove cached AWS answers"""
+    _cache.invalidate(namespace)
+    click.echo(f"Cleared {', '.join(namespace) or 'all namespaces'}")
@@ -1,166 +1,275 @@
 import json
+import heapq
+import datetime
 import itertools
-import concurrent.futures
+import numpy as np
 import pandas as pd
 
-import boto3
 import click
 import colorama
-import requests
 
 import tabulate
 
+from tchotcho import aws, catalog, feed
+from tchotcho.cache import Cache, atomic_write, locked
 from tchotcho.config import get_settings
+from tchotcho.fanout import fan_out
+from tchotcho.region import RegionInventory
 
 colorama.init()
 
+# instance columns shown by render, info list only loads these
+RENDER_COLUMNS = [
+    "name",
+    "gpu",
+    "gpu_count",
+    "gpu_memory",
+    "gpu_model",
+    "compute_capability",
+    "cuda_cores",
+    "cpu",
+    "memory",
+    "supported",
+]
+
 
 class InfoManager(object):
     def __init__(self):
         self.settings = get_settings()
-
-    def _get_ami(self, region, ownerid, namefilter, limit):
-        rname = region["RegionName"]
-        # print("Running query in region: %s" % rname)
-        ec2 = boto3.client("ec2", region_name=rname)
-        resp = ec2.describe_images(
-            Owners=[ownerid], Filters=[{"Name": "name", "Values": [namefilter]}],
-        )
+        self._index = None
+        self.inventory = RegionInventory(self._client)
+
+    def _client(self, region):
+        return aws.client("ec2", region)
+
+    @staticmethod
+    def _parse_date(value):
+        try:
+            date = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%fZ")
+        except ValueError:
+            date = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=datetime.timezone.utc)
+        return date
+
+    @staticmethod
+    def _filter_pairs(ownerid, namefilter):
+        """Pair owner ids with name filters, a single value is used for all"""
+        ownerid = [ownerid] if isinstance(ownerid, str) else list(ownerid)
+        namefilter = [namefilter] if isinstance(namefilter, str) else list(namefilter)
+        if len(ownerid) == 1:
+            ownerid = ownerid * len(namefilter)
+        if len(namefilter) == 1:
+            namefilter = namefilter * len(ownerid)
+        if len(ownerid) != len(namefilter):
+            raise ValueError("Need one ownerid per namefilter or a single one")
+        return list(zip(ownerid, namefilter))
+
+    def _iter_images(self, ec2, ownerid, namefilter):
+        kwargs = {
+            "Owners": [ownerid],
+            "Filters": [{"Name": "name", "Values": [namefilter]}],
+        }
+        if not ec2.can_paginate("describe_images"):
+            yield from ec2.describe_images(**kwargs)["Images"]
+            return
+        for page in ec2.get_paginator("describe_images").paginate(**kwargs):
+            yield from page["Images"]
+
+    def _get_ami(self, rname, filters, limit):
+        """Newest AMIs of region, cached in the ami namespace"""
+        key = [rname, [list(x) for x in filters], limit]
+        return Cache("ami").get_or_set(key, lambda: self._fetch_ami(rname, filters, limit))
+
+    def _fetch_ami(self, rname, filters, limit):
+        ec2 = self._client(rname)
         ret = []
-        for image in resp["Images"]:
-            ret.append((rname, image["Name"], image["CreationDate"], image["ImageId"]))
-        # XXX return the newest <limit>
-        ret = sorted(ret, key=lambda x: int(x[2].replace("-", "")[:8]), reverse=True)[
-            :limit
-        ]
-        ret = [
-            {"region": x[0], "name": x[1], "date": x[2], "ami": x[3]} for x in ret if x
-        ]
+        for ownerid, namefilter in filters:
+            images = self._iter_images(ec2, ownerid, namefilter)
+            # only keep the newest <limit> while reading the pages
+            newest = heapq.nlargest(
+                limit, images, key=lambda x: self._parse_date(x["CreationDate"])
+            )
+            ret.extend(
+                {
+                    "region": rname,
+                    "name": x["Name"],
+                    "date": x["CreationDate"],
+                    "ami": x["ImageId"],
+                    "filter": namefilter,
+                }
+                for x in newest
+            )
         return ret
 
     def _get_ami_wrapper(self, args):
         return self._get_ami(*args)
 
-    def get_ami_image(self, ownerid, namefilter, limit, method="future-process"):
-        ec2 = boto3.client("ec2")
-        response = ec2.describe_regions()
-        regions = [(x, ownerid, namefilter, limit) for x in response["Regions"]]
-
-        if method == "future-process":
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                data = list(executor.map(self._get_ami_wrapper, regions))
-        else:
-            data = [self._get_ami(*x) for x in regions]
+    def get_ami_image(
+        self,
+        ownerid,
+        namefilter,
+        limit,
+        method="future-thread",
+        max_workers=None,
+        instance_types=None,
+    ):
+        """Newest <limit> AMIs per region for every ownerid/namefilter pair
+
+        With instance_types only regions offering one of them are searched.
+        """
+        filters = self._filter_pairs(ownerid, namefilter)
+        names = self.inventory.enabled_regions()
+        if instance_types is not None:
+            names = list(self.inventory.match(instance_types, names))
+        regions = [(x, filters, limit) for x in names]
 
+        data = fan_out(self._get_ami_wrapper, regions, method, max_workers)
         ret = list(itertools.chain.from_iterable(data))
         return ret
 
+    def ami_index(self, ami):
+        """Index the newest AMI by region and name filter"""
+        index = {}
+        for x in ami:
+            latest = index.setdefault(x["region"], {})
+            key = x.get("filter", "")
+            if key not in latest or self._parse_date(x["date"]) > self._parse_date(
+                latest[key]["date"]
+            ):
+                latest[key] = x
+        return index
+
+    def latest_ami(self, data, region, namefilter=None):
+        """Returns the newest AMI of region from update data or None"""
+        index = data.get("ami_latest") or self.ami_index(data["ami"])
+        latest = index.get(region, {})
+        if namefilter is not None:
+            return latest.get(namefilter)
+        if not latest:
+            return None
+        return max(latest.values(), key=lambda x: self._parse_date(x["date"]))
+
+    @staticmethod
+    def _parse_instance(i):
+        # XXX has a gpu and g2 are old not supported gpu cards
+        supported = i["GPU"] > 0 and not i["instance_type"].startswith("g2.")
+        tmp = {
+            "name": i["instance_type"],
+            "gpu": i["GPU"],
+            "cpu": i["vCPU"],
+            "gpu_count": i.get("gpu_count"),
+            "memory": i["memory"],
+            "gpu_memory": i["GPU_memory"],
+            "gpu_model": i["GPU_model"],
+            "compute_capability": i.get("compute_capability"),
+            "cuda_cores": i.get("cuda_cores"),
+            "storage": i["storage"],
+            "supported": supported,
+        }
+
+        pricing = {}
+        for k in i["pricing"]:
+            price = i["pricing"][k].get("linux", {}).get("ondemand")
+            pricing[k] = float(price) if price else None
+        tmp["pricing"] = pricing
+        return tmp
+
     def get_gpu_info(self):
         """
         Fetch gpu info from ec2instances.info
+
+        The feed is streamed and only refetched if it changed upstream, a gzip
+        copy of it is kept in INSTANCES_FILE.
         """
-        res = requests.get(
-            "https://raw.githubusercontent.com/powdahound/ec2instances.info/master/www/instances.json"  # noqa
+        records = feed.iter_instances(
+            self.settings.INSTANCES_URL, self.settings.INSTANCES_FILE
         )
-
-        ret = []
-        inst = res.json()
-
-        for i in inst:
-            # XXX has a gpu and g2 are old not supported gpu cards
-            supported = i["GPU"] > 0 and not i["instance_type"].startswith("g2.")
-            tmp = {
-                "name": i["instance_type"],
-                "gpu": i["GPU"],
-                "cpu": i["vCPU"],
-                "gpu_count": i.get("gpu_count"),
-                "memory": i["memory"],
-                "gpu_memory": i["GPU_memory"],
-                "gpu_model": i["GPU_model"],
-                "compute_capability": i.get("compute_capability"),
-                "cuda_cores": i.get("cuda_cores"),
-                "storage": i["storage"],
-                "supported": supported,
-            }
-
-            pricing = {}
-            for k in i["pricing"]:
-                price = i["pricing"][k].get("linux", {}).get("ondemand")
-                pricing[k] = float(price) if price else None
-            tmp["pricing"] = pricing
-            ret.append(tmp)
-        return ret
+        return [self._parse_instance(i) for i in records]
 
     def update(self, ownerid, namefilter, limit):
         full = {}
         gpu_data = self.get_gpu_info()
-        ami_data = self.get_ami_image(ownerid, namefilter, limit)
+        supported = [x["name"] for x in gpu_data if x["supported"]]
+        ami_data = self.get_ami_image(
+            ownerid, namefilter, limit, instance_types=supported
+        )
         full["instance"] = gpu_data
         full["ami"] = ami_data
+        full["ami_latest"] = self.ami_index(ami_data)
 
-        with open(self.settings.GPU_INFO_FILE, "w") as f:
-            json.dump(full, f, indent=4)
+        # concurrent updates must not interleave their writes
+        with locked(self.settings.GPU_INFO_FILE):
+            atomic_write(self.settings.GPU_INFO_FILE, json.dumps(full, indent=4))
+            if self.settings.GPU_INFO_COLUMNAR:
+                catalog.write(catalog.catalog_path(self.settings.GPU_INFO_FILE), full)
         return full
 
-    def list(self):
-        with open(self.settings.GPU_INFO_FILE, "r") as f:
-            return json.load(f)
-
-    def render(self, data, region, csv):
-        ami = data["ami"]
-        gp = data["instance"]
-
-        df = pd.DataFrame(gp)
-        df_ami = pd.DataFrame(ami)
-        df_ami = df_ami[df_ami.region == region]
-
-        def set_price(val):
-            val = val.get(region)
-            val = float(val) if val else val
-            return val
-
-        df["price"] = df["pricing"].apply(set_price)
-
-        def set_color(val):
-            if str(val) != "nan":
-                if val < 1:
-                    val = colorama.Back.GREEN + str(val) + colorama.Back.RESET
-                elif val > 3:
-                    val = colorama.Back.RED + str(val) + colorama.Back.RESET
-                else:
-                    val = colorama.Back.YELLOW + str(val) + colorama.Back.RESET
-            else:
-                val = "Not available"
-            return val
-
-        def set_color_support(val):
-            if val:
-                val = colorama.Back.GREEN + str(val) + colorama.Back.RESET
-            else:
-                val = colorama.Back.YELLOW + str(val) + colorama.Back.RESET
-            return val
+    def list(self, columns=None):
+        """Update data of the GPU info file, only columns of the instances"""
+        return catalog.read(self.settings.GPU_INFO_FILE, columns)
+
+    def query(self, region, **filters):
+        """Filter and rank the GPU instances by price per GPU in region
+
+        See InstanceIndex.mask and InstanceIndex.query for the filters, the
+        index is loaded once per manager.
+        """
+        if self._index is None:
+            self._index = catalog.read_index(self.settings.GPU_INFO_FILE)
+        return self._index.query(region, **filters)
+
+    @staticmethod
+    def _color_price(col):
+        """Color band price values, missing prices are marked"""
+        band = pd.Series(
+            np.select([col < 1, col > 3], [colorama.Back.GREEN, colorama.Back.RED],
+                      colorama.Back.YELLOW),
+            index=col.index,
+        )
+        text = band + col.astype(str) + colorama.Back.RESET
+        return text.mask(col.isna(), "Not available")
+
+    @staticmethod
+    def _color_support(col):
+        band = pd.Series(
+            np.where(col.astype(bool), colorama.Back.GREEN, colorama.Back.YELLOW),
+            index=col.index,
+        )
+        return band + col.astype(str) + colorama.Back.RESET
+
+    def price_columns(self, data, regions, cheapest=False):
+        """Price per instance for regions, one column per region
+
+        With a single region the column is called price, with cheapest the
+        cheapest region of every instance and its price is added.
+        """
+        prices = catalog.prices(data)
+        df = prices.reindex(columns=regions)
+        if len(regions) == 1:
+            df.columns = ["price"]
+        if cheapest:
+            df["cheapest_region"], df["cheapest_price"] = catalog.cheapest(prices)
+        return df
+
+    def render(self, data, region, csv, cheapest=False, sort="gpu"):
+        regions = [region] if isinstance(region, str) else list(region)
+        df = pd.DataFrame(data["instance"])
+        df_ami = pd.DataFrame(data["ami"])
+        df_ami = df_ami[df_ami.region.isin(regions)]
 
         # apply to specific column
-        df = df[
-            [
-                "name",
-                "gpu",
-                "gpu_count",
-                "gpu_memory",
-                "gpu_model",
-                "compute_capability",
-                "cuda_cores",
-                "cpu",
-                "memory",
-                "supported",
-                "price",
-            ]
-        ]
-        df = df.sort_values(by=["gpu"], ascending=False)
+        df = df[RENDER_COLUMNS]
+        price = self.price_columns(data, regions, cheapest)
+        df = pd.concat([df, price], axis=1)
+        by = ["gpu"] if sort == "gpu" else [price.columns[0]]
+        df = df.sort_values(by=by, ascending=sort == "price")
         to_print = df.to_csv()
         if not csv:
-            df["price"] = df["price"].apply(set_color)
-            df["supported"] = df["supported"].apply(set_color_support)
+            for col in price.columns:
+                if col != "cheapest_region":
+                    df[col] = self._color_price(df[col])
+            df["supported"] = self._color_support(df["supported"])
             to_print = tabulate.tabulate(
                 df, headers="keys", tablefmt="fancy_grid", showindex="never"
             )
@@ -187,15 +296,17 @@ def info():
 @info.command()
 @click.option(
     "--ownerid",
-    default="898082745236",
+    default=["898082745236"],
     required=True,
-    help="Owner id used (we use ubuntu)",
+    multiple=True,
+    help="Owner id used (we use ubuntu), one per namefilter or one for all",
     show_default=True,
 )
 @click.option(
     "--namefilter",
-    default="Deep Learning AMI* 18.04*",
+    default=["Deep Learning AMI* 18.04*"],
     show_default=True,
+    multiple=True,
     help="AMI filter by name",
     required=True,
 )
@@ -208,7 +319,10 @@ def info():
     help="Number of AMI image",
 )
 @click.option("--csv/--no-csv", default=False)
-@click.option("--region", help="List in region", required=True, default="eu-central-1")
+@click.option(
+    "--region", help="List in region", required=True, default=["eu-central-1"],
+    multiple=True,
+)
 def update(ownerid, namefilter, limit, csv, region):
     """Update the GPU info json file"""
     ret = mgr.update(ownerid, namefilter, limit)
@@ -216,9 +330,59 @@ def update(ownerid, namefilter, limit, csv, region):
 
 
 @info.command(name="list")
-@click.option("--region", help="List spot prices in region", required=True)
+@click.option(
+    "--region", help="List prices in region, repeat to compare regions",
+    required=True, multiple=True,
+)
+@click.option(
+    "--cheapest/--no-cheapest", default=False,
+    help="Add the cheapest region of every instance",
+)
+@click.option(
+    "--sort", type=click.Choice(["gpu", "price"]), default="gpu", show_default=True
+)
 @click.option("--csv/--no-csv", default=False)
-def _list(region, csv):
+def _list(region, cheapest, sort, csv):
     """Get the GPU info"""
-    ret = mgr.list()
-    mgr.render(ret, region, csv)
+    ret = mgr.list(RENDER_COLUMNS)
+    mgr.render(ret, region, csv, cheapest, sort)
+
+
+@info.command()
+@click.option("--region", help="Region of the AMI", required=True)
+@click.option("--namefilter", help="AMI filter by name used in update")
+def ami(region, namefilter):
+    """Get the newest AMI found by update"""
+    ret = mgr.latest_ami(mgr.list(), region, namefilter)
+    if not ret:
+        click.echo(f"No AMI found in {region}!")
+        return
+    click.echo(ret["ami"])
+
+
+@info.command(name="query")
+@click.option("--region", help="Rank by price in region", required=True)
+@click.option("--min-gpu-memory", type=float, help="Minimum GPU memory in GB")
+@click.option("--gpu-model", help="GPU model contains e.g. V100")
+@click.option("--min-compute-capability", type=float)
+@click.option("--min-cpu", type=int)
+@click.option("--max-cpu", type=int)
+@click.option("--min-memory", type=float, help="Minimum memory in GB")
+@click.option("--max-memory", type=float, help="Maximum memory in GB")
+@click.option("--max-price", type=float, help="Maximum on demand price per hour")
+@click.option("--supported/--all", default=True, show_default=True)
+@click.option("--top", type=int, help="Only show the top N by price per GPU")
+@click.option("--names/--no-names", default=False, help="Only print the names")
+@click.option("--csv/--no-csv", default=False)
+def _query(region, top, names, csv, **filters):
+    """Find GPU instances ranked by price per GPU"""
+    df = mgr.query(region, top_k=top, **filters)
+    if names:
+        to_print = "\n".join(df["name"])
+    elif csv:
+        to_print = df.to_csv()
+    else:
+        to_print = tabulate.tabulate(
+            df, headers="keys", tablefmt="fancy_grid", showindex="never"
+        )
+    print(to_print)
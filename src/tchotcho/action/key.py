@@ -1,12 +1,13 @@
 import os
 
-import boto3
 import click
 import colorama
 import pandas as pd
 
 import tabulate
 
+from tchotcho import aws
+from tchotcho.cache import Cache
 from tchotcho.log import log
 from tchotcho.rsa import RSAFingerprintManager
 from tchotcho.config import get_settings
@@ -16,8 +17,15 @@ colorama.init()
 
 class KeyManager:
     def __init__(self):
-        self.ec2 = boto3.client("ec2")
+        self._ec2 = None
         self.settings = get_settings()
+        self.cache = Cache("keys")
+
+    @property
+    def ec2(self):
+        if self._ec2 is None:
+            self._ec2 = aws.client("ec2")
+        return self._ec2
 
     def _import(self, name, path):
         ret = False
@@ -28,13 +36,18 @@ class KeyManager:
             return ret
 
         resp = self.ec2.import_key_pair(KeyName=name, PublicKeyMaterial=data)
+        self.cache.invalidate(self._cache_key())
         if resp["ResponseMetadata"]["HTTPStatusCode"] == 200:
             log.info(f"Succesfully imported key {name} from {path}")
             ret = True
         return ret
 
+    def _cache_key(self):
+        return [aws.account(), self.ec2.meta.region_name]
+
     def list(self):
-        resp = self.ec2.describe_key_pairs()  # KeyName=name)
+        """Key pairs of the account, cached in the keys namespace"""
+        resp = self.cache.get_or_set(self._cache_key(), self.ec2.describe_key_pairs)
         ret = [x for x in resp["KeyPairs"]]
         return ret
 
@@ -49,6 +62,7 @@ class KeyManager:
 
         log.info(f"Creating key {name}...")
         resp = self.ec2.create_key_pair(KeyName=name)
+        self.cache.invalidate(self._cache_key())
         priv_key = resp["KeyMaterial"]
 
         pub_name = "%s.pub" % name
@@ -81,6 +95,7 @@ class KeyManager:
 
         log.info(f"Deleting key {name}...")
         resp = self.ec2.delete_key_pair(KeyName=name)
+        self.cache.invalidate(self._cache_key())
         if resp["ResponseMetadata"]["HTTPStatusCode"] == 200:
 
             pub_name = "%s.pub" % name
@@ -0,0 +1,147 @@
+import click
+import pandas as pd
+import tabulate
+
+from tchotcho import catalog, placement
+from tchotcho.action.info import InfoManager
+from tchotcho.action.spot import SpotManager
+from tchotcho.config import get_settings
+from tchotcho.tropo import get_default_subnet_id
+
+
+class PlacementManager(object):
+    def __init__(self):
+        self.settings = get_settings()
+        self.info = InfoManager()
+        self.spot = SpotManager()
+
+    def solve(
+        self,
+        market="spot",
+        gpus=None,
+        gpu_memory=None,
+        min_compute_capability=None,
+        budget=None,
+        regions=None,
+        top=None,
+        cached=False,
+        supported=True,
+    ):
+        """Returns the cheapest placements per GPU for the requirements
+
+        The catalog of info update is joined with the on demand prices or the
+        spot prices (live or cached by spot sync), see placement.solve. Every
+        row has the newest AMI of its region, stack_args turns a row into the
+        arguments of StackManager.create.
+        """
+        index = catalog.read_index(self.settings.GPU_INFO_FILE)
+        spot = None
+        if market == "spot":
+            candidates = placement.solve(
+                index,
+                market="ondemand",
+                gpus=gpus,
+                gpu_memory=gpu_memory,
+                min_compute_capability=min_compute_capability,
+                regions=regions,
+                supported=supported,
+            )
+            # only fetch spot prices of instances matching the requirements
+            names = candidates["name"].unique().tolist()
+            if not names:
+                return candidates
+            spot = self.spot.current_prices(names, regions, cached=cached)
+        df = placement.solve(
+            index,
+            spot,
+            market,
+            gpus=gpus,
+            gpu_memory=gpu_memory,
+            min_compute_capability=min_compute_capability,
+            budget=budget,
+            regions=regions,
+            top=top,
+            supported=supported,
+        )
+        # only the AMIs are needed, not the instance columns
+        data = self.info.list(["name"])
+        ami = {x: self.info.latest_ami(data, x) for x in df["region"].unique()}
+        df["ami"] = df["region"].map(lambda x: (ami[x] or {}).get("ami"))
+        return df
+
+    def stack_args(self, row):
+        """Returns the StackManager.launch candidate of a placement row
+
+        region is the one of StackManager(region), the others are arguments
+        of StackManager.create. A spot row is launched in the default subnet
+        of its availability zone and bids the on demand price, or without one
+        the spot price plus Settings.SPOT_BID_HEADROOM. On demand has no bid.
+        """
+        ret = {"region": row["region"], "ami": row["ami"], "inst": row["name"]}
+        if row["market"] != "spot":
+            return ret
+        subnet = get_default_subnet_id(row["az"], row["region"])
+        if subnet is None:
+            raise ValueError(f"No default subnet in {row['az']}")
+        ret["subnet"] = subnet
+        ret["price"] = float(row["ondemand"])
+        if pd.isna(ret["price"]):
+            headroom = 1 + self.settings.SPOT_BID_HEADROOM
+            ret["price"] = round(float(row["price"]) * headroom, 4)
+        return ret
+
+
+@click.command()
+@click.option(
+    "--market",
+    type=click.Choice(placement.MARKETS),
+    default="spot",
+    show_default=True,
+)
+@click.option("--gpus", type=int, help="Minimum number of GPUs")
+@click.option("--gpu-memory", type=float, help="Minimum total GPU memory in GB")
+@click.option("--min-compute-capability", type=float)
+@click.option("--budget", type=float, help="Maximum price per hour")
+@click.option("--region", help="Only place in region", multiple=True)
+@click.option("--top", type=int, default=10, show_default=True)
+@click.option(
+    "--cached/--live",
+    default=False,
+    help="Use the spot prices stored by spot sync instead of fetching them",
+)
+@click.option("--supported/--all", default=True, show_default=True)
+@click.option("--csv/--no-csv", default=False)
+def place(
+    market,
+    gpus,
+    gpu_memory,
+    min_compute_capability,
+    budget,
+    region,
+    top,
+    cached,
+    supported,
+    csv,
+):
+    """Find the cheapest instance and zone for GPU requirements"""
+    mgr = PlacementManager()
+    df = mgr.solve(
+        market,
+        gpus,
+        gpu_memory,
+        min_compute_capability,
+        budget,
+        region,
+        top,
+        cached,
+        supported,
+    )
+    if df.empty:
+        click.echo("No placement found!")
+        return
+    to_print = df.to_csv(index=False)
+    if not csv:
+        to_print = tabulate.tabulate(
+            df, headers="keys", tablefmt="fancy_grid", showindex="never"
+        )
+    print(to_print)
@@ -1,84 +1,362 @@
-import json
 import datetime
 import itertools
+import json
+import pathlib
 import collections.abc
-import concurrent.futures
+import subprocess
+import time
 
-import boto3
 import click
 import colorama
 import pandas as pd
 
 import tabulate
 
+from tchotcho import aws, catalog
+from tchotcho.cache import Cache
+from tchotcho.analytics import spot_stats
 from tchotcho.config import get_settings
+from tchotcho.fanout import fan_out
+from tchotcho.history import SpotHistoryStore
+from tchotcho.log import log
+from tchotcho.region import RegionInventory
 
 colorama.init()
 
+PRODUCTS = ["Linux/UNIX", "Linux/UNIX (Amazon VPC)"]
+# instance types per describe_spot_price_history call
+INSTANCE_CHUNK = 100
+
 
 class SpotManager(object):
     def __init__(self):
         self.settings = get_settings()
+        self.inventory = RegionInventory(self._client)
+
+    def _client(self, region):
+        return aws.client("ec2", region)
 
-    def _spot_history_wrapper(self, args):
-        return self._spot_history(*args)
+    def iter_spot_history(
+        self, inst, region, start_time=None, end_time=None, availability_zone=None
+    ):
+        """Yield the spot price records of region following every page
+
+        The instance types are queried in chunks of INSTANCE_CHUNK.
+        """
+        paginator = self._client(region).get_paginator("describe_spot_price_history")
+        inst = list(inst)
+        for i in range(0, len(inst), INSTANCE_CHUNK):
+            kwargs = {
+                "InstanceTypes": inst[i : i + INSTANCE_CHUNK],
+                "ProductDescriptions": PRODUCTS,
+            }
+            if start_time:
+                kwargs["StartTime"] = start_time
+            if end_time:
+                kwargs["EndTime"] = end_time
+            if availability_zone:
+                kwargs["AvailabilityZone"] = availability_zone
+            for page in paginator.paginate(**kwargs):
+                yield from page["SpotPriceHistory"]
+
+    @staticmethod
+    def latest(records):
+        """Latest record per (instance type, availability zone, product)"""
+        ret = {}
+        for x in records:
+            key = (x["InstanceType"], x["AvailabilityZone"], x["ProductDescription"])
+            if key not in ret or x["Timestamp"] > ret[key]["Timestamp"]:
+                ret[key] = x
+        return list(ret.values())
 
     def _spot_history(self, inst, region):
-        client = boto3.client("ec2", region_name=region)
-        prices = client.describe_spot_price_history(
-            InstanceTypes=inst,
-            ProductDescriptions=["Linux/UNIX", "Linux/UNIX (Amazon VPC)"],
-            StartTime=(
-                datetime.datetime.now() + datetime.timedelta(days=1)
-            ).isoformat(),
-            MaxResults=len(inst),
-        )
-        ret = prices["SpotPriceHistory"]
-        return ret
+        # with StartTime now only the prices in effect now are returned
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return self.latest(self.iter_spot_history(inst, region, start_time=now))
 
-    def list(self, gpu, region=None, inst=[], method="future-process"):
+    def _region_prices(self, args):
+        inst, region = args
+        ret = self._spot_history(inst, region)
+        for x in ret:
+            x["SpotPrice"] = float(x["SpotPrice"])
+        return region, sorted(ret, key=lambda x: x["SpotPrice"])
+
+    def _watched_region_prices(self, args):
+        """_region_prices of a poll, (region, None) if the region failed"""
+        try:
+            return self._region_prices(args)
+        except Exception as ex:
+            log.warning(f"Spot prices of {args[1]} failed, keeping the last: {ex}")
+            return args[1], None
+
+    def _cached_region_prices(self, args):
+        """_region_prices cached in the spot namespace"""
+        inst, region = args
+        key = [region, sorted(inst)]
+        return region, Cache("spot").get_or_set(key, lambda: self._region_prices(args)[1])
+
+    def _instances(self, gpu, inst):
         if len(inst) == 0:
-            with open(self.settings.GPU_INFO_FILE) as f:
-                inst = json.load(f)["instance"]
-                if gpu:
-                    inst = [x["name"] for x in inst if x["gpu"] > 0 and x["supported"]]
-                else:
-                    inst = [x["name"] for x in inst]
+            df = catalog.read_instances(
+                self.settings.GPU_INFO_FILE, ["name", "gpu", "supported"]
+            )
+            if gpu:
+                df = df[(df["gpu"] > 0) & df["supported"]]
+            inst = df["name"].tolist()
 
         if not isinstance(inst, collections.abc.Sequence) or isinstance(inst, str):
             raise Exception("We need a list for inst!")
+        return inst
 
-        client = boto3.client("ec2")
-        regions = [
-            (inst, x["RegionName"]) for x in client.describe_regions()["Regions"]
-        ]
-
+    def _regions(self, region):
+        names = self.inventory.enabled_regions()
         if region:
-            regions = [x for x in regions if region in x[1]]
-
-        if method == "future-process":
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                results = list(executor.map(self._spot_history_wrapper, regions))
-        else:
-            results = [self._spot_history(*x) for x in regions]
+            names = [x for x in names if region in x]
+        return names
 
-        results = [x for x in results if x]
+    def iter_list(
+        self, gpu, region=None, inst=[], method="future-thread", max_workers=None
+    ):
+        """Yield (region, prices sorted by price) as soon as a region is done"""
+        inst = self._instances(gpu, inst)
+        # only query regions and instance types that are offered
+        matches = self.inventory.match(inst, self._regions(region))
+        regions = [(v, k) for k, v in matches.items()]
 
-        results = list(itertools.chain.from_iterable(results))
+        yield from fan_out(self._cached_region_prices, regions, method, max_workers)
 
-        for x in results:
-            x["SpotPrice"] = float(x["SpotPrice"])
+    def list(
+        self, gpu, region=None, inst=[], method="future-thread", max_workers=None
+    ):
+        results = self.iter_list(gpu, region, inst, method, max_workers)
+        results = list(itertools.chain.from_iterable(x[1] for x in results))
         ret = sorted(results, key=lambda x: x["SpotPrice"])
         print(f"Found {len(results)} entries")
         return ret
 
+    def current_prices(self, inst, regions=None, cached=False):
+        """Returns the spot price per (region, instance type, az) as DataFrame
+
+        Live prices are fetched from the enabled (or given) regions, cached
+        ones are the last points stored by sync. Of the products the cheaper
+        price is kept.
+        """
+        if cached:
+            store = self.history_store()
+            try:
+                df = store.latest(regions or None, inst)
+            finally:
+                store.close()
+        else:
+            regions = list(regions) if regions else self.inventory.enabled_regions()
+            matches = self.inventory.match(inst, regions)
+            jobs = [(v, k) for k, v in matches.items()]
+            df = pd.DataFrame(
+                [
+                    (name, x["InstanceType"], x["AvailabilityZone"], x["SpotPrice"])
+                    for name, ret in fan_out(self._cached_region_prices, jobs)
+                    for x in ret
+                ],
+                columns=["region", "instance_type", "az", "price"],
+            )
+        keys = ["region", "instance_type", "az"]
+        return df.groupby(keys, observed=True, as_index=False)["price"].min()
+
+    @staticmethod
+    def delta(previous, current, below=None, above=None):
+        """Returns the events between two {(region, instance type, az): price}
+
+        Every new, changed or removed price is an event, threshold is set to
+        below or above when the price crossed it (a first price counts as
+        crossing).
+        """
+        events = []
+        for key in sorted(set(previous) | set(current)):
+            old, new = previous.get(key), current.get(key)
+            if old == new:
+                continue
+            region, inst, az = key
+            if old is None:
+                kind = "new"
+            elif new is None:
+                kind = "removed"
+            elif new < old:
+                kind = "down"
+            else:
+                kind = "up"
+            event = {
+                "region": region,
+                "instance_type": inst,
+                "az": az,
+                "event": kind,
+                "price": new,
+                "previous": old,
+                "threshold": None,
+                "limit": None,
+            }
+            if new is not None:
+                if below is not None and new < below and (old is None or old >= below):
+                    event["threshold"], event["limit"] = "below", below
+                elif above is not None and new > above and (old is None or old <= above):
+                    event["threshold"], event["limit"] = "above", above
+            events.append(event)
+        return events
+
+    @staticmethod
+    def message(event):
+        name = f"{event['instance_type']} in {event['az']}"
+        if event["event"] == "removed":
+            return f"{name} has no spot price anymore"
+        if event["threshold"]:
+            word = "dropped below" if event["threshold"] == "below" else "rose above"
+            return f"{name} {word} ${event['limit']:.2f} at ${event['price']:.4f}"
+        if event["event"] == "new":
+            return f"{name} is ${event['price']:.4f}"
+        return (
+            f"{name} went {event['event']} to ${event['price']:.4f} "
+            f"from ${event['previous']:.4f}"
+        )
+
+    def watch(
+        self,
+        gpu,
+        region=None,
+        inst=[],
+        interval=60,
+        below=None,
+        above=None,
+        count=None,
+        method="future-thread",
+        max_workers=None,
+    ):
+        """Poll the spot prices every interval seconds and yield the events
+
+        The offered regions and the clients are resolved once, every poll
+        queries the regions concurrently and is diffed against the previous
+        one, see delta. A region that fails keeps its previous prices until a
+        later poll succeeds. Stops after count polls if given.
+        """
+        inst = self._instances(gpu, inst)
+        matches = self.inventory.match(inst, self._regions(region))
+        jobs = [(v, k) for k, v in matches.items()]
+        previous = {}
+        started = time.monotonic()
+        for i in itertools.count():
+            if count is not None and i >= count:
+                return
+            if i:
+                time.sleep(max(0, started + interval - time.monotonic()))
+            started = time.monotonic()
+            current = {}
+            polls = fan_out(self._watched_region_prices, jobs, method, max_workers)
+            for name, ret in polls:
+                if ret is None:
+                    current.update((k, v) for k, v in previous.items() if k[0] == name)
+                    continue
+                # sorted by price so the cheaper product wins
+                for x in reversed(ret):
+                    key = (name, x["InstanceType"], x["AvailabilityZone"])
+                    current[key] = x["SpotPrice"]
+            now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            for event in self.delta(previous, current, below, above):
+                event["time"] = now
+                event["message"] = self.message(event)
+                yield event
+            previous = current
+
+    def history_store(self):
+        return SpotHistoryStore(self.settings.PROG_HOME / "spot_history.sqlite")
+
+    @staticmethod
+    def _sync_plan(last, zones, inst, default_start):
+        """Returns {az: (instance types, start)} to fetch only new points"""
+        plan = {}
+        for az, offered in zones.items():
+            types = [x for x in inst if x in offered]
+            if not types:
+                continue
+            start = min(last.get((x, az), default_start) for x in types)
+            plan[az] = (types, datetime.datetime.fromtimestamp(start, datetime.timezone.utc))
+        return plan
+
+    def _sync_region(self, args):
+        region, plan = args
+        records = []
+        for az, (types, start) in plan.items():
+            records.extend(
+                self.iter_spot_history(
+                    types, region, start_time=start, availability_zone=az
+                )
+            )
+        return region, records
+
+    def sync(
+        self,
+        gpu,
+        region=None,
+        inst=[],
+        days=None,
+        method="future-thread",
+        max_workers=None,
+    ):
+        """Fetch the spot price history into the local store
+
+        Per (region, instance type, az) only points after the last stored one
+        are fetched, without stored points the last days (default
+        Settings.SPOT_HISTORY_DAYS) are fetched. Returns {region: new points}.
+        """
+        inst = self._instances(gpu, inst)
+        days = self.settings.SPOT_HISTORY_DAYS if days is None else days
+        now = datetime.datetime.now(datetime.timezone.utc)
+        default_start = int((now - datetime.timedelta(days=days)).timestamp())
 
-mgr = SpotManager()
+        store = self.history_store()
+        try:
+            offerings = self.inventory.offerings(self._regions(region))
+            jobs = [
+                (k, self._sync_plan(store.last_timestamps(k), v, inst, default_start))
+                for k, v in offerings.items()
+            ]
+            ret = {}
+            for name, records in fan_out(self._sync_region, jobs, method, max_workers):
+                ret[name] = store.append(name, records)
+                log.info(f"Stored {ret[name]} new spot prices of {name}")
+            return ret
+        finally:
+            store.close()
+
+    def history(self, region=None, inst=None, days=None):
+        """Returns the stored spot prices of the last days as DataFrame"""
+        start = None
+        if days is not None:
+            start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+                days=days
+            )
+        store = self.history_store()
+        try:
+            return store.query(region=region, instance_types=inst, start=start)
+        finally:
+            store.close()
+
+    def stats(self, region=None, inst=None, days=None, window="1D", ratio=0.5):
+        """Returns spot price statistics per (region, instance type, az, product)
+
+        Computed over the stored history, see analytics.spot_stats.
+        """
+        ondemand = None
+        if pathlib.Path(self.settings.GPU_INFO_FILE).exists():
+            ondemand = catalog.read_prices(self.settings.GPU_INFO_FILE)
+        df = self.history(region, inst, days)
+        return spot_stats(df, ondemand, window=window, ratio=ratio)
+
+
+mgr = None
 
 
 @click.group()
 def spot():
-    ...
+    global mgr
+    mgr = SpotManager()
 
 
 @spot.command(name="list")
@@ -89,8 +367,6 @@ def spot():
 @click.option("--inst", help="List spot prices for instance type", multiple=True)
 @click.option("--csv/--no-csv", default=False)
 def _list(gpu, region, inst, csv):
-    ret = mgr.list(gpu, region, inst)
-
     def set_color(val):
         if val < 1:
             val = colorama.Back.GREEN + str(val) + colorama.Back.RESET
@@ -100,13 +376,102 @@ def _list(gpu, region, inst, csv):
             val = colorama.Back.YELLOW + str(val) + colorama.Back.RESET
         return val
 
-    # apply to specific column
-    df = pd.DataFrame(ret)
-    df = df[["InstanceType", "AvailabilityZone", "SpotPrice"]]
-    to_print = df.to_csv()
+    # print every region as soon as its prices are there
+    count = 0
+    for _, ret in mgr.iter_list(gpu, region, inst):
+        if not ret:
+            continue
+        # apply to specific column
+        df = pd.DataFrame(ret)
+        df = df[["InstanceType", "AvailabilityZone", "SpotPrice"]]
+        to_print = df.to_csv(header=count == 0)
+
+        if not csv:
+            df["SpotPrice"] = df["SpotPrice"].apply(set_color)
+            to_print = tabulate.tabulate(
+                df, headers="keys", tablefmt="fancy_grid", showindex="never"
+            )
+        print(to_print, flush=True)
+        count += len(ret)
+    print(f"Found {count} entries")
+
+
+@spot.command()
+@click.option("--region", help="Watch spot prices in region")
+@click.option(
+    "--gpu/--no-gpu", default=True, help="Limit results to show only GPU instances"
+)
+@click.option("--inst", help="Watch spot prices of instance type", multiple=True)
+@click.option("--interval", type=float, default=60, show_default=True,
+              help="Seconds between polls")
+@click.option("--below", type=float, help="Report prices dropping below")
+@click.option("--above", type=float, help="Report prices rising above")
+@click.option("--thresholds-only/--all-changes", default=False,
+              help="Only report threshold crossings")
+@click.option("--count", type=int, help="Stop after count polls")
+@click.option(
+    "--output", type=click.Choice(["table", "ndjson"]), default="table",
+    show_default=True,
+)
+@click.option("--hook", help="Run command per event with the event json on stdin")
+def watch(gpu, region, inst, interval, below, above, thresholds_only, count,
+          output, hook):
+    """Watch spot prices and report only the changes"""
+    events = mgr.watch(gpu, region, inst, interval, below, above, count)
+    for event in events:
+        if thresholds_only and not event["threshold"]:
+            continue
+        if output == "ndjson":
+            print(json.dumps(event), flush=True)
+        else:
+            print(f"{event['time']} {event['region']} {event['message']}", flush=True)
+        if hook:
+            ret = subprocess.run(hook, shell=True, input=json.dumps(event), text=True)
+            if ret.returncode:
+                log.warning(f"Hook failed with exit code {ret.returncode}")
+
+
+@spot.command()
+@click.option("--region", help="Sync spot prices of region")
+@click.option(
+    "--gpu/--no-gpu", default=True, help="Limit results to show only GPU instances"
+)
+@click.option("--inst", help="Sync spot prices of instance type", multiple=True)
+@click.option("--days", type=int, help="Days to fetch if nothing is stored yet")
+def sync(gpu, region, inst, days):
+    """Fetch new spot prices into the local history"""
+    ret = mgr.sync(gpu, region, inst, days)
+    click.echo(f"Stored {sum(ret.values())} new spot prices")
 
+
+@spot.command()
+@click.option("--region", help="Spot prices of region", multiple=True)
+@click.option("--inst", help="Spot prices of instance type", multiple=True)
+@click.option("--days", type=int, default=7, show_default=True)
+def history(region, inst, days):
+    """Print the stored spot prices as csv"""
+    df = mgr.history(region, inst, days)
+    print(df.to_csv(index=False))
+
+
+@spot.command()
+@click.option("--region", help="Spot prices of region", multiple=True)
+@click.option("--inst", help="Spot prices of instance type", multiple=True)
+@click.option("--days", type=int, default=7, show_default=True)
+@click.option("--window", default="1D", show_default=True, help="Rolling window")
+@click.option(
+    "--ratio", type=float, default=0.5, show_default=True,
+    help="Count the time the spot price is above ratio * on demand price",
+)
+@click.option("--csv/--no-csv", default=False)
+def stats(region, inst, days, window, ratio, csv):
+    """Spot price volatility and stability of the stored history"""
+    df = mgr.stats(region, inst, days, window, ratio)
+    if df.empty:
+        click.echo("No spot prices stored, run spot sync first!")
+        return
+    to_print = df.to_csv()
     if not csv:
-        df["SpotPrice"] = df["SpotPrice"].apply(set_color)
         to_print = tabulate.tabulate(
             df, headers="keys", tablefmt="fancy_grid", showindex="never"
         )
@@ -1,6 +1,34 @@
-import boto3
-from tchotcho.tropo import create_cloudformation
-from tchotcho.util import boto_exception, get_wrapped_waiter
+import datetime
+import json
+import threading
+import time
+
+from tchotcho import aws
+from tchotcho.cache import Cache
+from tchotcho.config import get_settings
+from tchotcho.bake import BakedImages, bake_key, requirements_script
+from tchotcho.tropo import (
+    ALLOCATION_STRATEGIES,
+    METADATA_KEY,
+    USER_SCRIPT_BAKED,
+    USER_SCRIPT_DEFAULT,
+    create_cloudformation,
+    lint,
+    template_digest,
+)
+from tchotcho.errors import AwsError
+from tchotcho.events import (
+    DEFAULT_MAX_INTERVAL,
+    MIN_INTERVAL,
+    STACK_TYPE,
+    FleetProgress,
+    StackEvents,
+    StackProgress,
+    is_capacity_failure,
+)
+from tchotcho.fanout import fan_out
+from tchotcho.region import RegionInventory
+from tchotcho.util import boto_exception
 from tchotcho.log import log
 import pandas as pd
 import click
@@ -10,57 +38,414 @@ import tabulate
 
 colorama.init()
 
+# statuses of stacks that only cost money, deleted by gc
+GC_STATUSES = (
+    "CREATE_FAILED",
+    "ROLLBACK_COMPLETE",
+    "ROLLBACK_FAILED",
+    "DELETE_FAILED",
+    "UPDATE_ROLLBACK_FAILED",
+)
+INVENTORY_COLUMNS = ["region", "name", "status", "reason", "created", "age_hours", "id"]
+# seconds gc waits for its deletes
+GC_TIMEOUT = 30 * 60
+# seconds update waits for its change set to be created
+CHANGE_SET_TIMEOUT = 5 * 60
+# StatusReason of a change set that failed only because nothing changed
+NO_CHANGES_REASONS = ("didn't contain changes", "No updates are to be performed")
+
 
 class StackManager(object):
-    def __init__(self):
-        self.cf = boto3.client("cloudformation")
+    def __init__(self, region=None):
+        self.region = region
+        self._cf = None
         self.output = None
+        self.cache = Cache("stacks")
+        self.templates = Cache("templates")
+        self.baked = BakedImages(get_settings().BAKED_AMI_FILE)
+        self.events = []
+        self.changes = []
+        self.regions = RegionInventory(lambda x: aws.client("ec2", x))
+
+    @property
+    def cf(self):
+        if self._cf is None:
+            self._cf = aws.client("cloudformation", self.region)
+        return self._cf
 
-    def _parse_template(self, template_data):
+    @property
+    def region_name(self):
+        """Region of the manager, known offline without a client"""
+        return self.region or aws.default_region()
+
+    def _validate(self, template_data):
         self.cf.validate_template(TemplateBody=template_data)
+        return True
+
+    def _parse_template(self, template_data, offline=False):
+        """Validate a template once, a valid one is marked by its digest
+
+        offline checks the template with cfn-lint instead of cloudformation.
+        """
+        if offline:
+            region = self.region_name
+            errors = lint(template_data, [region] if region else None)
+            if errors:
+                raise ValueError("Invalid template:\n" + "\n".join(errors))
+            return template_data
+        key = ["validated", template_digest(template_data)]
+        self.templates.get_or_set(key, lambda: self._validate(template_data))
         return template_data
 
     def stack_exists(self, name):
-        stacks = self.cf.list_stacks()["StackSummaries"]
-        for stack in stacks:
-            if stack["StackStatus"] == "DELETE_COMPLETE":
-                continue
-            if name == stack["StackName"]:
-                return True
-        return False
-
-    def _waiter_callback(self, response):
-        if "Stacks" in response:
-            stack = response["Stacks"][0]
-            if "Outputs" in stack:
-                out = stack["Outputs"]
-                df = pd.DataFrame(out)
-                self.output = {x["OutputKey"].lower(): x["OutputValue"] for x in out}
-                to_print = tabulate.tabulate(
+        """True if there is a stack name, deleted stacks are not found by name"""
+        try:
+            self.cf.describe_stacks(StackName=name)
+        except AwsError as ex:
+            if ex.code == "ValidationError" and "does not exist" in str(ex):
+                return False
+            raise
+        return True
+
+    def _outputs(self, stack_id):
+        """Outputs of a stack, the instance outputs are read from the instance
+
+        The template outputs of an instance are fixed at creation and wrong
+        after a stop and start, a fleet template has none. They are kept if
+        the instance is gone e.g. terminated.
+        """
+        stack = self.cf.describe_stacks(StackName=stack_id)["Stacks"][0]
+        outputs = {x["OutputKey"]: x for x in stack.get("Outputs", [])}
+        instance_id = None
+        if "FleetId" in outputs:
+            fleet_id = outputs["FleetId"]["OutputValue"]
+            resp = self.ec2.describe_fleet_instances(FleetId=fleet_id)
+            active = resp["ActiveInstances"]
+            if active:
+                instance_id = active[0]["InstanceId"]
+        elif "InstanceId" in outputs:
+            instance_id = outputs["InstanceId"]["OutputValue"]
+        if instance_id is not None:
+            for x in self._instance_outputs(instance_id):
+                outputs[x["OutputKey"]] = dict(outputs.get(x["OutputKey"], {}), **x)
+        return [x for x in outputs.values()]
+
+    def _instance(self, instance_id):
+        """Returns the description of an instance or None if it is gone"""
+        try:
+            resp = self.ec2.describe_instances(InstanceIds=[instance_id])
+        except AwsError as ex:
+            if ex.code == "InvalidInstanceID.NotFound":
+                return None
+            raise
+        if not resp["Reservations"]:
+            return None
+        return resp["Reservations"][0]["Instances"][0]
+
+    def _instance_outputs(self, instance_id):
+        inst = self._instance(instance_id)
+        if inst is None:
+            return []
+        values = {
+            "InstanceId": inst["InstanceId"],
+            "InstanceType": inst["InstanceType"],
+            "State": inst["State"]["Name"],
+            "AZ": inst["Placement"]["AvailabilityZone"],
+            "PublicIP": inst.get("PublicIpAddress"),
+            "PrivateIP": inst.get("PrivateIpAddress"),
+            "PublicDNS": inst.get("PublicDnsName"),
+            "PrivateDNS": inst.get("PrivateDnsName"),
+        }
+        return [{"OutputKey": k, "OutputValue": v} for k, v in values.items() if v]
+
+    def _print_outputs(self, stack_id):
+        out = self._outputs(stack_id)
+        self.output = {x["OutputKey"].lower(): x["OutputValue"] for x in out}
+        log.debug(self.output)
+        if out:
+            df = pd.DataFrame(out)
+            print(
+                tabulate.tabulate(
                     df, headers="keys", tablefmt="fancy_grid", showindex="never"
                 )
-                log.debug(self.output)
-                print(to_print)
-            elif "StackName" in stack:
-                log.info(f"StackName: {stack['StackName']} StackStatus: "
-                         f"{stack['StackStatus']}")
-            else:
-                log.info(stack)
+            )
+
+    @staticmethod
+    def _log_event(event):
+        took = f" in {event['duration']:.0f}s" if event["duration"] is not None else ""
+        reason = f" ({event['reason']})" if event["reason"] else ""
+        log.info(f"{event['resource']} {event['status']}{took}{reason}")
+
+    def _follow(self, stack_id, last_event_id=None, on_event=None, stop=None):
+        progress = StackProgress(StackEvents(self.cf, stack_id, last_event_id))
+        events = []
+        for event in progress.follow(stop, get_settings().STACK_TIMEOUT):
+            events.append(event)
+            (on_event or self._log_event)(event)
+        return progress.status, events
+
+    def follow(self, stack_id, last_event_id=None):
+        """Log the events of a stack operation until it is done
+
+        Returns the final stack status, the events with the duration of
+        every finished resource are kept in events. Raises TimeoutError after
+        Settings.STACK_TIMEOUT seconds.
+        """
+        status, self.events = self._follow(stack_id, last_event_id)
+        return status
+
+    @property
+    def ec2(self):
+        return aws.client("ec2", self.cf.meta.region_name)
+
+    def baked_image(self, ami, requirements="", verify=True):
+        """Returns the record of the AMI baked from ami and requirements or None
+
+        With verify a record of a deregistered AMI is removed, else the local
+        record is returned as is.
+        """
+        key = bake_key(ami, USER_SCRIPT_DEFAULT, requirements)
+        record = self.baked.get(key, self.region_name)
+        if record is None or not verify:
+            return record
+        if not self._image_available(record["ami"]):
+            log.info(f"Baked image {record['ami']} is gone")
+            self.baked.remove(key)
+            return None
+        return record
+
+    def _image_available(self, image_id):
+        images = self.ec2.describe_images(
+            Filters=[{"Name": "image-id", "Values": [image_id]}]
+        )["Images"]
+        return bool(images) and images[0]["State"] == "available"
+
+    def _template(
+        self,
+        name,
+        ami,
+        inst,
+        security_group=None,
+        subnet=None,
+        price=None,
+        size=120,
+        extra_user_data='echo "hello" > /tmp/hello.txt',
+        key_name=None,
+        requirements="",
+        baked=True,
+        allocation=None,
+        vpc=None,
+        offline=False,
+        baked_image=None,
+    ):
+        """Template of a stack, uses the baked AMI of ami if there is one
+
+        inst and subnet can be ranked lists to launch by an EC2 Fleet, see
+        create_cloudformation. The arguments are kept in the template
+        metadata for update. offline builds it without calling AWS.
+        baked_image is a baked AMI id used as is e.g. the one of a stack to
+        update, raises ValueError if it is gone.
+        """
+        args = {
+            "ami": ami,
+            "inst": inst,
+            "security_group": security_group,
+            "subnet": subnet,
+            "price": price,
+            "size": size,
+            "extra_user_data": extra_user_data,
+            "key_name": key_name,
+            "requirements": requirements,
+            "allocation": allocation,
+            "vpc": vpc,
+        }
+        # cloudformation does not take null values in the metadata
+        metadata = {"args": {k: v for k, v in args.items() if v is not None}}
+        if baked_image is not None:
+            if not offline and not self._image_available(baked_image):
+                raise ValueError(f"Baked image {baked_image} of {ami} is gone")
+            record = {"ami": baked_image}
+        elif baked:
+            record = self.baked_image(ami, requirements, not offline)
+        else:
+            record = None
+        if record is not None:
+            log.info(f"Using baked image {record['ami']} of {ami}")
+            ami = record["ami"]
+            user_script = USER_SCRIPT_BAKED
+            metadata["baked_image"] = ami
         else:
-            log.info(response)
+            user_script = USER_SCRIPT_DEFAULT
+            extra_user_data = requirements_script(requirements) + extra_user_data
+        return create_cloudformation(
+            key_name or name,
+            ami,
+            inst,
+            security_group,
+            subnet,
+            price,
+            size,
+            user_script=user_script,
+            extra_user_data=extra_user_data,
+            allocation=allocation,
+            region=self.region_name,
+            metadata=metadata,
+            vpc_id=vpc,
+            offline=offline,
+        )
+
+    def _start_create(self, name, **kwargs):
+        """Validate the template and start creating the stack, returns its id
+
+        See _template for the arguments.
+        """
+        template = self._template(name, **kwargs)
+        params = {
+            "StackName": name,
+            "TemplateBody": self._parse_template(template),
+            "Capabilities": ["CAPABILITY_IAM"],
+            # finds the stack in the inventory whatever its name
+            "Tags": [{"Key": get_settings().PREFIX, "Value": name}],
+        }
+        stack_id = self.cf.create_stack(**params)["StackId"]
+        self.cache.invalidate(self._cache_key())
+        return stack_id
+
+    def _created_with(self, name):
+        """Template arguments of a stack, kept in its template metadata"""
+        body = self.cf.get_template(StackName=name)["TemplateBody"]
+        if isinstance(body, str):
+            body = json.loads(body)
+        metadata = body.get("Metadata", {}).get(METADATA_KEY)
+        if metadata is None:
+            raise ValueError(f"Stack {name} has no {METADATA_KEY} metadata to update")
+        args = dict(metadata["args"], baked=False)
+        # keep starting from the same baked image, never a newer bake
+        if "baked_image" in metadata:
+            args["baked_image"] = metadata["baked_image"]
+        return args
+
+    def _describe_change_set(self, name, change_set, timeout=CHANGE_SET_TIMEOUT):
+        """Wait for a change set, returns its status, reason and changes
+
+        The status is TIMEOUT if it is still being created after timeout
+        seconds.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            resp = self.cf.describe_change_set(StackName=name, ChangeSetName=change_set)
+            if resp["Status"] not in ("CREATE_PENDING", "CREATE_IN_PROGRESS"):
+                break
+            if time.monotonic() >= deadline:
+                return "TIMEOUT", f"not created after {timeout}s", []
+            time.sleep(MIN_INTERVAL)
+        changes = resp.get("Changes", [])
+        while resp.get("NextToken"):
+            resp = self.cf.describe_change_set(
+                StackName=name, ChangeSetName=change_set, NextToken=resp["NextToken"]
+            )
+            changes.extend(resp.get("Changes", []))
+        ret = []
+        for x in changes:
+            change = x["ResourceChange"]
+            ret.append(
+                {
+                    "action": change["Action"],
+                    "resource": change["LogicalResourceId"],
+                    "type": change["ResourceType"],
+                    # True, False or Conditional for a Modify
+                    "replacement": change.get("Replacement", ""),
+                    "scope": ",".join(change.get("Scope", [])),
+                    "details": ",".join(
+                        y["Target"].get("Name") or y["Target"]["Attribute"]
+                        for y in change.get("Details", [])
+                    ),
+                }
+            )
+        return resp["Status"], resp.get("StatusReason"), ret
+
+    @staticmethod
+    def _print_changes(changes):
+        df = pd.DataFrame(changes)
+        print(
+            tabulate.tabulate(
+                df, headers="keys", tablefmt="fancy_grid", showindex="never"
+            )
+        )
+
+    def update(self, name, dry=False, **changes):
+        """Update a stack in place by a change set
+
+        changes are template arguments (see _template) replacing the ones
+        the stack was created with. The changes, with the resources that are
+        replaced instead of modified, are printed and kept in changes. A dry
+        run only shows them. A change set that fails for another reason than
+        no changes raises ValueError. The stack keeps its baked image unless
+        ami or requirements change.
+        """
+        args = self._created_with(name)
+        changes = {k: v for k, v in changes.items() if v is not None}
+        if any(
+            changes.get(x, args.get(x)) != args.get(x) for x in ("ami", "requirements")
+        ):
+            args.pop("baked_image", None)
+        args.update(changes)
+        template = self._parse_template(self._template(name, **args))
+        stack_id = self.cf.describe_stacks(StackName=name)["Stacks"][0]["StackId"]
+        change_set = f"{get_settings().PREFIX}-update-{int(time.time())}"
+        self.cf.create_change_set(
+            StackName=name,
+            ChangeSetName=change_set,
+            TemplateBody=template,
+            Capabilities=["CAPABILITY_IAM"],
+            ChangeSetType="UPDATE",
+        )
+        status, reason, self.changes = self._describe_change_set(name, change_set)
+        if status != "CREATE_COMPLETE":
+            self.cf.delete_change_set(StackName=name, ChangeSetName=change_set)
+            # a change set without changes fails to be created
+            if status == "FAILED" and any(
+                x in (reason or "") for x in NO_CHANGES_REASONS
+            ):
+                log.info(f"Stack {name} has no changes")
+                return self.changes
+            raise ValueError(f"Change set of {name} {status}: {reason}")
+        self._print_changes(self.changes)
+        if dry:
+            self.cf.delete_change_set(StackName=name, ChangeSetName=change_set)
+            return self.changes
+
+        log.info(f"Updating stack: {name}...")
+        events = StackEvents(self.cf, stack_id)
+        events.mark()
+        self.cf.execute_change_set(StackName=name, ChangeSetName=change_set)
+        status = self.follow(stack_id, events.last_event_id)
+        self.cache.invalidate(self._cache_key())
+        if status != "UPDATE_COMPLETE":
+            log.error(f"Stack {name} not updated: {status}")
+            return self.changes
+        log.info(f"Stack {name} updated")
+        self._print_outputs(stack_id)
+        return self.changes
 
     @boto_exception
     def delete(self, name):
-        """Delete a stack if it exists by name """
+        """Delete a stack if it exists by name"""
         log.info("Stack is: %s", name)
 
         if self.stack_exists(name):
             log.info(f"Deleting stack: {name}...")
+            # the events of a deleted stack are only found by its id
+            stack_id = self.cf.describe_stacks(StackName=name)["Stacks"][0]["StackId"]
+            events = StackEvents(self.cf, stack_id)
+            events.mark()
             self.cf.delete_stack(StackName=name)
-            waiter = get_wrapped_waiter(
-                self.cf, "stack_delete_complete", self._waiter_callback
-            )
-            waiter.wait(StackName=name)
+            self.cache.invalidate(self._cache_key())
+            status = self.follow(stack_id, events.last_event_id)
+            self.cache.invalidate(self._cache_key())
+            if status != "DELETE_COMPLETE":
+                log.error(f"Stack {name} not deleted: {status}")
+                return
             log.info(f"Stack {name} deleted")
         else:
             log.error(f"Stack {name} does not exist.")
@@ -77,54 +462,499 @@ class StackManager(object):
         size,
         dry,
         extra_user_data='echo "hello" > /tmp/hello.txt',
+        key_name=None,
+        requirements="",
+        baked=True,
+        allocation=None,
+        vpc=None,
+        offline=False,
     ):
-        "Create stack"
+        """Create stack, the key pair is key_name or name
 
-        template = create_cloudformation(
-            name,
-            ami,
-            inst,
-            security_group,
-            subnet,
-            price,
-            size,
+        A dry run only builds and validates the template, offline without
+        calling AWS. vpc is the VPC of the security group, default the
+        default VPC, an offline template without takes it as parameter.
+        """
+        kwargs = dict(
+            ami=ami,
+            inst=inst,
+            security_group=security_group,
+            subnet=subnet,
+            price=price,
+            size=size,
             extra_user_data=extra_user_data,
+            key_name=key_name,
+            requirements=requirements,
+            baked=baked,
+            allocation=allocation,
+            vpc=vpc,
         )
-
-        template_data = self._parse_template(template)
         if dry:
-            return template_data
-
-        params = {
-            "StackName": name,
-            "TemplateBody": template_data,
-            "Capabilities": ["CAPABILITY_IAM"],
-        }
+            template = self._template(name, offline=offline, **kwargs)
+            return self._parse_template(template, offline)
 
         if self.stack_exists(name):
             log.error(f"Stack {name} already exists!")
         else:
             print(f"Creating stack: {name}...")
-            self.cf.create_stack(**params)
-            waiter = get_wrapped_waiter(
-                self.cf, "stack_create_complete", self._waiter_callback
-            )
-            waiter.wait(StackName=name)
+            stack_id = self._start_create(name, **kwargs)
+            status = self.follow(stack_id)
+            self.cache.invalidate(self._cache_key())
+            if status != "CREATE_COMPLETE":
+                log.error(f"Stack {name} not created: {status}")
+                return None
             log.info(f"Stack {name} created")
+            self._print_outputs(stack_id)
             return self.output
 
+    def bake(
+        self,
+        ami,
+        inst,
+        requirements="",
+        name=None,
+        security_group=None,
+        subnet=None,
+        price=None,
+        size=120,
+        key_name=None,
+        force=False,
+    ):
+        """Bake the bootstrap and requirements into a new AMI
+
+        A stack is created from ami with the full user script, its instance
+        is imaged and the stack deleted again. The AMI is recorded by bake
+        key, later stacks of the same ami and requirements start from it
+        with USER_SCRIPT_BAKED. Returns the record of the baked AMI, raises
+        ValueError if it can not be baked.
+        """
+        key = bake_key(ami, USER_SCRIPT_DEFAULT, requirements)
+        record = None if force else self.baked_image(ami, requirements)
+        if record is not None:
+            log.info(f"Image {record['ami']} is already baked")
+            return record
+        name = name or f"{get_settings().PREFIX}-bake-{key[:8]}"
+        if self.stack_exists(name):
+            raise ValueError(f"Stack {name} already exists")
+        log.info(f"Baking {ami} with stack {name}...")
+        stack_id = self._start_create(
+            name,
+            ami=ami,
+            inst=inst,
+            security_group=security_group,
+            subnet=subnet,
+            price=price,
+            size=size,
+            extra_user_data="",
+            key_name=key_name,
+            requirements=requirements,
+            baked=False,
+        )
+        try:
+            status = self.follow(stack_id)
+            if status != "CREATE_COMPLETE":
+                raise ValueError(f"Bake stack {name} not created: {status}")
+            outputs = {
+                x["OutputKey"]: x["OutputValue"] for x in self._outputs(stack_id)
+            }
+            image_id = self.ec2.create_image(
+                InstanceId=outputs["InstanceId"],
+                Name=f"{get_settings().PREFIX}-{key[:16]}",
+                Description=f"{ami} baked by tchotcho",
+            )["ImageId"]
+            log.info(f"Waiting for image {image_id}...")
+            self.ec2.get_waiter("image_available").wait(ImageIds=[image_id])
+        finally:
+            self.delete(name)
+        return self.baked.add(
+            {
+                "key": key,
+                "ami": image_id,
+                "base_ami": ami,
+                "region": self.cf.meta.region_name,
+                "requirements": requirements or "",
+                "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            }
+        )
+
+    def _warm_instance(self, name):
+        """Instance id of a stack that can be stopped and started"""
+        outputs = {x["OutputKey"]: x["OutputValue"] for x in self._outputs(name)}
+        if "FleetId" in outputs:
+            raise ValueError(
+                f"Stack {name} is a fleet, its instance can not be stopped"
+            )
+        if "InstanceId" not in outputs:
+            raise ValueError(f"Stack {name} has no instance")
+        inst = self._instance(outputs["InstanceId"])
+        if inst is None or inst["State"]["Name"] == "terminated":
+            raise ValueError(f"The instance of stack {name} is terminated")
+        if inst.get("InstanceLifecycle") == "spot":
+            raise ValueError(f"Stack {name} is a spot instance, it can not be stopped")
+        if inst.get("RootDeviceType") != "ebs":
+            raise ValueError(f"Stack {name} has no EBS root volume")
+        return inst["InstanceId"]
+
+    def stop(self, name):
+        """Stop the on demand instance of a stack, its root volume is kept"""
+        instance_id = self._warm_instance(name)
+        log.info(f"Stopping {instance_id} of stack {name}...")
+        self.ec2.stop_instances(InstanceIds=[instance_id])
+        self.ec2.get_waiter("instance_stopped").wait(InstanceIds=[instance_id])
+        self.cache.invalidate(self._cache_key())
+        log.info(f"Stack {name} stopped")
+
+    def start(self, name):
+        """Start the stopped instance of a stack, returns its new outputs"""
+        instance_id = self._warm_instance(name)
+        log.info(f"Starting {instance_id} of stack {name}...")
+        self.ec2.start_instances(InstanceIds=[instance_id])
+        self.ec2.get_waiter("instance_running").wait(InstanceIds=[instance_id])
+        self.cache.invalidate(self._cache_key())
+        log.info(f"Stack {name} started")
+        # the public ip and dns change with every start
+        self._print_outputs(name)
+        return self.output
+
+    def _launch(self, args):
+        spec, progress = args
+        name = spec["name"]
+        started = time.monotonic()
+        ret = {"name": name, "status": "FAILED", "outputs": {}, "error": None}
+        try:
+            if self.stack_exists(name):
+                raise ValueError(f"Stack {name} already exists")
+            progress.set(name, "STARTING")
+            stack_id = self._start_create(**spec)
+            status, events = self._follow(
+                stack_id, on_event=lambda x: progress.update(name, x)
+            )
+            ret["status"] = status
+            if status == "CREATE_COMPLETE":
+                ret["outputs"] = {
+                    x["OutputKey"].lower(): x["OutputValue"]
+                    for x in self._outputs(stack_id)
+                }
+            else:
+                # the first failure is the cause, later ones are the rollback
+                failed = [x for x in events if x["status"].endswith("_FAILED")]
+                ret["error"] = failed[0]["reason"] if failed else status
+        except Exception as ex:
+            # one failed stack must not stop the rest of the fleet
+            log.error(f"Stack {name} failed: {ex}")
+            ret["error"] = str(ex)
+        progress.set(name, ret["status"])
+        ret["seconds"] = round(time.monotonic() - started, 1)
+        return ret
+
+    def create_fleet(self, specs, max_workers=None, **defaults):
+        """Create a stack per spec concurrently and wait for all of them
+
+        Every spec is a dict of create arguments (at least name) overriding
+        defaults, at most max_workers (default Settings.FLEET_WORKERS)
+        stacks are created at once. A failed stack does not stop the others.
+        Returns per stack name, status, outputs, error and seconds in the
+        order of specs.
+        """
+        specs = [dict(defaults, **x) for x in specs]
+        names = [x["name"] for x in specs]
+        if len(set(names)) != len(names):
+            raise ValueError("Stack names of a fleet must be unique")
+        progress = FleetProgress(names)
+        max_workers = max_workers or get_settings().FLEET_WORKERS
+        jobs = [(x, progress) for x in specs]
+        ret = {
+            x["name"]: x for x in fan_out(self._launch, jobs, max_workers=max_workers)
+        }
+        self.cache.invalidate(self._cache_key())
+        log.info(f"Fleet {progress.summary()}")
+        return [ret[x] for x in names]
+
+    @staticmethod
+    def _give_up(status, events, capacity, race):
+        """Status and reason of a candidate that is not the winner"""
+        if capacity:
+            return {"status": "CAPACITY", "reason": capacity[0]["reason"]}
+        if race["winner"] is not None:
+            return {"status": "CANCELLED", "reason": f"{race['winner']} won"}
+        failed = [x for x in events if x["status"].endswith("_FAILED")]
+        return {"status": "FAILED", "reason": failed[0]["reason"] if failed else status}
+
+    @staticmethod
+    def _win(race, name):
+        """Make name the winner of race unless another one won before"""
+        with race["lock"]:
+            if race["winner"] is None:
+                race["winner"] = name
+        return race["winner"] == name
+
+    def _roll_back(self, stack_id, attempt):
+        """Delete the stack of a given up attempt without waiting for it"""
+        where = f"{attempt['name']} in {attempt['region']}"
+        # the delete goes on in the background, the next candidate starts now
+        log.info(f"Rolling back {where}: {attempt['status']}")
+        try:
+            self.cf.delete_stack(StackName=stack_id)
+        except Exception as ex:
+            log.error(f"Stack {where} not deleted: {ex}")
+        self.cache.invalidate(self._cache_key())
+
+    def _attempt(self, spec, race):
+        """Create the stack of a launch candidate, see launch"""
+        spec = dict(spec)
+        mgr = StackManager(spec.pop("region", None))
+        name = spec["name"]
+        ret = {
+            "name": name,
+            "region": mgr.cf.meta.region_name,
+            "inst": spec.get("inst"),
+            "subnet": spec.get("subnet"),
+            "status": "SKIPPED",
+            "reason": None,
+            "outputs": {},
+        }
+        if race["winner"] is not None:
+            return ret
+        started = time.monotonic()
+        capacity = []
+
+        def on_event(event):
+            self._log_event(
+                dict(event, resource=f"{ret['region']}/{event['resource']}")
+            )
+            if is_capacity_failure(event):
+                capacity.append(event)
+
+        try:
+            stack_id = mgr._start_create(**spec)
+        except Exception as ex:
+            log.error(f"Candidate {name} in {ret['region']} failed: {ex}")
+            ret.update(status="FAILED", reason=str(ex))
+            return ret
+        try:
+            status, events = mgr._follow(
+                stack_id,
+                on_event=on_event,
+                # give up at the first capacity failure or if another won
+                stop=lambda: bool(capacity) or race["winner"] is not None,
+            )
+        except Exception as ex:
+            # the stack exists, it is rolled back below
+            log.error(f"Candidate {name} in {ret['region']} failed: {ex}")
+            ret.update(status="FAILED", reason=str(ex))
+        else:
+            ret["seconds"] = round(time.monotonic() - started, 1)
+            if status == "CREATE_COMPLETE" and self._win(race, name):
+                ret["status"] = status
+                ret["outputs"] = {
+                    x["OutputKey"].lower(): x["OutputValue"]
+                    for x in mgr._outputs(stack_id)
+                }
+                return ret
+            ret.update(self._give_up(status, events, capacity, race))
+        mgr._roll_back(stack_id, ret)
+        return ret
+
+    def launch(self, name, candidates, race=1, **defaults):
+        """Create stack name from the first candidate with capacity
+
+        candidates is an ordered list of dicts of create arguments and
+        region, e.g. ranked by place, overriding defaults. A candidate is
+        given up at the first capacity failure (see CAPACITY_ERRORS) and
+        rolled back while the next one starts. race > 1 creates the top race
+        candidates at once, the first one created wins and the others are
+        rolled back. The stack of a later candidate in an already used
+        region is name-<index>.
+
+        Returns the winning attempt (or None) and all attempts in candidate
+        order.
+        """
+        specs = []
+        used = set()
+        for i, candidate in enumerate(candidates):
+            spec = dict(defaults, **candidate)
+            region = spec.get("region") or self.cf.meta.region_name
+            spec["region"] = region
+            spec["name"] = name if region not in used else f"{name}-{i}"
+            used.add(region)
+            specs.append(spec)
+        state = {"winner": None, "lock": threading.Lock()}
+        results = fan_out(
+            lambda x: self._attempt(x, state),
+            specs,
+            method="serial" if race <= 1 else "future-thread",
+            max_workers=race,
+        )
+        order = {(x["region"], x["name"]): i for i, x in enumerate(specs)}
+        attempts = sorted(results, key=lambda x: order[(x["region"], x["name"])])
+        winner = [x for x in attempts if x["status"] == "CREATE_COMPLETE"]
+        return {"winner": winner[0] if winner else None, "attempts": attempts}
+
+    def _cache_key(self):
+        return [aws.account(), self.cf.meta.region_name]
+
+    def _describe_stacks(self):
+        paginator = self.cf.get_paginator("describe_stacks")
+        return [x for page in paginator.paginate() for x in page["Stacks"]]
+
     @boto_exception
     def list(self):
-        resp = self.cf.describe_stacks()
-        return resp
+        """Stacks of the region with their outputs, cached in the stacks namespace"""
+        return self.cache.get_or_set(self._cache_key(), self._describe_stacks)
+
+    @staticmethod
+    def _is_managed(stack, prefix):
+        tags = {x["Key"] for x in stack.get("Tags", [])}
+        return prefix in tags or stack["StackName"].startswith(prefix)
+
+    @staticmethod
+    def _region_stacks(region):
+        try:
+            return region, StackManager(region).list() or []
+        except AwsError as ex:
+            # one region e.g. without access must not hide the others
+            log.error(f"Stacks of {region} not listed: {ex}")
+            return region, []
 
+    def inventory(
+        self, regions=None, all_stacks=False, method="future-thread", max_workers=None
+    ):
+        """Stacks of all enabled (or the given) regions as DataFrame
+
+        The regions are swept concurrently. Only stacks of tchotcho, tagged
+        with or named by Settings.PREFIX, are returned unless all_stacks.
+        age_hours is the time since the last update or the creation.
+        """
+        regions = regions or self.regions.enabled_regions()
+        prefix = get_settings().PREFIX
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rows = []
+        for region, stacks in fan_out(
+            self._region_stacks, regions, method, max_workers
+        ):
+            for x in stacks:
+                if not all_stacks and not self._is_managed(x, prefix):
+                    continue
+                updated = x.get("LastUpdatedTime") or x["CreationTime"]
+                rows.append(
+                    {
+                        "region": region,
+                        "name": x["StackName"],
+                        "status": x["StackStatus"],
+                        "reason": x.get("StackStatusReason"),
+                        "created": x["CreationTime"],
+                        "age_hours": round((now - updated).total_seconds() / 3600, 1),
+                        "id": x["StackId"],
+                    }
+                )
+        df = pd.DataFrame(rows, columns=INVENTORY_COLUMNS)
+        return df.sort_values(["region", "name"], ignore_index=True)
 
-mgr = StackManager()
+    def stale(self, regions=None, older_than=None, failed=True):
+        """Inventory of the stacks gc deletes
+
+        Stale are stacks in GC_STATUSES if failed and stacks not updated for
+        older_than hours.
+        """
+        df = self.inventory(regions)
+        stale = pd.Series(False, index=df.index)
+        if failed:
+            stale |= df["status"].isin(GC_STATUSES)
+        if older_than is not None:
+            stale |= df["age_hours"] >= older_than
+        stale &= ~df["status"].isin(["DELETE_IN_PROGRESS", "DELETE_COMPLETE"])
+        return df[stale].reset_index(drop=True)
+
+    @staticmethod
+    def _start_delete(row):
+        """Delete the stack of an inventory row, returns (id, its events)
+
+        The events are marked before the delete, later ones are of it.
+        """
+        events = StackEvents(StackManager(row["region"]).cf, row["id"])
+        events.mark()
+        events.cf.delete_stack(StackName=row["id"])
+        return row["id"], events
+
+    @staticmethod
+    def _delete_failed(events):
+        """True if the stack itself failed to delete since the mark"""
+        return any(
+            x["ResourceType"] == STACK_TYPE
+            and x["LogicalResourceId"] == x["StackName"]
+            and x["ResourceStatus"] == "DELETE_FAILED"
+            for x in events.new_events()
+        )
+
+    def _wait_deleted(self, rows, deletes, timeout=GC_TIMEOUT):
+        """One waiter for the deletes of many stacks, returns {id: status}
+
+        deletes are the marked events by stack id of _start_delete. A stack
+        that was DELETE_FAILED before is only done once its new delete was
+        seen in progress or failing. Stacks not done after timeout seconds
+        keep their last status.
+        """
+        labels = {x["id"]: f"{x['region']}/{x['name']}" for x in rows}
+        progress = FleetProgress(labels.values(), title="Gc")
+        pending = dict(deletes)
+        started = set()
+        ret = {}
+        interval = MIN_INTERVAL
+        deadline = time.monotonic() + timeout
+        while True:
+            for stack_id, events in tuple(pending.items()):
+                # deleted stacks are still found by id
+                resp = events.cf.describe_stacks(StackName=stack_id)
+                status = resp["Stacks"][0]["StackStatus"]
+                progress.set(labels[stack_id], status)
+                ret[stack_id] = status
+                if status == "DELETE_IN_PROGRESS" or (
+                    status == "DELETE_FAILED"
+                    and stack_id not in started
+                    and self._delete_failed(events)
+                ):
+                    started.add(stack_id)
+                if status == "DELETE_COMPLETE" or (
+                    status == "DELETE_FAILED" and stack_id in started
+                ):
+                    del pending[stack_id]
+            if not pending:
+                return ret
+            if time.monotonic() >= deadline:
+                log.warning(
+                    f"Gave up waiting for {len(pending)} deletes after {timeout}s"
+                )
+                return ret
+            time.sleep(interval)
+            interval = min(DEFAULT_MAX_INTERVAL, interval * 1.5)
+
+    def gc(self, stale, max_workers=None, timeout=GC_TIMEOUT):
+        """Delete the stacks of a stale inventory concurrently and wait for all
+
+        Returns stale with the final status of every stack, the last one of
+        stacks still deleting after timeout seconds.
+        """
+        rows = stale.to_dict("records")
+        if not rows:
+            return stale
+        max_workers = max_workers or get_settings().FLEET_WORKERS
+        deletes = dict(fan_out(self._start_delete, rows, max_workers=max_workers))
+        for stack_id in deletes:
+            log.info(f"Deleting {stack_id}")
+        status = self._wait_deleted(rows, deletes, timeout)
+        for region in {x["region"] for x in rows}:
+            mgr = StackManager(region)
+            mgr.cache.invalidate(mgr._cache_key())
+        return stale.assign(status=[status[x["id"]] for x in rows])
+
+
+mgr = None
 
 
 @click.group()
 def stack():
-    ...
+    global mgr
+    mgr = StackManager()
 
 
 @stack.command()
@@ -136,18 +966,230 @@ def stack():
     default="ami-062a3145bcf312c71",
     show_default=True,
 )
-@click.option("--inst", required=True, help="Name of the instance to use")
+@click.option(
+    "--inst",
+    required=True,
+    multiple=True,
+    help="Name of the instance to use, repeat to rank several for an EC2 Fleet",
+)
 @click.option("--security_group", help="Name of the security group to use")
-@click.option("--subnet", help="Name of the subnet to use")
+@click.option(
+    "--subnet",
+    multiple=True,
+    help="Name of the subnet to use, repeat to spread an EC2 Fleet",
+)
 @click.option("--price", type=float, help="Name of the instance to use")
 @click.option("--size", type=int, help="Size of the disk in GB", default=120)
 @click.option("--dry/--no-dry", help="Only print yaml no create", default=False)
-def create(name, ami, inst, security_group, subnet, price, size, dry):
-    ret = mgr.create(name, ami, inst, security_group, subnet, price, size, dry)
+@click.option(
+    "--allocation",
+    type=click.Choice(ALLOCATION_STRATEGIES),
+    help="Launch by an EC2 Fleet with this spot allocation strategy",
+)
+@click.option(
+    "--offline/--online",
+    default=False,
+    help="Validate a dry run with cfn-lint, without calling AWS",
+)
+@click.option("--vpc", help="VPC of the security group, default the default VPC")
+@click.option("--requirements", type=click.File(), help="pip requirements to install")
+@click.option(
+    "--baked/--no-baked",
+    default=True,
+    show_default=True,
+    help="Start from the baked AMI of ami and requirements if there is one",
+)
+def create(
+    name,
+    ami,
+    inst,
+    security_group,
+    subnet,
+    price,
+    size,
+    dry,
+    allocation,
+    offline,
+    vpc,
+    requirements,
+    baked,
+):
+    requirements = requirements.read() if requirements else ""
+    ret = mgr.create(
+        name,
+        ami,
+        inst,
+        security_group,
+        subnet or None,
+        price,
+        size,
+        dry,
+        requirements=requirements,
+        baked=baked,
+        allocation=allocation,
+        vpc=vpc,
+        offline=offline,
+    )
     ret = click.echo(ret)
     click.echo(ret)
 
 
+@stack.command()
+@click.option(
+    "--config",
+    type=click.File(),
+    required=True,
+    help="json list of stacks, every entry has a name and overrides the options",
+)
+@click.option("--ami", default="ami-062a3145bcf312c71", show_default=True)
+@click.option("--inst", help="Name of the instance to use")
+@click.option("--security_group", help="Name of the security group to use")
+@click.option("--subnet", help="Name of the subnet to use")
+@click.option("--price", type=float, help="Max spot price")
+@click.option("--size", type=int, help="Size of the disk in GB", default=120)
+@click.option(
+    "--key", "key_name", help="Key pair of all stacks, default the stack name"
+)
+@click.option("--max-workers", type=int, help="Stacks created at once")
+@click.option("--csv/--no-csv", default=False)
+def fleet(config, max_workers, csv, **defaults):
+    """Create one stack per config entry concurrently e.g. for a sweep"""
+    specs = json.load(config)
+    defaults = {k: v for k, v in defaults.items() if v is not None}
+    ret = mgr.create_fleet(specs, max_workers, **defaults)
+    df = pd.DataFrame(ret)[["name", "status", "seconds", "error", "outputs"]]
+    to_print = df.to_csv(index=False)
+    if not csv:
+        to_print = tabulate.tabulate(
+            df, headers="keys", tablefmt="fancy_grid", showindex="never"
+        )
+    print(to_print)
+    if any(x["status"] != "CREATE_COMPLETE" for x in ret):
+        raise click.ClickException("Not all stacks of the fleet were created")
+
+
+@stack.command()
+@click.option("--name", required=True, help="Name of stack to create")
+@click.option(
+    "--candidates",
+    type=click.File(),
+    required=True,
+    help="ranked json list of candidates, every entry has a region and overrides "
+    "the options e.g. inst, ami, subnet",
+)
+@click.option("--ami", default="ami-062a3145bcf312c71", show_default=True)
+@click.option("--inst", help="Name of the instance to use")
+@click.option("--security_group", help="Name of the security group to use")
+@click.option("--price", type=float, help="Max spot price")
+@click.option("--size", type=int, help="Size of the disk in GB", default=120)
+@click.option("--key", "key_name", help="Key pair in every region, default the name")
+@click.option(
+    "--race",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Candidates created at once, the first one created wins",
+)
+@click.option("--csv/--no-csv", default=False)
+def launch(name, candidates, race, csv, **defaults):
+    """Create a stack from the first candidate with capacity"""
+    candidates = json.load(candidates)
+    defaults = {k: v for k, v in defaults.items() if v is not None}
+    ret = mgr.launch(name, candidates, race, **defaults)
+    df = pd.DataFrame(ret["attempts"])
+    df = df[["name", "region", "inst", "subnet", "status", "reason"]]
+    to_print = df.to_csv(index=False)
+    if not csv:
+        to_print = tabulate.tabulate(
+            df, headers="keys", tablefmt="fancy_grid", showindex="never"
+        )
+    print(to_print)
+    if ret["winner"] is None:
+        raise click.ClickException("No candidate had capacity")
+    click.echo(json.dumps(ret["winner"]["outputs"]))
+
+
+@stack.command()
+@click.option("--ami", default="ami-062a3145bcf312c71", show_default=True)
+@click.option("--inst", required=True, help="Name of the instance to bake on")
+@click.option("--requirements", type=click.File(), help="pip requirements to install")
+@click.option("--name", help="Name of the bake stack")
+@click.option("--security_group", help="Name of the security group to use")
+@click.option("--subnet", help="Name of the subnet to use")
+@click.option("--price", type=float, help="Max spot price")
+@click.option("--size", type=int, help="Size of the disk in GB", default=120)
+@click.option("--key", "key_name", help="Key pair, default the stack name")
+@click.option("--force/--no-force", default=False, help="Bake again if already baked")
+def bake(requirements, **kwargs):
+    """Bake the bootstrap and requirements into an AMI for faster starts"""
+    requirements = requirements.read() if requirements else ""
+    try:
+        ret = mgr.bake(requirements=requirements, **kwargs)
+    except (ValueError, TimeoutError) as ex:
+        raise click.ClickException(str(ex))
+    click.echo(ret["ami"])
+
+
+@stack.command()
+@click.option("--csv/--no-csv", default=False)
+def baked(csv):
+    """List the baked AMIs"""
+    ret = mgr.baked.all()
+    if not ret:
+        click.echo("No baked images found!")
+        return
+    df = pd.DataFrame(ret)[["ami", "base_ami", "region", "created", "key"]]
+    to_print = df.to_csv(index=False)
+    if not csv:
+        to_print = tabulate.tabulate(
+            df, headers="keys", tablefmt="fancy_grid", showindex="never"
+        )
+    print(to_print)
+
+
+@stack.command()
+@click.option("--name", required=True, help="Name of stack to update")
+@click.option("--ami", help="Name of ami to use")
+@click.option(
+    "--inst",
+    multiple=True,
+    help="Name of the instance to use, repeat to rank several for an EC2 Fleet",
+)
+@click.option("--security_group", help="Name of the security group to use")
+@click.option("--subnet", multiple=True, help="Name of the subnet to use")
+@click.option("--price", type=float, help="Max spot price")
+@click.option("--size", type=int, help="Size of the disk in GB")
+@click.option("--dry/--no-dry", help="Only show the changes", default=False)
+def update(name, inst, subnet, dry, **changes):
+    """Change e.g. the instance type of a stack in place by a change set"""
+    changes["inst"] = inst or None
+    changes["subnet"] = subnet or None
+    try:
+        mgr.update(name, dry, **changes)
+    except (ValueError, TimeoutError) as ex:
+        raise click.ClickException(str(ex))
+
+
+@stack.command()
+@click.option("--name", required=True, help="Name of stack to stop")
+def stop(name):
+    """Stop the instance of an on demand stack, keeps its disk"""
+    try:
+        mgr.stop(name)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+
+
+@stack.command()
+@click.option("--name", required=True, help="Name of stack to start")
+def start(name):
+    """Start the stopped instance of a stack again"""
+    try:
+        mgr.start(name)
+    except ValueError as ex:
+        raise click.ClickException(str(ex))
+
+
 @stack.command()
 @click.option("--name", required=True, help="Name of stack to delete")
 def delete(name):
@@ -159,13 +1201,10 @@ def delete(name):
 @click.option("--csv/--no-csv", default=False)
 def list(name, csv):
     ret = mgr.list()
-    stacks = ret.get("Stacks")
-    if not stacks:
+    if not ret:
         click.echo("No stacks found!")
         return
 
-    ret = ret["Stacks"]
-
     def set_color(val):
         if val == name:
             val = colorama.Back.GREEN + val + colorama.Back.RESET
@@ -182,3 +1221,60 @@ def list(name, csv):
             df, headers="keys", tablefmt="fancy_grid", showindex="never"
         )
     print(to_print)
+
+
+def _print_inventory(df, csv):
+    to_print = df.to_csv(index=False)
+    if not csv:
+        to_print = tabulate.tabulate(
+            df, headers="keys", tablefmt="fancy_grid", showindex="never"
+        )
+    print(to_print)
+
+
+@stack.command()
+@click.option("--region", multiple=True, help="Region to sweep, default all enabled")
+@click.option(
+    "--all/--managed",
+    "all_stacks",
+    default=False,
+    help="Also list stacks not created by tchotcho",
+)
+@click.option("--csv/--no-csv", default=False)
+def inventory(region, all_stacks, csv):
+    """List the stacks of all regions"""
+    df = mgr.inventory(region or None, all_stacks)
+    if df.empty:
+        click.echo("No stacks found!")
+        return
+    _print_inventory(df, csv)
+
+
+@stack.command()
+@click.option("--region", multiple=True, help="Region to sweep, default all enabled")
+@click.option("--older-than", type=float, help="Also delete stacks older than hours")
+@click.option(
+    "--failed/--no-failed",
+    default=True,
+    show_default=True,
+    help="Delete failed and rolled back stacks",
+)
+@click.option("--dry/--no-dry", default=False, help="Only list the stale stacks")
+@click.option("--yes", is_flag=True, help="Do not ask before deleting")
+@click.option("--max-workers", type=int, help="Stacks deleted at once")
+@click.option("--csv/--no-csv", default=False)
+def gc(region, older_than, failed, dry, yes, max_workers, csv):
+    """Delete stale tchotcho stacks of all regions"""
+    df = mgr.stale(region or None, older_than, failed)
+    if df.empty:
+        click.echo("No stale stacks found!")
+        return
+    _print_inventory(df, csv)
+    if dry:
+        return
+    if not yes:
+        click.confirm(f"Delete {len(df)} stacks?", abort=True)
+    ret = mgr.gc(df, max_workers)
+    _print_inventory(ret[["region", "name", "status"]], csv)
+    if (ret["status"] != "DELETE_COMPLETE").any():
+        raise click.ClickException("Not all stale stacks were deleted")
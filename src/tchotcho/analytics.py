@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+
+# every product e.g. Linux/UNIX and Linux/UNIX (Amazon VPC) is its own series
+KEYS = ["region", "instance_type", "az", "product"]
+
+
+def _durations(ts, group, end):
+    """Seconds every price is in effect, the last one of a group until end"""
+    nxt = np.append(ts[1:], end)
+    last = np.append(group[1:] != group[:-1], True)
+    nxt = np.where(last, end, nxt)
+    return np.maximum(nxt - ts, 0).astype(float)
+
+
+def _weighted(values, weights, group, size):
+    total = np.bincount(group, weights=weights, minlength=size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.bincount(group, weights=values * weights, minlength=size) / total
+
+
+def _ondemand_for(df, ondemand):
+    """On demand price of every point from an (instance x region) matrix"""
+    if ondemand is None:
+        return np.full(len(df), np.nan)
+    lookup = ondemand.stack()
+    idx = pd.MultiIndex.from_arrays(
+        [df["instance_type"].astype(str), df["region"].astype(str)]
+    )
+    return lookup.reindex(idx).to_numpy(dtype=float)
+
+
+def _rolling(df, ts, group, size, window):
+    """Rolling mean/min/max over window evaluated at the last point per group
+
+    Only the points in (last - window, last] of a group are in the window at
+    its last point, so they are selected with one mask instead of rolling.
+    """
+    window = pd.Timedelta(window) // pd.Timedelta(seconds=1)
+    last = np.full(size, np.iinfo(ts.dtype).min)
+    np.maximum.at(last, group, ts)
+    inside = ts > last[group] - window
+    grouped = df.loc[inside, ["_group", "price"]].groupby("_group", sort=True)
+    ret = grouped["price"].agg(["mean", "min", "max"])
+    return ret.add_prefix("rolling_")
+
+
+def spot_stats(history, ondemand=None, window="1D", ratio=0.5, end=None):
+    """Price statistics per (region, instance type, az, product) of a spot history
+
+    history is a frame of SpotHistoryStore.query. Prices are step functions,
+    every point is weighted by the time it was in effect (the last one until
+    end, default now). ondemand is an (instance type x region) price matrix,
+    above_ratio is the share of time the spot price was above ratio times
+    the on demand price. volatility is the time weighted coefficient of
+    variation and stability = (1 - above_ratio) / (1 + volatility).
+    """
+    if history.empty:
+        return pd.DataFrame()
+    df = history.sort_values(KEYS + ["ts"]).reset_index(drop=True)
+    df["_group"] = df.groupby(KEYS, observed=True, sort=True).ngroup()
+    group = df["_group"].to_numpy()
+    size = group.max() + 1
+    ts = ((df["ts"] - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).to_numpy()
+    end = pd.Timestamp.now(tz="UTC") if end is None else pd.Timestamp(end)
+    duration = _durations(ts, group, end.timestamp())
+    price = df["price"].to_numpy(dtype=float)
+
+    mean = _weighted(price, duration, group, size)
+    var = _weighted((price - mean[group]) ** 2, duration, group, size)
+    ondemand = _ondemand_for(df, ondemand)
+    above = (price > ratio * ondemand).astype(float)
+    above = _weighted(np.where(np.isnan(ondemand), np.nan, above), duration, group, size)
+
+    grouped = df.groupby("_group", sort=True)
+    ret = grouped[KEYS].first()
+    ret["points"] = grouped.size()
+    ret["last"] = grouped["price"].last()
+    ret["mean"] = mean
+    ret["min"] = grouped["price"].min()
+    ret["max"] = grouped["price"].max()
+    ret = ret.join(_rolling(df, ts, group, size, window))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ret["volatility"] = np.sqrt(var) / mean
+    ret["above_ratio"] = above
+    ret["stability"] = (1 - np.nan_to_num(above)) / (1 + ret["volatility"])
+    return ret.sort_values("stability", ascending=False).reset_index(drop=True)
@@ -0,0 +1,385 @@
+import random
+import threading
+import time
+
+import boto3.session
+import botocore.config
+import botocore.exceptions
+
+from tchotcho.config import get_settings
+from tchotcho.errors import (
+    AuthError,
+    RequestError,
+    ThrottledError,
+    TransientError,
+)
+from tchotcho.log import log
+
+THROTTLING_CODES = {
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "SlowDown",
+}
+TRANSIENT_CODES = {
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "InternalError",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "Unavailable",
+}
+AUTH_CODES = {
+    "AuthFailure",
+    "AccessDenied",
+    "AccessDeniedException",
+    "UnauthorizedOperation",
+    "ExpiredToken",
+    "ExpiredTokenException",
+    "InvalidClientTokenId",
+    "UnrecognizedClientException",
+    "SignatureDoesNotMatch",
+}
+TRANSIENT_EXCEPTIONS = (
+    botocore.exceptions.EndpointConnectionError,
+    botocore.exceptions.ConnectionClosedError,
+    botocore.exceptions.ReadTimeoutError,
+    botocore.exceptions.ConnectTimeoutError,
+)
+AUTH_EXCEPTIONS = (
+    botocore.exceptions.NoCredentialsError,
+    botocore.exceptions.PartialCredentialsError,
+)
+
+
+def error_code(ex):
+    if isinstance(ex, botocore.exceptions.ClientError):
+        return ex.response.get("Error", {}).get("Code")
+    return type(ex).__name__
+
+
+def is_retryable(ex):
+    if isinstance(ex, TRANSIENT_EXCEPTIONS):
+        return True
+    if not isinstance(ex, botocore.exceptions.ClientError):
+        return False
+    code = error_code(ex)
+    status = ex.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+    return code in THROTTLING_CODES or code in TRANSIENT_CODES or status >= 500
+
+
+def typed_error(ex, operation=None, region=None):
+    """Returns the AwsError of a botocore exception"""
+    code = error_code(ex)
+    response = None
+    if isinstance(ex, botocore.exceptions.ClientError):
+        message = ex.response.get("Error", {}).get("Message", str(ex))
+        response = ex.response
+    else:
+        message = str(ex)
+    if code in THROTTLING_CODES:
+        cls = ThrottledError
+    elif is_retryable(ex):
+        cls = TransientError
+    elif code in AUTH_CODES or isinstance(ex, AUTH_EXCEPTIONS):
+        cls = AuthError
+    else:
+        cls = RequestError
+    return cls(
+        f"{operation} in {region}: {code}: {message}", code, operation, region, response
+    )
+
+
+class TokenBucket(object):
+    """Thread safe token bucket with an adaptive rate
+
+    A throttled call halves the rate (down to rate / 16), every success adds
+    rate / 16 back up to the configured rate.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 16
+        self.rate = self.max_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take a token, blocks until there is one. Returns the wait time"""
+        with self._lock:
+            self._refill()
+            # the token is reserved, waiting happens outside the lock
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def throttled(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 16)
+
+
+class CallPolicy(object):
+    """Rate limit, concurrency cap and retries of every AWS call
+
+    Every (service, region) has its own token bucket and semaphore shared by
+    all clients instrumented with the policy. Retryable errors are retried
+    with jittered exponential backoff, everything else and retryable errors
+    after the last attempt are raised as tchotcho.errors.AwsError, a
+    ClientError so the error acceptors of waiters keep working.
+    """
+
+    def __init__(
+        self,
+        rate=None,
+        burst=None,
+        max_concurrency=None,
+        max_attempts=None,
+        backoff_base=None,
+        backoff_max=None,
+        sleep=time.sleep,
+    ):
+        settings = get_settings()
+        self.rate = settings.AWS_RATE if rate is None else rate
+        self.burst = settings.AWS_BURST if burst is None else burst
+        self.max_concurrency = (
+            settings.AWS_MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        )
+        self.max_attempts = (
+            settings.AWS_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        )
+        self.backoff_base = (
+            settings.AWS_BACKOFF_BASE if backoff_base is None else backoff_base
+        )
+        self.backoff_max = settings.AWS_BACKOFF_MAX if backoff_max is None else backoff_max
+        self.sleep = sleep
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    def limits(self, service, region):
+        """Returns the (token bucket, semaphore) of service in region"""
+        with self._lock:
+            key = (service, region)
+            if key not in self._limits:
+                self._limits[key] = (
+                    TokenBucket(self.rate, self.burst, sleep=self.sleep),
+                    threading.BoundedSemaphore(self.max_concurrency),
+                )
+            return self._limits[key]
+
+    def backoff(self, attempt):
+        """Full jitter delay before retry attempt + 1"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, service, region, operation, fn, *args, **kwargs):
+        bucket, semaphore = self.limits(service, region)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            with semaphore:
+                try:
+                    ret = fn(*args, **kwargs)
+                except (
+                    botocore.exceptions.ClientError,
+                    botocore.exceptions.BotoCoreError,
+                ) as ex:
+                    error = ex
+                else:
+                    bucket.succeeded()
+                    return ret
+            attempt += 1
+            if not is_retryable(error) or attempt >= self.max_attempts:
+                raise typed_error(error, operation, region) from error
+            if error_code(error) in THROTTLING_CODES:
+                bucket.throttled()
+            delay = self.backoff(attempt)
+            log.debug(
+                f"{operation} in {region} failed with {error_code(error)}, "
+                f"retry {attempt} in {delay:.2f}s"
+            )
+            self.sleep(delay)
+
+    def instrument(self, client):
+        """Route every call of client, also of its paginators and waiters,
+        through the policy
+        """
+        service = client.meta.service_model.service_name
+        region = client.meta.region_name
+        make_api_call = client._make_api_call
+
+        def wrapper(operation_name, api_params):
+            return self.call(
+                service, region, operation_name, make_api_call, operation_name, api_params
+            )
+
+        client._make_api_call = wrapper
+        return client
+
+
+def _connections(client):
+    # new connections opened by the urllib3 pools of the client
+    try:
+        pools = client._endpoint.http_session._manager.pools
+        return sum(pools[x].num_connections for x in pools.keys())
+    except AttributeError:
+        return 0
+
+
+class ClientPool(object):
+    """Thread safe registry of boto3 clients by (service, region)
+
+    Clients are created lazily from one shared session and reused by every
+    manager. All calls go through policy, max_pool_connections (default
+    Settings.AWS_MAX_POOL_CONNECTIONS) is the urllib3 pool size per client.
+    """
+
+    def __init__(self, policy=None, max_pool_connections=None, session=None):
+        settings = get_settings()
+        self.policy = policy
+        self.max_pool_connections = (
+            settings.AWS_MAX_POOL_CONNECTIONS
+            if max_pool_connections is None
+            else max_pool_connections
+        )
+        self.session = session
+        self.config = botocore.config.Config(
+            # retries are done by CallPolicy, botocore only tries once
+            retries={"total_max_attempts": 1, "mode": "standard"},
+            max_pool_connections=self.max_pool_connections,
+        )
+        self._clients = {}
+        self._hits = 0
+        self._account = None
+        self._lock = threading.Lock()
+
+    def _session(self):
+        if self.session is None:
+            self.session = boto3.session.Session()
+        return self.session
+
+    def region(self):
+        with self._lock:
+            return self._session().region_name
+
+    def account(self):
+        """Account id of the session credentials, asked STS once"""
+        with self._lock:
+            if self._account is not None:
+                return self._account
+        # client takes the lock itself
+        account = self.client("sts").get_caller_identity()["Account"]
+        with self._lock:
+            self._account = account
+        return account
+
+    def client(self, service, region=None):
+        key = (service, region)
+        # creating clients from a session is not thread safe
+        with self._lock:
+            if key in self._clients:
+                self._hits += 1
+                return self._clients[key]
+            ret = self._session().client(service, region_name=region, config=self.config)
+            self._clients[key] = (self.policy or get_policy()).instrument(ret)
+            return ret
+
+    def stats(self):
+        """Returns the number of clients created, reused and connections opened"""
+        with self._lock:
+            clients = dict(self._clients)
+            hits = self._hits
+        per_client = {
+            f"{k[0]}:{k[1] or 'default'}": _connections(v) for k, v in clients.items()
+        }
+        return {
+            "clients": len(clients),
+            "reused": hits,
+            "connections": sum(per_client.values()),
+            "per_client": per_client,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+            self._hits = 0
+            self._account = None
+            self.session = None
+
+
+_POLICY = None
+_POOL = None
+_POLICY_LOCK = threading.Lock()
+
+
+def get_policy():
+    global _POLICY
+    with _POLICY_LOCK:
+        if _POLICY is None:
+            _POLICY = CallPolicy()
+        return _POLICY
+
+
+def set_policy(policy):
+    global _POLICY
+    with _POLICY_LOCK:
+        _POLICY = policy
+    return policy
+
+
+def get_pool():
+    global _POOL
+    with _POLICY_LOCK:
+        if _POOL is None:
+            _POOL = ClientPool()
+        return _POOL
+
+
+def set_pool(pool):
+    global _POOL
+    with _POLICY_LOCK:
+        _POOL = pool
+    return pool
+
+
+def client(service, region=None):
+    """Returns the pooled boto3 client of service in region
+
+    Its calls go through the shared CallPolicy, region None is the default
+    region of the session.
+    """
+    return get_pool().client(service, region)
+
+
+def default_region():
+    """Configured region of the pooled session or None, without a client"""
+    return get_pool().region()
+
+
+def account():
+    """Account id of the pooled session, part of account specific cache keys
+
+    The profile name is no key, environment credentials of any account have
+    none.
+    """
+    return get_pool().account()
@@ -0,0 +1,64 @@
+import hashlib
+import json
+
+from tchotcho.cache import atomic_write, locked
+
+REQUIREMENTS_SCRIPT = """
+cat > /tmp/tchotcho-requirements.txt << 'TCHOTCHO_REQUIREMENTS'
+{requirements}
+TCHOTCHO_REQUIREMENTS
+pip install -r /tmp/tchotcho-requirements.txt
+"""
+
+
+def bake_key(ami, user_script, requirements=""):
+    """Hash of everything a baked image is built from"""
+    data = json.dumps([ami, user_script, requirements or ""])
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def requirements_script(requirements):
+    """Shell lines installing the pip requirements text, empty without"""
+    if not requirements or not requirements.strip():
+        return ""
+    return REQUIREMENTS_SCRIPT.format(requirements=requirements.strip())
+
+
+class BakedImages(object):
+    """Local catalog of baked AMIs by bake key in a json file
+
+    A baked AMI is a base AMI with the bootstrap of the user script and the
+    project requirements already installed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _load(self):
+        if not self.path.exists():
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def all(self):
+        return list(self._load().values())
+
+    def get(self, key, region):
+        ret = self._load().get(key)
+        if ret is None or ret["region"] != region:
+            return None
+        return ret
+
+    def _update(self, fn):
+        # read, modify and write under the lock, concurrent bakes keep both
+        with locked(self.path):
+            data = self._load()
+            fn(data)
+            atomic_write(self.path, json.dumps(data, indent=4))
+
+    def add(self, record):
+        self._update(lambda data: data.__setitem__(record["key"], record))
+        return record
+
+    def remove(self, key):
+        self._update(lambda data: data.pop(key, None))
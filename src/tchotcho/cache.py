@@ -0,0 +1,210 @@
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import threading
+import time
+
+from tchotcho.config import get_settings
+from tchotcho.log import log
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # no cross process locking e.g. on windows
+    fcntl = None
+
+CACHE_DIR = "cache"
+DEFAULT_TTL = 60 * 60
+# lock files of get_or_set per namespace, keys share them by digest prefix
+LOCK_DIR = ".locks"
+LOCK_STRIPES = 256
+# writes between two scans of the cache size, also counts other processes
+SCAN_EVERY = 100
+
+# estimated bytes and writes since the last scan per cache root
+_usage = {}
+_usage_lock = threading.Lock()
+
+
+def _default(value):
+    if isinstance(value, datetime.datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"{type(value).__name__} is not json serializable")
+
+
+def _object_hook(value):
+    if "__datetime__" in value:
+        return datetime.datetime.fromisoformat(value["__datetime__"])
+    return value
+
+
+@contextlib.contextmanager
+def locked(path):
+    """Exclusive cross process lock of path, held on path.lock"""
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(path.name + ".lock"), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def atomic_write(path, data, mode="w"):
+    """Write data to a temporary file next to path and rename it over path"""
+    path = pathlib.Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, mode) as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def root():
+    return get_settings().PROG_HOME / CACHE_DIR
+
+
+class Cache(object):
+    """Json values by key in PROG_HOME/cache/<namespace>
+
+    Every key is one file, written atomically. Values expire after the ttl
+    of the namespace (Settings.CACHE_TTL), all namespaces together are
+    bounded to Settings.CACHE_MAX_BYTES by evicting the least recently used
+    entries. The cache is only scanned for that when the estimated size
+    crosses the bound and every SCAN_EVERY writes. Settings.CACHE_ENABLED
+    False bypasses reading the cache.
+    """
+
+    def __init__(self, namespace, ttl=None):
+        settings = get_settings()
+        self.namespace = namespace
+        self.ttl = settings.CACHE_TTL.get(namespace, DEFAULT_TTL) if ttl is None else ttl
+        self.enabled = settings.CACHE_ENABLED
+        self.max_bytes = settings.CACHE_MAX_BYTES
+        self.root = root()
+        self.path = self.root / namespace
+
+    @staticmethod
+    def _digest(key):
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def _file(self, key):
+        return self.path / f"{self._digest(key)}.json"
+
+    def _lock_file(self, key):
+        stripe = int(self._digest(key)[:8], 16) % LOCK_STRIPES
+        return self.path / LOCK_DIR / f"{stripe:02x}"
+
+    def _read(self, path):
+        if not self.enabled or not path.exists():
+            return None
+        try:
+            with open(path) as f:
+                entry = json.load(f, object_hook=_object_hook)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["time"] >= self.ttl:
+            return None
+        # the modification time is the last use for eviction
+        os.utime(path)
+        return entry
+
+    def get(self, key, default=None):
+        entry = self._read(self._file(key))
+        return default if entry is None else entry["value"]
+
+    def set(self, key, value):
+        path = self._file(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {"key": key, "time": time.time(), "value": value}
+        data = json.dumps(entry, default=_default)
+        atomic_write(path, data)
+        if self._grown(len(data)):
+            self.evict()
+        return value
+
+    def _grown(self, size):
+        """Add size to the estimate, True if the cache should be scanned
+
+        The first write and every SCAN_EVERY one scan, so do writes taking
+        the estimate above max_bytes.
+        """
+        with _usage_lock:
+            usage = _usage.get(self.root)
+            if usage is None:
+                return True
+            usage["bytes"] += size
+            usage["writes"] += 1
+            return usage["bytes"] > self.max_bytes or usage["writes"] >= SCAN_EVERY
+
+    def get_or_set(self, key, fn):
+        """Returns the cached value of key or stores the result of fn()
+
+        Concurrent callers of the same key, also of other processes, wait
+        for the first one instead of calling fn again.
+        """
+        path = self._file(key)
+        entry = self._read(path)
+        if entry is not None:
+            return entry["value"]
+        with locked(self._lock_file(key)):
+            entry = self._read(path)
+            if entry is not None:
+                return entry["value"]
+            return self.set(key, fn())
+
+    def invalidate(self, key=None):
+        """Remove key or the whole namespace"""
+        if key is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            return
+        with contextlib.suppress(FileNotFoundError):
+            self._file(key).unlink()
+
+    def evict(self):
+        """Remove the least recently used entries above max_bytes"""
+        entries = []
+        for x in self.root.glob("*/*.json"):
+            with contextlib.suppress(FileNotFoundError):
+                stat = x.stat()
+                entries.append((stat.st_mtime, stat.st_size, x))
+        # per key lock files of earlier versions
+        for x in self.root.glob("*/*.json.lock"):
+            with contextlib.suppress(FileNotFoundError):
+                x.unlink()
+        total = sum(x[1] for x in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+                log.debug(f"Evicted cache entry {path}")
+            total -= size
+        with _usage_lock:
+            _usage[self.root] = {"bytes": total, "writes": 0}
+
+
+def namespaces():
+    """Returns {namespace: (entries, bytes)} of the cache"""
+    ret = {}
+    for path in sorted(root().glob("*/")):
+        files = list(path.glob("*.json"))
+        ret[path.name] = (len(files), sum(x.stat().st_size for x in files))
+    return ret
+
+
+def invalidate(names=None):
+    """Remove the namespaces names or the whole cache"""
+    if not names:
+        shutil.rmtree(root(), ignore_errors=True)
+        with _usage_lock:
+            _usage.pop(root(), None)
+        return
+    for name in names:
+        Cache(name).invalidate()
@@ -0,0 +1,247 @@
+import json
+import os
+import pathlib
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from tchotcho import query
+from tchotcho.log import log
+
+SCHEMA_VERSION = 4
+META_FILE = "meta.json"
+
+
+def catalog_path(gpu_info_file):
+    """Directory of the columnar catalog next to the json GPU info file"""
+    return pathlib.Path(gpu_info_file).with_suffix(".cols")
+
+
+def price_frame(pricing, index=None):
+    """Dense (instance x region) on demand price matrix, NaN if not available"""
+    df = pd.DataFrame(list(pricing), index=index, dtype=float)
+    return df.reindex(columns=sorted(df.columns))
+
+
+def cheapest(prices):
+    """Returns (region, price) Series of the cheapest region per instance"""
+    arr = prices.to_numpy(dtype=float)
+    filled = np.where(np.isnan(arr), np.inf, arr)
+    if not filled.shape[1]:
+        filled = np.full((len(arr), 1), np.inf)
+    idx = filled.argmin(axis=1)
+    price = filled[np.arange(len(filled)), idx]
+    available = np.isfinite(price)
+    regions = np.array(list(prices.columns) or [None], dtype=object)
+    return (
+        pd.Series(np.where(available, regions[idx], None), index=prices.index),
+        pd.Series(np.where(available, price, np.nan), index=prices.index),
+    )
+
+
+def _encode(series):
+    """Returns (encoding, array, nulls) of a column that np.load can memory map
+
+    nulls is the mask of the None cells of a str column, else None.
+    """
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return "num", series.to_numpy(), None
+    values = series.tolist()
+    if all(x is None or isinstance(x, str) for x in values):
+        nulls = np.array([x is None for x in values], dtype=bool)
+        arr = np.array(["" if x is None else x for x in values], dtype=str)
+        return "str", arr, nulls if nulls.any() else None
+    # nested values e.g. storage are kept as json text
+    return "json", np.array([json.dumps(x) for x in values], dtype=str), None
+
+
+def write(path, data):
+    """Write update data as one .npy file per instance column
+
+    The catalog is written to a temporary directory first and swapped in
+    when complete.
+    """
+    path = pathlib.Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    df = pd.DataFrame(data["instance"])
+    # pricing is normalized into a dense matrix
+    prices = price_frame(df.pop("pricing"))
+    np.save(tmp / "price.npy", prices.to_numpy(dtype=np.float64), allow_pickle=False)
+    np.save(tmp / "regions.npy", np.array(prices.columns, dtype=str))
+
+    columns = {}
+    nulls = []
+    for name in df.columns:
+        columns[name], arr, mask = _encode(df[name])
+        np.save(tmp / f"{name}.npy", arr, allow_pickle=False)
+        if mask is not None:
+            np.save(tmp / f"null_{name}.npy", mask, allow_pickle=False)
+            nulls.append(name)
+
+    index = query.build(df)
+    for name, arr in index.items():
+        np.save(tmp / f"idx_{name}.npy", arr, allow_pickle=False)
+
+    meta = {
+        "schema_version": SCHEMA_VERSION,
+        "rows": len(df),
+        "columns": columns,
+        "nulls": nulls,
+        "index": list(index),
+        "ami": data.get("ami", []),
+        "ami_latest": data.get("ami_latest", {}),
+    }
+    with open(tmp / META_FILE, "w") as f:
+        json.dump(meta, f)
+
+    old = path.with_name(path.name + ".old")
+    if path.exists():
+        os.replace(path, old)
+    os.replace(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+    return path
+
+
+class Catalog(object):
+    """Read only view of a columnar catalog, columns are loaded on access"""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        with open(self.path / META_FILE) as f:
+            self.meta = json.load(f)
+        if self.meta.get("schema_version") != SCHEMA_VERSION:
+            raise ValueError(
+                f"Catalog schema {self.meta.get('schema_version')} is not "
+                f"{SCHEMA_VERSION}, run update again"
+            )
+        self.columns = list(self.meta["columns"])
+        self._cache = {}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def column(self, name):
+        """Returns a memory mapped column, json columns are decoded
+
+        A str column with None cells is an object array with them restored.
+        """
+        if name not in self._cache:
+            arr = np.load(self.path / f"{name}.npy", mmap_mode="r")
+            if self.meta["columns"][name] == "json":
+                arr = [json.loads(x) for x in arr]
+            elif name in self.meta["nulls"]:
+                mask = np.load(self.path / f"null_{name}.npy")
+                arr = np.where(mask, None, arr.astype(object))
+            self._cache[name] = arr
+        return self._cache[name]
+
+    def to_frame(self, columns=None):
+        columns = columns or self.columns
+        return pd.DataFrame({x: self.column(x) for x in columns})
+
+    def prices(self):
+        """Returns the memory mapped (instance x region) price matrix"""
+        if "price" not in self._cache:
+            self._cache["price"] = pd.DataFrame(
+                np.load(self.path / "price.npy", mmap_mode="r"),
+                columns=np.load(self.path / "regions.npy").tolist(),
+            )
+        return self._cache["price"]
+
+    def index(self):
+        """Returns the query index built by update, memory mapped"""
+        arrays = {
+            x: np.load(self.path / f"idx_{x}.npy", mmap_mode="r")
+            for x in self.meta["index"]
+        }
+        frame = self.to_frame([x for x in query.RESULT_COLUMNS if x in self.columns])
+        return query.InstanceIndex(arrays, frame, self.prices())
+
+    def to_dict(self, columns=None):
+        """Returns update data like the json GPU info file read by read
+
+        Unlike the json file instance is a DataFrame with only the given
+        columns (default all) and the pricing is the prices matrix.
+        """
+        return {
+            "instance": self.to_frame(columns),
+            "prices": self.prices(),
+            "ami": self.meta["ami"],
+            "ami_latest": self.meta["ami_latest"],
+        }
+
+
+def load(gpu_info_file):
+    """Returns the columnar catalog of gpu_info_file or None
+
+    The catalog is not used if it is missing, older than the json file or
+    has another schema version.
+    """
+    json_path = pathlib.Path(gpu_info_file)
+    path = catalog_path(json_path)
+    meta = path / META_FILE
+    if not meta.exists():
+        return None
+    if json_path.exists() and json_path.stat().st_mtime > meta.stat().st_mtime:
+        return None
+    try:
+        return Catalog(path)
+    except ValueError as ex:
+        log.warning(str(ex))
+        return None
+
+
+def read(gpu_info_file, columns=None):
+    """Returns update data from the columnar catalog or the json file
+
+    instance is a DataFrame of the catalog (see Catalog.to_dict) limited to
+    columns or the list of records of the json file, both are taken by
+    pd.DataFrame.
+    """
+    cat = load(gpu_info_file)
+    if cat is not None:
+        return cat.to_dict(columns)
+    with open(gpu_info_file) as f:
+        return json.load(f)
+
+
+def prices(data):
+    """Returns the price matrix of update data read from either format"""
+    if "prices" in data:
+        return data["prices"]
+    return price_frame(x["pricing"] for x in data["instance"])
+
+
+def read_prices(gpu_info_file):
+    """Returns the (instance x region) on demand price matrix indexed by name"""
+    cat = load(gpu_info_file)
+    if cat is not None:
+        df = cat.prices()
+        return df.set_axis(cat.column("name").tolist(), axis=0)
+    with open(gpu_info_file) as f:
+        data = json.load(f)
+    return prices(data).set_axis([x["name"] for x in data["instance"]], axis=0)
+
+
+def read_index(gpu_info_file):
+    """Returns the query index from the columnar catalog or the json file"""
+    cat = load(gpu_info_file)
+    if cat is not None:
+        return cat.index()
+    with open(gpu_info_file) as f:
+        data = json.load(f)
+    return query.InstanceIndex.from_data(data, prices(data))
+
+
+def read_instances(gpu_info_file, columns=None):
+    """Returns a DataFrame of the instances with only the given columns"""
+    cat = load(gpu_info_file)
+    if cat is not None:
+        return cat.to_frame(columns)
+    with open(gpu_info_file) as f:
+        df = pd.DataFrame(json.load(f)["instance"])
+    return df[columns] if columns else df
@@ -1,6 +1,7 @@
 from pydantic import BaseSettings
 
 import pathlib
+from typing import Dict
 
 _SETTINGS = None
 
@@ -8,7 +9,51 @@ _SETTINGS = None
 class Settings(BaseSettings):
     PROG_HOME: pathlib.Path = pathlib.Path("~").expanduser() / ".tchotcho"
     GPU_INFO_FILE: pathlib.Path = PROG_HOME / "gpu_info.json"
+    # also write a memory mapped columnar copy of GPU_INFO_FILE on update
+    GPU_INFO_COLUMNAR: bool = True
+    INSTANCES_URL: str = (
+        "https://raw.githubusercontent.com/powdahound/ec2instances.info/master/www/instances.json"  # noqa
+    )
+    INSTANCES_FILE: pathlib.Path = PROG_HOME / "instances.json.gz"
     PREFIX: str = "tchotcho"
+    # AMIs baked by stack bake, by bake key
+    BAKED_AMI_FILE: pathlib.Path = PROG_HOME / "baked_amis.json"
+    # seconds the entries of a cache namespace are valid, see tchotcho.cache
+    CACHE_TTL: Dict[str, int] = {
+        "regions": 24 * 60 * 60,
+        "offerings": 24 * 60 * 60,
+        "ami": 6 * 60 * 60,
+        "spot": 5 * 60,
+        "keys": 60,
+        "stacks": 30,
+        "vpc": 24 * 60 * 60,
+        "templates": 7 * 24 * 60 * 60,
+    }
+    # least recently used entries are evicted above
+    CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    # False ignores cached values, they are still refreshed
+    CACHE_ENABLED: bool = True
+    # days of spot prices fetched by a first spot sync
+    SPOT_HISTORY_DAYS: int = 7
+    # spot bid of a placement above its spot price without an on demand price
+    SPOT_BID_HEADROOM: float = 0.25
+    # max concurrent calls of a region sweep
+    FANOUT_WORKERS: int = 16
+    # seconds a stack operation is followed before giving up on it
+    STACK_TIMEOUT: int = 60 * 60
+    # stacks of a fleet created at once
+    FLEET_WORKERS: int = 8
+    # calls per second and burst of every (service, region), adapts to throttling
+    AWS_RATE: float = 10.0
+    AWS_BURST: int = 20
+    # max concurrent calls per (service, region)
+    AWS_MAX_CONCURRENCY: int = 8
+    # attempts and jittered exponential backoff of retryable errors
+    AWS_MAX_ATTEMPTS: int = 6
+    AWS_BACKOFF_BASE: float = 0.5
+    AWS_BACKOFF_MAX: float = 20.0
+    # urllib3 connection pool size of every pooled client
+    AWS_MAX_POOL_CONNECTIONS: int = 10
 
     # class Config:
     #     env_file = os.environ.get("TCHOTCHO_ENV", ".env")
@@ -0,0 +1,38 @@
+import botocore.exceptions
+
+
+class AwsError(botocore.exceptions.ClientError):
+    """A failed AWS call, raised by the call layer in tchotcho.aws
+
+    It is a ClientError with the error response of the call, waiters still
+    match their error acceptors on it.
+    """
+
+    def __init__(self, message, code=None, operation=None, region=None, response=None):
+        # not ClientError.__init__, the message is ours
+        Exception.__init__(self, message)
+        self.code = code
+        self.operation = operation
+        self.region = region
+        self.operation_name = operation
+        self.response = response or {"Error": {"Code": code, "Message": message}}
+
+    def __reduce__(self):
+        return type(self), (str(self), self.code, self.operation, self.region,
+                            self.response)
+
+
+class TransientError(AwsError):
+    """A retryable error that persisted after all attempts"""
+
+
+class ThrottledError(TransientError):
+    """The request rate limit was still exceeded after all attempts"""
+
+
+class AuthError(AwsError):
+    """Missing, expired or insufficient credentials"""
+
+
+class RequestError(AwsError):
+    """The request itself was rejected e.g. invalid parameters"""
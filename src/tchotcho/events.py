@@ -0,0 +1,180 @@
+import collections
+import re
+import threading
+import time
+
+from tchotcho.log import log
+
+STACK_TYPE = "AWS::CloudFormation::Stack"
+# longest poll interval per stack phase, instances take minutes, deletes less
+PHASE_MAX_INTERVAL = {
+    "CREATE_IN_PROGRESS": 10.0,
+    "UPDATE_IN_PROGRESS": 10.0,
+    "DELETE_IN_PROGRESS": 5.0,
+}
+DEFAULT_MAX_INTERVAL = 5.0
+MIN_INTERVAL = 1.0
+
+
+# error codes and spot statuses of a placement without capacity (or quota),
+# another region, zone or instance type may have some. Each is matched as a
+# whole word of the failure reason.
+CAPACITY_ERRORS = (
+    "InsufficientInstanceCapacity",
+    "InsufficientCapacity",
+    "InsufficientHostCapacity",
+    "capacity-not-available",
+    "capacity-oversubscribed",
+    "price-too-low",
+    "SpotMaxPriceTooLow",
+    "MaxSpotInstanceCountExceeded",
+    "VcpuLimitExceeded",
+    "InstanceLimitExceeded",
+    # the instance type is not offered in the zone, too common a word alone
+    "Error Code: Unsupported",
+)
+_CAPACITY_RE = re.compile(
+    "|".join(rf"(?<![\w-]){re.escape(x)}(?![\w-])" for x in CAPACITY_ERRORS)
+)
+
+
+def is_terminal(status):
+    return status.endswith("_COMPLETE") or status.endswith("_FAILED")
+
+
+def is_capacity_failure(event):
+    """True if a StackProgress event failed for lack of capacity"""
+    if not event["status"].endswith("_FAILED") or not event["reason"]:
+        return False
+    return _CAPACITY_RE.search(event["reason"]) is not None
+
+
+class StackEvents(object):
+    """Tail the events of a stack, every event is returned once
+
+    stack_id should be the stack ARN so the events of a deleted stack can
+    still be read. Only events after last_event_id are returned, see mark.
+    """
+
+    def __init__(self, cf, stack_id, last_event_id=None):
+        self.cf = cf
+        self.stack_id = stack_id
+        self.last_event_id = last_event_id
+
+    def mark(self):
+        """Skip all events up to now e.g. of an earlier operation"""
+        resp = self.cf.describe_stack_events(StackName=self.stack_id)
+        if resp["StackEvents"]:
+            self.last_event_id = resp["StackEvents"][0]["EventId"]
+
+    def new_events(self):
+        """Returns the events since the last call, oldest first"""
+        ret = []
+        paginator = self.cf.get_paginator("describe_stack_events")
+        # pages are newest first, stop at the last seen event
+        for page in paginator.paginate(StackName=self.stack_id):
+            for x in page["StackEvents"]:
+                if x["EventId"] == self.last_event_id:
+                    break
+                ret.append(x)
+            else:
+                continue
+            break
+        if ret:
+            self.last_event_id = ret[0]["EventId"]
+        return ret[::-1]
+
+
+class StackProgress(object):
+    """Follow a stack operation until its stack reaches a terminal status
+
+    Per resource the timestamp of its in progress status is kept to report
+    the duration of every finished step. The poll interval starts at
+    MIN_INTERVAL, grows while nothing happens up to the maximum of the stack
+    phase and drops back on new events.
+    """
+
+    def __init__(self, events, sleep=time.sleep, clock=time.monotonic):
+        self.events = events
+        self.sleep = sleep
+        self.clock = clock
+        self.status = None
+        self._started = {}
+
+    def _record(self, event):
+        resource = event["LogicalResourceId"]
+        status = event["ResourceStatus"]
+        duration = None
+        if status.endswith("_IN_PROGRESS"):
+            self._started.setdefault(resource, event["Timestamp"])
+        elif resource in self._started:
+            duration = (event["Timestamp"] - self._started.pop(resource)).total_seconds()
+        if event["ResourceType"] == STACK_TYPE and resource == event["StackName"]:
+            self.status = status
+        return {
+            "time": event["Timestamp"].isoformat(),
+            "resource": resource,
+            "type": event["ResourceType"],
+            "status": status,
+            "reason": event.get("ResourceStatusReason"),
+            "duration": duration,
+        }
+
+    def follow(self, stop=None, timeout=None):
+        """Yield a dict per stack event until the stack is done
+
+        The final stack status is in status afterwards. stop is called after
+        every poll, if it returns True following ends before the stack is
+        done. Raises TimeoutError if the stack is not done after timeout
+        seconds.
+        """
+        deadline = None if timeout is None else self.clock() + timeout
+        interval = MIN_INTERVAL
+        while True:
+            new = self.events.new_events()
+            for x in new:
+                yield self._record(x)
+            if self.status is not None and is_terminal(self.status):
+                return
+            if stop is not None and stop():
+                return
+            if deadline is not None and self.clock() >= deadline:
+                raise TimeoutError(
+                    f"Stack {self.events.stack_id} not done after {timeout}s: "
+                    f"{self.status}"
+                )
+            phase_max = PHASE_MAX_INTERVAL.get(self.status, DEFAULT_MAX_INTERVAL)
+            interval = MIN_INTERVAL if new else min(phase_max, interval * 1.5)
+            if deadline is not None:
+                interval = min(interval, max(0, deadline - self.clock()))
+            self.sleep(interval)
+
+
+class FleetProgress(object):
+    """Aggregated status of many stack operations followed concurrently
+
+    A summary line is logged whenever the status of a stack changes.
+    """
+
+    def __init__(self, names, title="Fleet"):
+        self.status = {x: "PENDING" for x in names}
+        self.title = title
+        self._lock = threading.Lock()
+
+    def summary(self):
+        counts = collections.Counter(self.status.values())
+        done = sum(v for k, v in counts.items() if is_terminal(k) or k == "FAILED")
+        states = ", ".join(f"{k}={v}" for k, v in sorted(counts.items()))
+        return f"{done}/{len(self.status)} done: {states}"
+
+    def set(self, name, status):
+        with self._lock:
+            if self.status.get(name) == status:
+                return
+            self.status[name] = status
+            log.info(f"{self.title} {self.summary()}")
+
+    def update(self, name, event):
+        """Take the stack status from a StackProgress event of stack name"""
+        if event["type"] == STACK_TYPE and event["resource"] == name:
+            self.set(name, event["status"])
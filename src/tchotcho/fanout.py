@@ -0,0 +1,31 @@
+import concurrent.futures
+
+from tchotcho.config import get_settings
+
+METHODS = ("future-thread", "serial")
+
+
+def fan_out(fn, items, method="future-thread", max_workers=None):
+    """Call fn for every item and yield the results as they complete
+
+    ``future-thread`` runs at most max_workers (default
+    ``Settings.FANOUT_WORKERS``) calls concurrently in a thread pool,
+    ``serial`` runs them one after another in order.
+    """
+    if method == "serial":
+        for item in items:
+            yield fn(item)
+        return
+    if method != "future-thread":
+        raise ValueError(f"Unknown fan out method {method}, use one of {METHODS}")
+
+    max_workers = max_workers or get_settings().FANOUT_WORKERS
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fn, x) for x in items]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+        finally:
+            # consumer stopped early or a call failed
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,139 @@
+import codecs
+import gzip
+import json
+import os
+import pathlib
+
+import requests
+
+from tchotcho.log import log
+
+CHUNK_SIZE = 1 << 16
+TIMEOUT = 60
+
+# fields of an ec2instances.info record we keep, everything else is dropped
+# while decoding
+INSTANCE_FIELDS = (
+    "instance_type",
+    "GPU",
+    "vCPU",
+    "gpu_count",
+    "memory",
+    "GPU_memory",
+    "GPU_model",
+    "compute_capability",
+    "cuda_cores",
+    "storage",
+    "pricing",
+)
+# pricing contains reserved prices for every os, we only use ondemand
+DROP_FIELDS = ("reserved",)
+
+
+def _meta_path(path):
+    return path.with_name(path.name + ".meta")
+
+
+def read_meta(path):
+    """Returns the stored ETag/Last-Modified of the local feed copy"""
+    meta_path = _meta_path(pathlib.Path(path))
+    if not meta_path.exists():
+        return {}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_meta(path, headers):
+    meta = {
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+    }
+    with open(_meta_path(path), "w") as f:
+        json.dump(meta, f)
+
+
+def _conditional_headers(path):
+    headers = {}
+    if not path.exists():
+        return headers
+    meta = read_meta(path)
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+def _object_hook(pairs):
+    keys = [k for k, _ in pairs]
+    if "instance_type" in keys:
+        return {k: v for k, v in pairs if k in INSTANCE_FIELDS}
+    return {k: v for k, v in pairs if k not in DROP_FIELDS}
+
+
+def iter_json_array(chunks):
+    """Yield the objects of a top level json array from an iterable of bytes
+
+    Only one array element is decoded at a time so memory is bounded by the
+    largest element and not by the size of the document.
+    """
+    decoder = json.JSONDecoder(object_pairs_hook=_object_hook)
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    for chunk in chunks:
+        buf += utf8.decode(chunk)
+        pos = 0
+        while True:
+            # skip the array syntax between elements
+            while pos < len(buf) and buf[pos] in "[, \t\r\n":
+                pos += 1
+            if pos == len(buf) or buf[pos] != "{":
+                break
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # element is not complete yet, wait for more data
+                break
+            yield obj
+        buf = buf[pos:]
+    buf += utf8.decode(b"", final=True)
+    if buf.strip() not in ("", "]"):
+        raise ValueError(f"Invalid json array, trailing data: {buf[:80]!r}")
+
+
+def _read_local(path):
+    with gzip.open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            yield chunk
+
+
+def _download(res, path):
+    """Yield the response body while writing a gzip copy of it to path"""
+    tmp = path.with_name(path.name + ".tmp")
+    with gzip.open(tmp, "wb") as f:
+        for chunk in res.iter_content(CHUNK_SIZE):
+            f.write(chunk)
+            yield chunk
+    # only replace the local copy if the download was complete
+    os.replace(tmp, path)
+    _write_meta(path, res.headers)
+
+
+def iter_instances(url, path):
+    """Stream the instance records of the feed
+
+    A conditional request is made with the stored ETag/Last-Modified. If the
+    feed did not change the local gzip copy in path is used, else the new
+    feed is written to path while it is parsed.
+    """
+    path = pathlib.Path(path)
+    headers = _conditional_headers(path)
+    with requests.get(url, headers=headers, stream=True, timeout=TIMEOUT) as res:
+        if res.status_code == 304:
+            log.info(f"Feed not modified, using local copy {path}")
+            chunks = _read_local(path)
+        else:
+            res.raise_for_status()
+            log.info(f"Downloading feed {url} to {path}")
+            chunks = _download(res, path)
+        yield from iter_json_array(chunks)
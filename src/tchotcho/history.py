@@ -0,0 +1,129 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS spot_price (
+    region TEXT NOT NULL,
+    instance_type TEXT NOT NULL,
+    az TEXT NOT NULL,
+    product TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    price REAL NOT NULL,
+    PRIMARY KEY (region, instance_type, az, product, ts)
+) WITHOUT ROWID
+"""
+CATEGORIES = ("region", "instance_type", "az", "product")
+COLUMNS = list(CATEGORIES) + ["ts", "price"]
+CHUNK_SIZE = 100000
+
+
+class SpotHistoryStore(object):
+    """Append only spot price history in a SQLite database
+
+    Points are unique by (region, instance type, az, product, timestamp) so
+    overlapping syncs do not add duplicates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def append(self, region, records):
+        """Store describe_spot_price_history records, returns the new count"""
+        rows = [
+            (
+                region,
+                x["InstanceType"],
+                x["AvailabilityZone"],
+                x["ProductDescription"],
+                int(x["Timestamp"].timestamp()),
+                float(x["SpotPrice"]),
+            )
+            for x in records
+        ]
+        with self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO spot_price VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            return self.conn.total_changes - before
+
+    def last_timestamps(self, region):
+        """Returns {(instance type, az): last unix timestamp} of region"""
+        cur = self.conn.execute(
+            "SELECT instance_type, az, MAX(ts) FROM spot_price WHERE region = ? "
+            "GROUP BY instance_type, az",
+            (region,),
+        )
+        return {(x[0], x[1]): x[2] for x in cur}
+
+    def latest(self, region=None, instance_types=None):
+        """Returns the last stored point per (region, instance type, az, product)"""
+        where, params = self._where(region, instance_types, None, None, None)
+        # SQLite takes the bare price column from the row of MAX(ts)
+        sql = (
+            f"SELECT {', '.join(CATEGORIES)}, MAX(ts) AS ts, price "
+            f"FROM spot_price{where} GROUP BY {', '.join(CATEGORIES)}"
+        )
+        df = pd.read_sql_query(sql, self.conn, params=params)
+        if df.empty:
+            return _empty()
+        df["ts"] = pd.to_datetime(df["ts"], unit="s", utc=True)
+        return df
+
+    def _where(self, region, instance_types, azs, start, end):
+        clauses, params = [], []
+        for col, values in (("region", region), ("instance_type", instance_types),
+                            ("az", azs)):
+            if values:
+                values = [values] if isinstance(values, str) else list(values)
+                clauses.append(f"{col} IN ({', '.join('?' * len(values))})")
+                params.extend(values)
+        for op, value in ((">=", start), ("<=", end)):
+            if value is not None:
+                clauses.append(f"ts {op} ?")
+                params.append(int(pd.Timestamp(value).timestamp()))
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return where, params
+
+    def query(self, region=None, instance_types=None, azs=None, start=None, end=None):
+        """Returns the points of the window as a compact DataFrame
+
+        The names are categorical, ts is a UTC datetime and price float32.
+        Rows are read in chunks so only the compact frame is held in memory.
+        """
+        where, params = self._where(region, instance_types, azs, start, end)
+        sql = (
+            f"SELECT {', '.join(COLUMNS)} FROM spot_price{where} "
+            "ORDER BY region, instance_type, az, product, ts"
+        )
+        frames = []
+        for df in pd.read_sql_query(sql, self.conn, params=params, chunksize=CHUNK_SIZE):
+            for col in CATEGORIES:
+                df[col] = df[col].astype("category")
+            df["price"] = df["price"].astype(np.float32)
+            frames.append(df)
+        if not frames:
+            return _empty()
+        ret = {
+            col: pd.api.types.union_categoricals([x[col] for x in frames])
+            for col in CATEGORIES
+        }
+        for col in ("ts", "price"):
+            ret[col] = np.concatenate([x[col].to_numpy() for x in frames])
+        df = pd.DataFrame(ret)
+        df["ts"] = pd.to_datetime(df["ts"], unit="s", utc=True)
+        return df
+
+
+def _empty():
+    df = pd.DataFrame({x: pd.Categorical([]) for x in CATEGORIES})
+    df["ts"] = pd.to_datetime(pd.Series([], dtype=np.int64), unit="s", utc=True)
+    df["price"] = pd.Series([], dtype=np.float32)
+    return df
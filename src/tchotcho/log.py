@@ -24,4 +24,4 @@ handler.setFormatter(
 log = colorlog.getLogger(LOGGER_NAME)
 log.addHandler(handler)
 log.setLevel(LEVEL)
-log.info("Logging level: %s" % LEVEL_STR)
+log.debug("Logging level: %s" % LEVEL_STR)
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+MARKETS = ("spot", "ondemand")
+COLUMNS = [
+    "name",
+    "region",
+    "az",
+    "market",
+    "price",
+    "price_per_gpu",
+    "price_per_gpu_gb",
+    "gpu",
+    "gpu_memory",
+    "gpu_model",
+    "compute_capability",
+    "ondemand",
+]
+
+
+def _ondemand(index, rows, regions):
+    """(row, region, az, price) of every priced (instance, region) cell"""
+    prices = index.prices
+    if regions:
+        prices = prices.reindex(columns=list(regions))
+    matrix = prices.to_numpy(dtype=float)[rows]
+    r, c = np.nonzero(~np.isnan(matrix))
+    columns = np.array(prices.columns, dtype=object)
+    return rows[r], columns[c], np.full(len(r), "", dtype=object), matrix[r, c]
+
+
+def _ondemand_of(index, rows, region):
+    """On demand price of every (row, region), NaN if not available"""
+    col = pd.Index(index.prices.columns).get_indexer(region)
+    matrix = index.prices.to_numpy(dtype=float)
+    if not matrix.shape[1]:
+        return np.full(len(rows), np.nan)
+    return np.where(col >= 0, matrix[rows, col], np.nan)
+
+
+def _spot(index, rows, spot, regions):
+    """(row, region, az, price) of the spot prices of candidate instances"""
+    if regions:
+        spot = spot[spot["region"].isin(list(regions))]
+    pos = pd.Index(index.frame["name"]).get_indexer(spot["instance_type"].astype(str))
+    candidate = np.zeros(index.size + 1, dtype=bool)
+    candidate[rows] = True
+    # get_indexer returns -1 for unknown names which maps to the extra False
+    keep = candidate[pos]
+    return (
+        pos[keep],
+        spot["region"].astype(str).to_numpy(dtype=object)[keep],
+        spot["az"].astype(str).to_numpy(dtype=object)[keep],
+        spot["price"].to_numpy(dtype=float)[keep],
+    )
+
+
+def solve(
+    index,
+    spot=None,
+    market="spot",
+    gpus=None,
+    gpu_memory=None,
+    min_compute_capability=None,
+    budget=None,
+    regions=None,
+    top=None,
+    supported=True,
+):
+    """Returns the placements matching the requirements ranked by price per GPU
+
+    index is the InstanceIndex of the catalog, spot a frame with region,
+    instance_type, az and price columns. A placement is one instance with at
+    least gpus GPUs and gpu_memory GB GPU memory in total, priced per hour on
+    the market in a region (on demand) or availability zone (spot). budget is
+    the maximum price per hour. Ties are ranked by price per GPU memory GB.
+    ondemand is the on demand price of the instance in the region.
+    """
+    if market not in MARKETS:
+        raise ValueError(f"Unknown market {market}, use one of {MARKETS}")
+    mask = index.mask(
+        min_gpu_memory=gpu_memory,
+        min_compute_capability=min_compute_capability,
+        supported=supported,
+    )
+    if gpus:
+        mask &= index.range("gpu", gpus)
+    rows = np.flatnonzero(mask)
+    if market == "spot":
+        if spot is None or spot.empty:
+            return pd.DataFrame(columns=COLUMNS)
+        rows, region, az, price = _spot(index, rows, spot, regions)
+    else:
+        rows, region, az, price = _ondemand(index, rows, regions)
+
+    gpu = pd.to_numeric(index.frame["gpu"]).to_numpy(dtype=float)[rows]
+    memory = pd.to_numeric(index.frame["gpu_memory"]).to_numpy(dtype=float)[rows]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_gpu = price / gpu
+        per_gb = np.where(memory > 0, price / memory, np.nan)
+    keep = np.ones(len(rows), dtype=bool) if budget is None else price <= budget
+    order = np.flatnonzero(keep)[
+        np.lexsort((np.nan_to_num(per_gb[keep], nan=np.inf), per_gpu[keep]))
+    ]
+    if top is not None:
+        order = order[:top]
+
+    df = index.frame.iloc[rows[order]][
+        ["name", "gpu", "gpu_memory", "gpu_model", "compute_capability"]
+    ].reset_index(drop=True)
+    df["region"] = region[order]
+    df["az"] = az[order]
+    df["market"] = market
+    df["price"] = price[order]
+    df["price_per_gpu"] = per_gpu[order]
+    df["price_per_gpu_gb"] = per_gb[order]
+    df["ondemand"] = _ondemand_of(index, rows[order], region[order])
+    return df[COLUMNS]
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+
+# columns with a sorted index for range queries
+RANGE_COLUMNS = ("gpu", "gpu_memory", "compute_capability", "cpu", "memory")
+RESULT_COLUMNS = [
+    "name",
+    "gpu",
+    "gpu_memory",
+    "gpu_model",
+    "compute_capability",
+    "cpu",
+    "memory",
+    "price",
+    "price_per_gpu",
+]
+
+
+def build(df):
+    """Returns the index arrays of an instance frame
+
+    Every range column gets its argsort order and sorted values, gpu models
+    are factorized into codes and supported is kept as bitmap.
+    """
+    arrays = {}
+    for col in RANGE_COLUMNS:
+        values = pd.to_numeric(df[col]).to_numpy(dtype=float)
+        order = np.argsort(values, kind="stable")
+        arrays[f"order_{col}"] = order
+        arrays[f"sorted_{col}"] = values[order]
+    codes, models = pd.factorize(df["gpu_model"].fillna("").astype(str))
+    arrays["model_codes"] = codes
+    arrays["models"] = np.array(list(models) or [""], dtype=str)
+    arrays["supported"] = df["supported"].to_numpy(dtype=bool)
+    return arrays
+
+
+class InstanceIndex(object):
+    """Filter and rank instances of the catalog with the update time index"""
+
+    def __init__(self, arrays, frame, prices):
+        self.arrays = arrays
+        self.frame = frame
+        self.prices = prices
+        self.size = len(frame)
+
+    @classmethod
+    def from_data(cls, data, prices):
+        """Build the index in memory from update data"""
+        frame = pd.DataFrame(data["instance"])
+        return cls(build(frame), frame, prices)
+
+    def range(self, col, low=None, high=None):
+        """Returns a mask of rows with low <= col <= high"""
+        mask = np.zeros(self.size, dtype=bool)
+        values = self.arrays[f"sorted_{col}"]
+        start = 0 if low is None else np.searchsorted(values, low, side="left")
+        # NaN is sorted last and never matches
+        end = np.searchsorted(values, np.inf if high is None else high, side="right")
+        mask[self.arrays[f"order_{col}"][start:end]] = True
+        return mask
+
+    def model(self, pattern):
+        """Returns a mask of rows whose gpu model contains pattern"""
+        models = np.char.lower(self.arrays["models"])
+        matches = np.flatnonzero(np.char.find(models, pattern.lower()) >= 0)
+        return np.isin(self.arrays["model_codes"], matches)
+
+    def price_per_gpu(self, region):
+        price = self.region_price(region)
+        gpu = np.asarray(self.frame["gpu"], dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(gpu > 0, price / gpu, np.nan)
+
+    def region_price(self, region):
+        if region not in self.prices.columns:
+            return np.full(self.size, np.nan)
+        return self.prices[region].to_numpy(dtype=float)
+
+    def mask(
+        self,
+        min_gpu_memory=None,
+        gpu_model=None,
+        min_compute_capability=None,
+        min_cpu=None,
+        max_cpu=None,
+        min_memory=None,
+        max_memory=None,
+        supported=False,
+    ):
+        """Returns the mask of rows matching all given filters"""
+        mask = self.range("gpu", 1)
+        ranges = (
+            ("gpu_memory", min_gpu_memory, None),
+            ("compute_capability", min_compute_capability, None),
+            ("cpu", min_cpu, max_cpu),
+            ("memory", min_memory, max_memory),
+        )
+        for col, low, high in ranges:
+            if low is not None or high is not None:
+                mask &= self.range(col, low, high)
+        if gpu_model:
+            mask &= self.model(gpu_model)
+        if supported:
+            mask &= self.arrays["supported"]
+        return mask
+
+    def query(self, region, max_price=None, top_k=None, **filters):
+        """Returns the matching GPU instances ranked by price per GPU in region
+
+        Instances without a price in region are ranked last and dropped if
+        max_price is set.
+        """
+        mask = self.mask(**filters)
+        price = self.region_price(region)
+        if max_price is not None:
+            mask &= price <= max_price
+        rows = np.flatnonzero(mask)
+        per_gpu = self.price_per_gpu(region)[rows]
+        rank = np.where(np.isnan(per_gpu), np.inf, per_gpu)
+        if top_k is not None and top_k < len(rows):
+            part = np.argpartition(rank, top_k - 1)[:top_k]
+            rows, rank = rows[part], rank[part]
+        rows = rows[np.argsort(rank, kind="stable")]
+
+        df = self.frame.iloc[rows].copy()
+        df["price"] = price[rows]
+        df["price_per_gpu"] = self.price_per_gpu(region)[rows]
+        return df[RESULT_COLUMNS].reset_index(drop=True)
@@ -0,0 +1,78 @@
+import itertools
+
+from tchotcho import aws
+from tchotcho.cache import Cache
+from tchotcho.fanout import fan_out
+
+# OptInStatus of regions the account can use
+ENABLED = ("opt-in-not-required", "opted-in")
+
+
+class RegionInventory(object):
+    """Regions and instance type offerings of the account
+
+    Both are kept in the regions and offerings cache namespaces, ttl
+    overrides Settings.CACHE_TTL. client is a callable returning an ec2
+    client for a region.
+    """
+
+    def __init__(self, client, ttl=None):
+        self.client = client
+        self.regions_cache = Cache("regions", ttl)
+        self.offerings_cache = Cache("offerings", ttl)
+
+    def _fetch_regions(self):
+        resp = self.client(None).describe_regions(AllRegions=True)
+        return [
+            {
+                "RegionName": x["RegionName"],
+                "OptInStatus": x.get("OptInStatus", "opt-in-not-required"),
+            }
+            for x in resp["Regions"]
+        ]
+
+    def regions(self):
+        """Returns all regions with their opt in status"""
+        return self.regions_cache.get_or_set(["all", aws.account()], self._fetch_regions)
+
+    def enabled_regions(self):
+        return [x["RegionName"] for x in self.regions() if x["OptInStatus"] in ENABLED]
+
+    def _fetch_offerings(self, region):
+        paginator = self.client(region).get_paginator(
+            "describe_instance_type_offerings"
+        )
+        ret = {}
+        for page in paginator.paginate(LocationType="availability-zone"):
+            for x in page["InstanceTypeOfferings"]:
+                ret.setdefault(x["Location"], []).append(x["InstanceType"])
+        return region, ret
+
+    def offerings(self, regions=None):
+        """Returns {region: {availability zone: [instance type]}}
+
+        Defaults to all enabled regions, missing or expired regions are
+        fetched concurrently.
+        """
+        regions = self.enabled_regions() if regions is None else regions
+        ret = {}
+        for region in regions:
+            value = self.offerings_cache.get([region, aws.account()])
+            if value is not None:
+                ret[region] = value
+        missing = [x for x in regions if x not in ret]
+        for region, value in fan_out(self._fetch_offerings, missing):
+            ret[region] = self.offerings_cache.set([region, aws.account()], value)
+        return ret
+
+    def match(self, instance_types, regions=None):
+        """Returns {region: [instance type]} of the regions offering any of
+        instance_types, types a region does not offer are removed
+        """
+        ret = {}
+        for region, zones in self.offerings(regions).items():
+            offered = set(itertools.chain.from_iterable(zones.values()))
+            types = [x for x in instance_types if x in offered]
+            if types:
+                ret[region] = types
+        return ret
@@ -1,4 +1,4 @@
-import boto3
+import hashlib
 import os
 import troposphere.iam
 import troposphere.ec2
@@ -10,6 +10,14 @@ import awacs.aws
 import awacs.sts
 import awacs
 
+from tchotcho import aws
+from tchotcho.cache import Cache
+
+# part of the template cache key, bump on every change of the template
+TEMPLATE_VERSION = 3
+# key of the create_cloudformation metadata in the template Metadata
+METADATA_KEY = "TchoTcho"
+
 
 USER_SCRIPT_DEFAULT = """#!/bin/bash
 set -x -e
@@ -46,16 +54,119 @@ cfn-signal -e $? --stack ${AWS::StackName} --resource TchoTchoInstance --region
 echo "END"
 """
 
+# user script of a baked AMI, the bootstrap is already installed
+USER_SCRIPT_BAKED = """#!/bin/bash
+set -x -e
+
+exec > >(tee /var/log/user-data.log|logger -t user-data -s 2>/dev/console) 2>&1
+
+echo "BEGIN"
+date '+%Y-%m-%d %H:%M:%S'
+
+echo "START # Extra user data #"
+
+<<extra_user_data>>
+
+echo "END # Extra user data #"
+
+cfn-signal -e $? --stack ${AWS::StackName} --resource TchoTchoInstance --region ${AWS::Region}
+
+echo "END"
+"""
+
+
+# cfn-signal target of the instance and of the wait handle of a fleet
+SIGNAL_INSTANCE = (
+    "--stack ${AWS::StackName} --resource TchoTchoInstance --region ${AWS::Region}"
+)
+SIGNAL_WAIT_HANDLE = '"${TchoTchoWaitHandle}"'
+# spot allocation strategies of fleet mode, see create_cloudformation
+ALLOCATION_STRATEGIES = (
+    "price-capacity-optimized",
+    "capacity-optimized",
+    "capacity-optimized-prioritized",
+    "lowest-price",
+)
+# a maintain fleet keeps trying every pool until one has capacity
+FLEET_TYPE = "maintain"
+WAIT_TIMEOUT = 15 * 60
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
 
-def get_default_vpc_id():
-    """Returns a default VPC id or None"""
-    ec2 = boto3.client("ec2")
+def _fetch_default_vpc_id(ec2):
     res = ec2.describe_vpcs(Filters=[{"Name": "isDefault", "Values": ["true"]}])
     if not len(res["Vpcs"]):
         return None
     return res["Vpcs"][0]["VpcId"]
 
 
+def get_default_vpc_id(region=None):
+    """Returns a default VPC id or None, cached per region and account"""
+    ec2 = aws.client("ec2", region)
+    key = [ec2.meta.region_name, aws.account()]
+    return Cache("vpc").get_or_set(key, lambda: _fetch_default_vpc_id(ec2))
+
+
+def _fetch_default_subnet_id(ec2, az):
+    res = ec2.describe_subnets(
+        Filters=[
+            {"Name": "availability-zone", "Values": [az]},
+            {"Name": "default-for-az", "Values": ["true"]},
+        ]
+    )
+    if not len(res["Subnets"]):
+        return None
+    return res["Subnets"][0]["SubnetId"]
+
+
+def get_default_subnet_id(az, region=None):
+    """Returns the default subnet id of availability zone az or None"""
+    ec2 = aws.client("ec2", region)
+    key = [ec2.meta.region_name, aws.account(), az]
+    return Cache("vpc").get_or_set(key, lambda: _fetch_default_subnet_id(ec2, az))
+
+
+def template_digest(template):
+    """Content address of a template body"""
+    return hashlib.sha256(template.encode()).hexdigest()
+
+
+def lint(template, regions=None):
+    """Offline check of a template with cfn-lint, returns the error messages
+
+    cfn-lint 0.x is optional, pip install tchotcho[lint].
+    """
+    try:
+        import cfnlint
+    except ModuleNotFoundError as ex:
+        if ex.name != "cfnlint":
+            raise
+        raise RuntimeError("Offline validation needs cfn-lint: pip install tchotcho[lint]")
+    try:
+        import cfnlint.api
+        import cfnlint.core
+    except ModuleNotFoundError as ex:
+        if ex.name != "cfnlint.core":
+            raise
+        # cfn-lint 1.x
+        from cfnlint.version import __version__
+        raise RuntimeError(
+            f"Offline validation needs cfn-lint<1, found {__version__}: "
+            "pip install tchotcho[lint]"
+        )
+    rules = cfnlint.core.get_rules([], [], [])
+    matches = cfnlint.api.lint(template, rules, regions or ["us-east-1"])
+    # warnings and informational matches are no errors
+    return [str(x) for x in matches if x.rule.id.startswith("E")]
+
+
 def create_cloudformation(
     key_name,
     ami_id,
@@ -66,18 +177,94 @@ def create_cloudformation(
     size=100,
     user_script=USER_SCRIPT_DEFAULT,
     extra_user_data="",
+    allocation=None,
+    region=None,
+    metadata=None,
+    vpc_id=None,
+    offline=False,
+):
+    """Returns the template json of a stack in region (default the session's)
+
+    instance_type and subnet_id can be ranked lists, with more than one
+    instance type or subnet or an allocation strategy the instance is
+    launched by an EC2 Fleet over all (instance type, subnet) pools instead
+    of a single instance. See ALLOCATION_STRATEGIES, default
+    price-capacity-optimized.
+
+    metadata is kept in the Metadata of the template e.g. the arguments it
+    was created with. The security group is in vpc_id, default the default
+    VPC of region. offline does not look it up, a VPC that is not known is
+    the VpcId parameter of the template. The template only depends on the
+    parameters and the VPC, it is built once and then read from the cache.
+    """
+    instance_types = _as_list(instance_type)
+    subnets = _as_list(subnet_id)
+    if allocation is None and (len(instance_types) > 1 or len(subnets) > 1):
+        allocation = ALLOCATION_STRATEGIES[0]
+    if allocation is not None and allocation not in ALLOCATION_STRATEGIES:
+        raise ValueError(f"Unknown allocation strategy {allocation}")
+    if allocation is None:
+        instance_types, subnets = instance_types[0], (subnets or [None])[0]
+    params = {
+        "key_name": key_name,
+        "ami_id": ami_id,
+        "instance_type": instance_types,
+        "security_group": security_group,
+        "subnet_id": subnets,
+        "price": price,
+        "size": size,
+        "user_script": user_script,
+        "extra_user_data": extra_user_data,
+        "allocation": allocation,
+        "metadata": metadata,
+        "vpc_id": vpc_id,
+    }
+    if vpc_id is None and not offline:
+        params["vpc_id"] = get_default_vpc_id(region)
+    key = {"version": TEMPLATE_VERSION, **params}
+    return Cache("templates").get_or_set(key, lambda: _build_cloudformation(**params))
+
+
+def _build_cloudformation(
+    key_name,
+    ami_id,
+    instance_type,
+    security_group,
+    subnet_id,
+    price,
+    size,
+    user_script,
+    extra_user_data,
+    allocation,
+    metadata,
+    vpc_id,
 ):
-    user_script = USER_SCRIPT_DEFAULT.replace("<<extra_user_data>>",
-                                              extra_user_data)
+    user_script = user_script.replace("<<extra_user_data>>", extra_user_data)
+    if allocation is not None:
+        # the fleet instance is not a resource of the stack, it signals a handle
+        user_script = user_script.replace(SIGNAL_INSTANCE, SIGNAL_WAIT_HANDLE)
     # XXX set this to get real bool values
     os.environ["TROPO_REAL_BOOL"] = "true"
 
     t = troposphere.Template(Description="TchoTcho EC2 train")
+    if metadata:
+        t.set_metadata({METADATA_KEY: metadata})
+
+    if vpc_id is None:
+        vpc_id = troposphere.Ref(
+            t.add_parameter(
+                troposphere.Parameter(
+                    "VpcId",
+                    Type="AWS::EC2::VPC::Id",
+                    Description="VPC of the security group",
+                )
+            )
+        )
 
     instance_security_group = t.add_resource(
         troposphere.ec2.SecurityGroup(
             "InstanceSecurityGroup",
-            VpcId=get_default_vpc_id(),
+            VpcId=vpc_id,
             GroupDescription="Enable only SSH ingoing via port 22 and all outgoing",
             SecurityGroupIngress=[
                 troposphere.ec2.SecurityGroupRule(
@@ -148,7 +335,6 @@ def create_cloudformation(
             LaunchTemplateData=troposphere.ec2.LaunchTemplateData(
                 KeyName=key_name,
                 ImageId=ami_id,
-                InstanceType=instance_type,
                 UserData=troposphere.Base64(
                     # Sub is needed if we have variables
                     troposphere.Sub(
@@ -172,6 +358,18 @@ def create_cloudformation(
         )
     )
 
+    if allocation is not None:
+        _add_fleet(
+            t,
+            launch_template,
+            _as_list(security_group) or [troposphere.Ref(instance_security_group)],
+            instance_type,
+            subnet_id,
+            price,
+            allocation,
+        )
+        return t.to_json()
+
     if price:
         instance_market_options = troposphere.ec2.InstanceMarketOptions(
             MarketType="spot",
@@ -207,6 +405,9 @@ def create_cloudformation(
     ec2_instance = t.add_resource(
         troposphere.ec2.Instance(
             "TchoTchoInstance",
+            # on the instance a new type is an update with a stop and start,
+            # a change of the launch template replaces the instance
+            InstanceType=instance_type,
             LaunchTemplate=troposphere.ec2.LaunchTemplateSpecification(
                 LaunchTemplateId=troposphere.Ref(launch_template),
                 Version=troposphere.GetAtt(launch_template, "LatestVersionNumber"),
@@ -255,3 +456,83 @@ def create_cloudformation(
     # not parsed so the ec2instance ImageId other keys are not found
     # return t.to_yaml()
     return t.to_json()
+
+
+def _add_fleet(t, launch_template, security_groups, instance_types, subnets, price,
+               allocation):
+    """Launch the instance by an EC2 Fleet over the ranked pools
+
+    A fleet has no instance attributes, the stack waits for the signal of
+    its instance on a wait condition and only outputs the fleet id.
+    """
+    launch_template.properties["LaunchTemplateData"].properties[
+        "SecurityGroupIds"
+    ] = security_groups
+
+    overrides = []
+    # a lower priority is preferred by the prioritized strategies
+    for priority, inst in enumerate(instance_types):
+        for subnet in subnets or [None]:
+            override = {"InstanceType": inst, "Priority": float(priority)}
+            if subnet:
+                override["SubnetId"] = subnet
+            overrides.append(
+                troposphere.ec2.FleetLaunchTemplateOverridesRequest(**override)
+            )
+
+    market = "spot" if price else "on-demand"
+    fleet = troposphere.ec2.EC2Fleet(
+        "TchoTchoFleet",
+        Type=FLEET_TYPE,
+        TargetCapacitySpecification=troposphere.ec2.TargetCapacitySpecificationRequest(
+            TotalTargetCapacity=1, DefaultTargetCapacityType=market,
+        ),
+        LaunchTemplateConfigs=[
+            troposphere.ec2.FleetLaunchTemplateConfigRequest(
+                LaunchTemplateSpecification=(
+                    troposphere.ec2.FleetLaunchTemplateSpecificationRequest(
+                        LaunchTemplateId=troposphere.Ref(launch_template),
+                        Version=troposphere.GetAtt(
+                            launch_template, "LatestVersionNumber"
+                        ),
+                    )
+                ),
+                Overrides=overrides,
+            )
+        ],
+        ReplaceUnhealthyInstances=False,
+        TerminateInstancesWithExpiration=True,
+    )
+    if price:
+        fleet.SpotOptions = troposphere.ec2.SpotOptionsRequest(
+            AllocationStrategy=allocation,
+            InstanceInterruptionBehavior="terminate",
+            MaxTotalPrice=str(price),
+        )
+    else:
+        fleet.OnDemandOptions = troposphere.ec2.OnDemandOptionsRequest(
+            AllocationStrategy=(
+                "prioritized" if "prioritized" in allocation else "lowest-price"
+            ),
+        )
+    fleet = t.add_resource(fleet)
+
+    handle = t.add_resource(
+        troposphere.cloudformation.WaitConditionHandle("TchoTchoWaitHandle")
+    )
+    t.add_resource(
+        troposphere.cloudformation.WaitCondition(
+            "TchoTchoWaitCondition",
+            DependsOn=fleet.title,
+            Handle=troposphere.Ref(handle),
+            Timeout=str(WAIT_TIMEOUT),
+            Count=1,
+        )
+    )
+    t.add_output(
+        troposphere.Output(
+            "FleetId",
+            Description="Id of the EC2 Fleet of the instance",
+            Value=troposphere.Ref(fleet),
+        )
+    )
@@ -0,0 +1,78 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from tchotcho.analytics import spot_stats
+
+
+def history(points, product="Linux/UNIX"):
+    df = pd.DataFrame(points, columns=["region", "instance_type", "az", "ts", "price"])
+    for col in ("region", "instance_type", "az"):
+        df[col] = df[col].astype("category")
+    df["product"] = pd.Categorical([product] * len(df))
+    df["ts"] = pd.to_datetime(df["ts"], utc=True)
+    df["price"] = df["price"].astype(np.float32)
+    return df
+
+
+class TestSpotStats(unittest.TestCase):
+    def test_stats(self):
+        df = history(
+            [
+                # stable, always 0.2
+                ("eu-central-1", "g4dn.xlarge", "eu-central-1a", "2020-06-01 00:00", 0.2),
+                ("eu-central-1", "g4dn.xlarge", "eu-central-1a", "2020-06-01 12:00", 0.2),
+                # 0.1 for 6h, 0.5 for 18h
+                ("eu-central-1", "g4dn.xlarge", "eu-central-1b", "2020-06-01 00:00", 0.1),
+                ("eu-central-1", "g4dn.xlarge", "eu-central-1b", "2020-06-01 06:00", 0.5),
+            ]
+        )
+        ondemand = pd.DataFrame({"eu-central-1": [0.6]}, index=["g4dn.xlarge"])
+        ret = spot_stats(df, ondemand, window="3h", ratio=0.5, end="2020-06-02 00:00Z")
+
+        self.assertEqual(ret["az"].tolist(), ["eu-central-1a", "eu-central-1b"])
+        stable, jumpy = ret.iloc[0], ret.iloc[1]
+        self.assertEqual(stable["points"], 2)
+        self.assertAlmostEqual(stable["volatility"], 0)
+        self.assertAlmostEqual(stable["above_ratio"], 0)
+        self.assertAlmostEqual(stable["stability"], 1)
+
+        self.assertAlmostEqual(jumpy["mean"], (0.1 * 6 + 0.5 * 18) / 24, places=5)
+        self.assertAlmostEqual(jumpy["min"], 0.1, places=5)
+        self.assertAlmostEqual(jumpy["max"], 0.5, places=5)
+        self.assertAlmostEqual(jumpy["last"], 0.5, places=5)
+        # 0.5 > 0.5 * 0.6 for 18 of 24 hours
+        self.assertAlmostEqual(jumpy["above_ratio"], 0.75)
+        self.assertGreater(jumpy["volatility"], 0)
+        # only the last point is in the 3h window
+        self.assertAlmostEqual(jumpy["rolling_mean"], 0.5, places=5)
+
+    def test_without_ondemand(self):
+        df = history(
+            [("eu-central-1", "x", "eu-central-1a", "2020-06-01", 1.0)]
+        )
+        ret = spot_stats(df, end="2020-06-02 00:00Z")
+        self.assertTrue(np.isnan(ret["above_ratio"][0]))
+        self.assertAlmostEqual(ret["stability"][0], 1)
+        self.assertTrue(spot_stats(df.iloc[:0]).empty)
+
+    def test_products(self):
+        linux = history(
+            [
+                ("eu-central-1", "x", "eu-central-1a", "2020-06-01 00:00", 1.0),
+                ("eu-central-1", "x", "eu-central-1a", "2020-06-01 12:00", 1.0),
+            ]
+        )
+        vpc = history(
+            [("eu-central-1", "x", "eu-central-1a", "2020-06-01 06:00", 0.2)],
+            "Linux/UNIX (Amazon VPC)",
+        )
+        df = pd.concat([linux, vpc], ignore_index=True)
+        df["product"] = df["product"].astype("category")
+        ret = spot_stats(df, end="2020-06-02 00:00Z").set_index("product")
+        # the series of the products are not mixed
+        self.assertEqual(sorted(ret.index), ["Linux/UNIX", "Linux/UNIX (Amazon VPC)"])
+        self.assertAlmostEqual(ret.loc["Linux/UNIX", "mean"], 1.0, places=5)
+        self.assertAlmostEqual(ret.loc["Linux/UNIX", "volatility"], 0)
+        self.assertAlmostEqual(ret.loc["Linux/UNIX (Amazon VPC)", "mean"], 0.2, places=5)
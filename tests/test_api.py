@@ -1,8 +1,8 @@
 import unittest
 
 from moto import mock_ec2
-from tchotcho import (InfoManager, KeyManager, ShellManager, SpotManager,
-                      StackManager)
+from tchotcho import (InfoManager, KeyManager, PlacementManager, ShellManager,
+                      SpotManager, StackManager)
 
 
 @mock_ec2
@@ -14,3 +14,4 @@ class TestApi(unittest.TestCase):
         self.assertIsInstance(SpotManager(), SpotManager)
         self.assertIsInstance(InfoManager(), InfoManager)
         self.assertIsInstance(ShellManager(), ShellManager)
+        self.assertIsInstance(PlacementManager(), PlacementManager)
@@ -0,0 +1,166 @@
+import concurrent.futures
+import unittest
+from unittest import mock
+
+import botocore.exceptions
+from moto import mock_cloudformation, mock_ec2, mock_sts
+
+from tchotcho import aws
+from tchotcho.errors import AuthError, RequestError, ThrottledError, TransientError
+
+
+def client_error(code, status=400):
+    return botocore.exceptions.ClientError(
+        {"Error": {"Code": code, "Message": code},
+         "ResponseMetadata": {"HTTPStatusCode": status}},
+        "DescribeRegions",
+    )
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_acquire(self):
+        clock = FakeClock()
+        bucket = aws.TokenBucket(10, 2, clock=clock, sleep=clock.sleep)
+        # the burst is free, then one token every 1 / rate seconds
+        self.assertEqual([bucket.acquire() for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+
+    def test_adaptive(self):
+        clock = FakeClock()
+        bucket = aws.TokenBucket(16, 1, clock=clock, sleep=clock.sleep)
+        bucket.throttled()
+        bucket.throttled()
+        self.assertEqual(bucket.rate, 4)
+        for _ in range(100):
+            bucket.throttled()
+        self.assertEqual(bucket.rate, 1)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 2)
+        for _ in range(100):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 16)
+
+
+class TestCallPolicy(unittest.TestCase):
+    def setUp(self):
+        self.sleep = mock.Mock()
+        self.policy = aws.CallPolicy(
+            rate=1000, burst=1000, max_concurrency=2, max_attempts=3, sleep=self.sleep
+        )
+
+    def test_retry(self):
+        fn = mock.Mock(side_effect=[client_error("RequestLimitExceeded"),
+                                    client_error("InternalError", 500), "ok"])
+        self.assertEqual(self.policy.call("ec2", "eu-central-1", "Op", fn), "ok")
+        self.assertEqual(fn.call_count, 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        bucket, _ = self.policy.limits("ec2", "eu-central-1")
+        self.assertLess(bucket.rate, 1000)
+
+    def test_exhausted(self):
+        fn = mock.Mock(side_effect=client_error("Throttling"))
+        with self.assertRaises(ThrottledError) as ex:
+            self.policy.call("ec2", "eu-central-1", "Op", fn)
+        self.assertEqual(fn.call_count, 3)
+        self.assertEqual(ex.exception.code, "Throttling")
+        self.assertEqual(ex.exception.region, "eu-central-1")
+
+        fn = mock.Mock(side_effect=botocore.exceptions.EndpointConnectionError(
+            endpoint_url="https://ec2"))
+        with self.assertRaises(TransientError):
+            self.policy.call("ec2", "eu-central-1", "Op", fn)
+
+    def test_fatal(self):
+        for code, cls in (("UnauthorizedOperation", AuthError),
+                          ("InvalidParameterValue", RequestError)):
+            fn = mock.Mock(side_effect=client_error(code))
+            with self.assertRaises(cls):
+                self.policy.call("ec2", "eu-central-1", "Op", fn)
+            # fatal errors are not retried
+            self.assertEqual(fn.call_count, 1)
+
+    def test_client_error(self):
+        fn = mock.Mock(side_effect=client_error("ValidationError"))
+        with self.assertRaises(botocore.exceptions.ClientError) as ex:
+            self.policy.call("cloudformation", "eu-central-1", "Op", fn)
+        self.assertIsInstance(ex.exception, RequestError)
+        self.assertEqual(ex.exception.response["Error"]["Code"], "ValidationError")
+        self.assertEqual(ex.exception.code, "ValidationError")
+
+    def test_backoff(self):
+        for attempt in range(1, 20):
+            delay = self.policy.backoff(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, self.policy.backoff_max)
+
+
+@mock_ec2
+class TestClient(unittest.TestCase):
+    def test_instrument(self):
+        policy = aws.CallPolicy(rate=1000, burst=1000)
+        with mock.patch.object(aws, "_POOL", aws.ClientPool(policy=policy)), \
+                mock.patch.object(policy, "call", wraps=policy.call) as call:
+            ec2 = aws.client("ec2", "eu-central-1")
+            ec2.describe_regions()
+            # paginators use the same call layer
+            list(ec2.get_paginator("describe_instances").paginate())
+        self.assertEqual(
+            [x[0][:3] for x in call.call_args_list],
+            [("ec2", "eu-central-1", "DescribeRegions"),
+             ("ec2", "eu-central-1", "DescribeInstances")],
+        )
+
+    @mock_cloudformation
+    def test_waiter_error_acceptor(self):
+        policy = aws.CallPolicy(rate=1000, burst=1000)
+        cf = aws.ClientPool(policy=policy).client("cloudformation", "eu-central-1")
+        # the ValidationError of a missing stack is the success of the waiter
+        cf.get_waiter("stack_delete_complete").wait(
+            StackName="missing", WaiterConfig={"Delay": 0, "MaxAttempts": 1}
+        )
+
+
+@mock_sts
+@mock_ec2
+class TestClientPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = aws.ClientPool(policy=aws.CallPolicy(), max_pool_connections=4)
+        ec2 = pool.client("ec2", "eu-central-1")
+        self.assertIs(pool.client("ec2", "eu-central-1"), ec2)
+        self.assertIsNot(pool.client("ec2", "us-east-1"), ec2)
+        self.assertEqual(ec2.meta.config.max_pool_connections, 4)
+        ec2.describe_regions()
+        stats = pool.stats()
+        self.assertEqual(stats["clients"], 2)
+        self.assertEqual(stats["reused"], 1)
+        self.assertEqual(set(stats["per_client"]), {"ec2:eu-central-1", "ec2:us-east-1"})
+
+    def test_threads(self):
+        pool = aws.ClientPool(policy=aws.CallPolicy())
+        regions = ["eu-central-1", "us-east-1"] * 8
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            clients = list(executor.map(lambda x: pool.client("ec2", x), regions))
+        self.assertEqual(len(set(map(id, clients))), 2)
+        self.assertEqual(pool.stats()["reused"], 14)
+
+    def test_account(self):
+        pool = aws.ClientPool(policy=aws.CallPolicy())
+        with mock.patch.object(pool.policy, "call", wraps=pool.policy.call) as call:
+            self.assertEqual(pool.account(), "123456789012")
+            self.assertEqual(pool.account(), "123456789012")
+        # asked once per session
+        self.assertEqual(call.call_count, 1)
+        pool.clear()
+        self.assertIsNone(pool._account)
@@ -0,0 +1,120 @@
+import concurrent.futures
+import datetime
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import pytest
+
+from tchotcho import cache
+from tchotcho.__main__ import cli
+from tchotcho.cache import Cache
+from tchotcho.config import set_settings, Settings
+
+
+class TestCache(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        settings = Settings()
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        settings.PROG_HOME = self.tmp_dir
+        self.settings = set_settings(settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_set(self):
+        c = Cache("spot")
+        self.assertIsNone(c.get(["eu-central-1", ["g4dn.xlarge"]]))
+        ts = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+        value = [{"SpotPrice": 0.2, "Timestamp": ts}]
+        c.set(["eu-central-1", ["g4dn.xlarge"]], value)
+        self.assertEqual(c.get(["eu-central-1", ["g4dn.xlarge"]]), value)
+        # no temporary files are left
+        self.assertEqual([x.suffix for x in c.path.iterdir()], [".json"])
+
+        self.assertIsNone(Cache("spot", ttl=0).get(["eu-central-1", ["g4dn.xlarge"]]))
+        self.settings.CACHE_ENABLED = False
+        self.assertIsNone(Cache("spot").get(["eu-central-1", ["g4dn.xlarge"]]))
+
+    def test_get_or_set(self):
+        c = Cache("regions")
+        calls = []
+        lock = threading.Lock()
+
+        def fetch():
+            with lock:
+                calls.append(1)
+            time.sleep(0.05)
+            return ["eu-central-1"]
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            ret = list(executor.map(lambda _: c.get_or_set("all", fetch), range(8)))
+        self.assertEqual(ret, [["eu-central-1"]] * 8)
+        # waiting callers are served by the first one
+        self.assertEqual(len(calls), 1)
+
+    def test_evict(self):
+        c = Cache("ami")
+        for i in range(10):
+            c.set(i, "x" * 200)
+            # distinct modification times for the lru order
+            t = time.time() - 100 + i
+            cache.os.utime(c._file(i), (t, t))
+        c.get(0)
+        size = c._file(0).stat().st_size
+        # room for 4 entries, their sizes differ by a few bytes
+        c.max_bytes = 4 * size + 20
+        c.set(10, "x" * 200)
+        kept = [i for i in range(11) if c.get(i) is not None]
+        self.assertIn(0, kept)
+        self.assertIn(10, kept)
+        self.assertEqual(len(kept), 4)
+
+    def test_scan(self):
+        c = Cache("ami")
+        with mock.patch.object(Cache, "evict", autospec=True,
+                               side_effect=Cache.evict) as evict:
+            for i in range(cache.SCAN_EVERY + 1):
+                c.set(i, i)
+        # the first write and then every SCAN_EVERY writes
+        self.assertEqual(evict.call_count, 2)
+
+    def test_lock_files(self):
+        c = Cache("regions")
+        (c.path).mkdir(parents=True)
+        (c.path / "old.json.lock").touch()
+        for i in range(cache.LOCK_STRIPES * 2):
+            c.get_or_set(i, lambda: 1)
+        locks = list(c.path.glob("**/*.lock"))
+        self.assertLessEqual(len(locks), cache.LOCK_STRIPES)
+        # lock files of earlier versions are removed
+        self.assertNotIn(c.path / "old.json.lock", locks)
+        self.assertEqual(cache.namespaces()["regions"][0], cache.LOCK_STRIPES * 2)
+
+    def test_cli(self):
+        Cache("spot").set("a", 1)
+        Cache("keys").set("a", 1)
+        with pytest.raises(SystemExit) as ex:
+            cli(["cache", "list"])
+        self.assertEqual(ex.value.code, 0)
+        out = self.capsys.readouterr().out
+        self.assertIn("keys: 1 entries", out)
+        self.assertIn("spot: 1 entries", out)
+
+        with pytest.raises(SystemExit) as ex:
+            cli(["--invalidate", "spot", "cache", "list"])
+        out = self.capsys.readouterr().out
+        self.assertNotIn("spot", out)
+        self.assertIn("keys", out)
+
+        with pytest.raises(SystemExit) as ex:
+            cli(["cache", "clear"])
+        self.assertEqual(cache.namespaces(), {})
@@ -0,0 +1,93 @@
+import json
+import os
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from tchotcho import catalog
+
+GPU_INFO_FILE = pathlib.Path(__file__).absolute().parent / "gpu_info.json"
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        self.json_file = self.tmp_dir / "gpu_info.json"
+        shutil.copy(GPU_INFO_FILE, self.json_file)
+        with open(GPU_INFO_FILE) as f:
+            self.data = json.load(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        path = catalog.write(catalog.catalog_path(self.json_file), self.data)
+        self.assertEqual(path, self.tmp_dir / "gpu_info.cols")
+
+        cat = catalog.load(self.json_file)
+        self.assertEqual(len(cat), len(self.data["instance"]))
+        self.assertIsInstance(cat.column("gpu"), np.memmap)
+        self.assertEqual(cat.meta["ami"], self.data["ami"])
+
+        expected = pd.DataFrame(self.data["instance"])
+        df = cat.to_frame()
+        self.assertEqual(df["name"].tolist(), expected["name"].tolist())
+        self.assertNotIn("pricing", df.columns)
+        self.assertEqual(df["supported"].tolist(), expected["supported"].tolist())
+        # missing str values stay missing, not ""
+        self.assertTrue(expected["gpu_model"].isna().any())
+        pd.testing.assert_series_equal(
+            df["gpu_model"].isna(), expected["gpu_model"].isna()
+        )
+        self.assertNotIn("", df["gpu_model"].tolist())
+
+        # pricing is a dense (instance x region) matrix
+        prices = cat.prices()
+        self.assertEqual(prices.shape, (len(expected), 17))
+        self.assertEqual(prices.loc[0, "eu-central-1"], 0.772)
+        pd.testing.assert_frame_equal(prices, catalog.prices(self.data))
+
+        # only the requested columns are loaded
+        df = catalog.read_instances(self.json_file, ["name", "gpu"])
+        self.assertEqual(list(df.columns), ["name", "gpu"])
+        cat = catalog.load(self.json_file)
+        cat.to_frame(["name", "gpu"])
+        self.assertEqual(sorted(cat._cache), ["gpu", "name"])
+        cat = catalog.load(self.json_file)
+        data = cat.to_dict(["name", "gpu"])
+        self.assertEqual(list(data["instance"].columns), ["name", "gpu"])
+        self.assertNotIn("storage", cat._cache)
+
+    def test_cheapest(self):
+        prices = catalog.price_frame(
+            [{"a": 2.0, "b": 1.0}, {"a": None, "b": None}, {"a": 0.5}]
+        )
+        region, price = catalog.cheapest(prices)
+        self.assertEqual(region[[0, 2]].tolist(), ["b", "a"])
+        self.assertTrue(region.isna()[1])
+        self.assertEqual(price.fillna(-1).tolist(), [1.0, -1, 0.5])
+
+    def test_fallback_json(self):
+        # no catalog
+        self.assertIsNone(catalog.load(self.json_file))
+        self.assertEqual(catalog.read(self.json_file), self.data)
+
+        # catalog is older than the json file
+        path = catalog.write(catalog.catalog_path(self.json_file), self.data)
+        meta = path / catalog.META_FILE
+        mtime = meta.stat().st_mtime
+        os.utime(meta, (mtime - 10, mtime - 10))
+        self.assertIsNone(catalog.load(self.json_file))
+
+    def test_schema_version(self):
+        path = catalog.write(catalog.catalog_path(self.json_file), self.data)
+        with open(path / catalog.META_FILE) as f:
+            meta = json.load(f)
+        meta["schema_version"] = 0
+        with open(path / catalog.META_FILE, "w") as f:
+            json.dump(meta, f)
+        self.assertIsNone(catalog.load(self.json_file))
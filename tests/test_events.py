@@ -0,0 +1,163 @@
+import datetime
+import json
+import pathlib
+import tempfile
+import unittest
+from unittest import mock
+
+from moto import mock_cloudformation, mock_sts
+
+from tchotcho import aws, events
+from tchotcho.action.stack import StackManager
+from tchotcho.config import set_settings, Settings
+from tchotcho.events import StackEvents, StackProgress
+
+T0 = datetime.datetime(2020, 6, 1, tzinfo=datetime.timezone.utc)
+TEMPLATE = {
+    "Resources": {
+        "Group": {
+            "Type": "AWS::EC2::SecurityGroup",
+            "Properties": {"GroupDescription": "test"},
+        }
+    },
+    "Outputs": {"Group": {"Value": {"Ref": "Group"}}},
+}
+
+
+def event(i, resource, status, seconds, type="AWS::EC2::Instance"):
+    return {
+        "EventId": f"e{i}",
+        "StackName": "test",
+        "LogicalResourceId": resource,
+        "ResourceType": type,
+        "ResourceStatus": status,
+        "Timestamp": T0 + datetime.timedelta(seconds=seconds),
+    }
+
+
+class FakeEvents(object):
+    """Returns one batch of new events per poll"""
+
+    def __init__(self, batches):
+        self.stack_id = "arn:test"
+        self.batches = iter(batches)
+
+    def new_events(self):
+        return next(self.batches)
+
+
+class TestStackEvents(unittest.TestCase):
+    def test_new_events(self):
+        history = [event(0, "test", "CREATE_IN_PROGRESS", 0, events.STACK_TYPE)]
+        cf = mock.Mock()
+
+        def paginate(StackName):
+            # newest first, two events per page
+            newest = history[::-1]
+            return [{"StackEvents": newest[i : i + 2]} for i in range(0, len(newest), 2)]
+
+        cf.get_paginator.return_value.paginate.side_effect = paginate
+        tail = StackEvents(cf, "arn:test")
+        self.assertEqual([x["EventId"] for x in tail.new_events()], ["e0"])
+        self.assertEqual(tail.new_events(), [])
+        history.extend(event(i, "Instance", "CREATE_IN_PROGRESS", i) for i in range(1, 5))
+        self.assertEqual(
+            [x["EventId"] for x in tail.new_events()], ["e1", "e2", "e3", "e4"]
+        )
+        self.assertEqual(tail.last_event_id, "e4")
+
+
+class TestStackProgress(unittest.TestCase):
+    def test_follow(self):
+        batches = [
+            [event(0, "test", "CREATE_IN_PROGRESS", 0, events.STACK_TYPE),
+             event(1, "Instance", "CREATE_IN_PROGRESS", 1)],
+            [],
+            [],
+            [event(2, "Instance", "CREATE_COMPLETE", 95)],
+            [event(3, "test", "CREATE_COMPLETE", 96, events.STACK_TYPE)],
+            # never polled, the stack is done
+            [event(4, "test", "DELETE_IN_PROGRESS", 97, events.STACK_TYPE)],
+        ]
+        sleep = mock.Mock()
+        progress = StackProgress(FakeEvents(batches), sleep=sleep)
+        ret = list(progress.follow())
+        self.assertEqual(progress.status, "CREATE_COMPLETE")
+        self.assertEqual(len(ret), 4)
+        self.assertEqual(ret[2]["resource"], "Instance")
+        self.assertEqual(ret[2]["duration"], 94)
+        self.assertEqual(ret[3]["duration"], 96)
+        # the interval grows while nothing happens and drops on new events
+        self.assertEqual([x[0][0] for x in sleep.call_args_list], [1, 1.5, 2.25, 1])
+
+    def test_stop(self):
+        batches = [[event(0, "test", "CREATE_IN_PROGRESS", 0, events.STACK_TYPE)], [], []]
+        progress = StackProgress(FakeEvents(batches), sleep=mock.Mock())
+        polls = []
+        ret = list(progress.follow(stop=lambda: polls.append(1) or len(polls) == 2))
+        self.assertEqual(len(ret), 1)
+        self.assertEqual(progress.status, "CREATE_IN_PROGRESS")
+
+    def test_timeout(self):
+        batches = [[event(0, "test", "CREATE_IN_PROGRESS", 0, events.STACK_TYPE)]]
+        batches += [[]] * 10
+        now = [0]
+        sleep = mock.Mock(side_effect=lambda x: now.__setitem__(0, now[0] + x))
+        progress = StackProgress(FakeEvents(batches), sleep=sleep, clock=lambda: now[0])
+        with self.assertRaises(TimeoutError):
+            list(progress.follow(timeout=5))
+        # the last sleep ends at the deadline
+        self.assertEqual(now[0], 5)
+        self.assertEqual(progress.status, "CREATE_IN_PROGRESS")
+
+    def test_capacity_failure(self):
+        record = {"status": "CREATE_FAILED", "reason": "Error Code: InsufficientInstanceCapacity"}
+        self.assertTrue(events.is_capacity_failure(record))
+        self.assertFalse(events.is_capacity_failure(dict(record, reason="AccessDenied")))
+        self.assertFalse(events.is_capacity_failure(dict(record, status="CREATE_IN_PROGRESS")))
+        self.assertFalse(events.is_capacity_failure(dict(record, reason=None)))
+        # error codes match as a whole, not as part of another code or word
+        for reason in [
+            "Error Code: InsufficientInstanceCapacityUnknown",
+            "(Service: AmazonEC2; Error Code: UnsupportedOperation)",
+            "Unsupported property VolumeType",
+        ]:
+            self.assertFalse(events.is_capacity_failure(dict(record, reason=reason)))
+        for reason in [
+            "(Service: AmazonEC2; Error Code: Unsupported; Request ID: 1)",
+            "Spot request status capacity-not-available",
+        ]:
+            self.assertTrue(events.is_capacity_failure(dict(record, reason=reason)))
+
+
+@mock_sts
+@mock_cloudformation
+class TestStackManagerEvents(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+        self.sleep = mock.patch.object(events.time, "sleep")
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_follow_delete(self):
+        mgr = StackManager()
+        stack_id = mgr.cf.create_stack(StackName="test", TemplateBody=json.dumps(TEMPLATE))
+        self.assertEqual(mgr.follow(stack_id["StackId"]), "CREATE_COMPLETE")
+        self.assertEqual(mgr.events[-1]["status"], "CREATE_COMPLETE")
+
+        mgr.delete("test")
+        # only the events of the delete are followed
+        self.assertEqual(
+            [x["status"] for x in mgr.events], ["DELETE_IN_PROGRESS", "DELETE_COMPLETE"]
+        )
+        self.assertFalse(mgr.stack_exists("test"))
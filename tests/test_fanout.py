@@ -0,0 +1,40 @@
+import threading
+import time
+import unittest
+
+from tchotcho.fanout import fan_out
+
+
+class TestFanOut(unittest.TestCase):
+    def test_serial(self):
+        ret = list(fan_out(lambda x: x * 2, [3, 1, 2], method="serial"))
+        self.assertEqual(ret, [6, 2, 4])
+
+    def test_thread_as_completed(self):
+        def fn(x):
+            time.sleep(x)
+            return x
+
+        ret = list(fan_out(fn, [0.2, 0.0, 0.1], max_workers=3))
+        self.assertEqual(ret, [0.0, 0.1, 0.2])
+
+    def test_thread_max_workers(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def fn(x):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return x
+
+        ret = list(fan_out(fn, range(20), max_workers=3))
+        self.assertEqual(sorted(ret), list(range(20)))
+        self.assertLessEqual(running[1], 3)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            list(fan_out(str, [1], method="future-process"))
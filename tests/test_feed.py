@@ -0,0 +1,86 @@
+import gzip
+import http.server
+import json
+import pathlib
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tchotcho import feed
+
+INSTANCES = pathlib.Path(__file__).absolute().parent / "instances-slim.json"
+
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    etag = '"instances-slim"'
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        with open(INSTANCES, "rb") as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        ...
+
+
+class TestFeed(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+        cls.server.requests = []
+        cls.url = "http://127.0.0.1:%s/instances.json" % cls.server.server_port
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests.clear()
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        self.path = self.tmp_dir / "instances.json.gz"
+        with open(INSTANCES) as f:
+            self.expected = json.load(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_iter_json_array(self):
+        with open(INSTANCES, "rb") as f:
+            data = f.read()
+        # odd chunk size to split elements and multibyte chars
+        chunks = (data[i : i + 7] for i in range(0, len(data), 7))
+        ret = list(feed.iter_json_array(chunks))
+        self.assertEqual(len(ret), len(self.expected))
+        self.assertTrue(set(ret[0]) <= set(feed.INSTANCE_FIELDS))
+        self.assertNotIn("ECU", ret[0])
+        self.assertEqual(ret[0]["instance_type"], self.expected[0]["instance_type"])
+        self.assertNotIn("reserved", ret[0]["pricing"]["eu-central-1"]["linux"])
+
+    def test_iter_json_array_invalid(self):
+        with self.assertRaises(ValueError):
+            list(feed.iter_json_array([b'[{"a": 1}, {"b": ']))
+
+    def test_conditional(self):
+        ret = list(feed.iter_instances(self.url, self.path))
+        self.assertEqual(len(ret), len(self.expected))
+        self.assertNotIn("If-None-Match", self.server.requests[0])
+        self.assertEqual(feed.read_meta(self.path)["etag"], FeedHandler.etag)
+        with gzip.open(self.path) as f:
+            self.assertEqual(json.load(f), self.expected)
+
+        # second fetch is not modified and served from the local copy
+        ret = list(feed.iter_instances(self.url, self.path))
+        self.assertEqual(len(ret), len(self.expected))
+        self.assertEqual(self.server.requests[1]["If-None-Match"], FeedHandler.etag)
@@ -0,0 +1,119 @@
+import datetime
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from tchotcho.action.spot import SpotManager
+from tchotcho.config import set_settings, Settings
+from tchotcho.history import SpotHistoryStore
+
+UTC = datetime.timezone.utc
+
+
+def record(inst, az, ts, price):
+    return {
+        "AvailabilityZone": az,
+        "InstanceType": inst,
+        "ProductDescription": "Linux/UNIX",
+        "SpotPrice": price,
+        "Timestamp": ts,
+    }
+
+
+class TestSpotHistoryStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        self.store = SpotHistoryStore(self.tmp_dir / "spot.sqlite")
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_append_query(self):
+        t0 = datetime.datetime(2020, 6, 1, tzinfo=UTC)
+        records = [
+            record("g4dn.xlarge", "eu-central-1a", t0 + datetime.timedelta(hours=x), "0.2")
+            for x in range(10)
+        ]
+        records.append(record("p3.2xlarge", "eu-central-1b", t0, "1.1"))
+        self.assertEqual(self.store.append("eu-central-1", records), 11)
+        # duplicates are ignored
+        self.assertEqual(self.store.append("eu-central-1", records[-3:]), 0)
+
+        last = self.store.last_timestamps("eu-central-1")
+        self.assertEqual(
+            last[("g4dn.xlarge", "eu-central-1a")],
+            int((t0 + datetime.timedelta(hours=9)).timestamp()),
+        )
+
+        df = self.store.query(
+            instance_types=["g4dn.xlarge"], start=t0 + datetime.timedelta(hours=5)
+        )
+        self.assertEqual(len(df), 5)
+        self.assertEqual(df["price"].dtype, np.float32)
+        self.assertEqual(df["instance_type"].dtype, "category")
+        self.assertEqual(df["ts"].iloc[0], t0 + datetime.timedelta(hours=5))
+
+        self.assertEqual(len(self.store.query(region="us-east-1")), 0)
+
+        latest = self.store.latest("eu-central-1", ["g4dn.xlarge", "p3.2xlarge"])
+        self.assertEqual(
+            latest[["instance_type", "ts"]].values.tolist(),
+            [
+                ["g4dn.xlarge", t0 + datetime.timedelta(hours=9)],
+                ["p3.2xlarge", t0],
+            ],
+        )
+
+
+class TestSpotSync(unittest.TestCase):
+    def setUp(self):
+        settings = Settings()
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        settings.PROG_HOME = self.tmp_dir
+        set_settings(settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_incremental(self):
+        now = datetime.datetime.now(UTC).replace(microsecond=0)
+        points = [record("g4dn.xlarge", "eu-central-1a", now, "0.2")]
+
+        ec2 = mock.Mock()
+        ec2.get_paginator.return_value.paginate.side_effect = lambda **kw: [
+            {"SpotPriceHistory": list(points)}
+        ]
+        mgr = SpotManager()
+        mgr._client = mock.Mock(return_value=ec2)
+        offerings = {"eu-central-1": {"eu-central-1a": ["g4dn.xlarge", "p3.2xlarge"]}}
+
+        with mock.patch.object(mgr.inventory, "offerings", return_value=offerings), \
+                mock.patch.object(mgr.inventory, "enabled_regions",
+                                  return_value=["eu-central-1"]):
+            ret = mgr.sync(False, inst=["g4dn.xlarge"], days=3)
+            self.assertEqual(ret, {"eu-central-1": 1})
+            kwargs = ec2.get_paginator.return_value.paginate.call_args[1]
+            self.assertEqual(kwargs["AvailabilityZone"], "eu-central-1a")
+            self.assertEqual(kwargs["InstanceTypes"], ["g4dn.xlarge"])
+            self.assertLess(kwargs["StartTime"], now - datetime.timedelta(days=2))
+
+            # only new points are fetched
+            points.append(
+                record("g4dn.xlarge", "eu-central-1a", now + datetime.timedelta(1), "0.3")
+            )
+            ret = mgr.sync(False, inst=["g4dn.xlarge"])
+            self.assertEqual(ret, {"eu-central-1": 1})
+            kwargs = ec2.get_paginator.return_value.paginate.call_args[1]
+            self.assertEqual(kwargs["StartTime"], now)
+
+        df = mgr.history(inst=["g4dn.xlarge"])
+        self.assertEqual(df["price"].tolist(), [np.float32(0.2), np.float32(0.3)])
+
+        df = mgr.current_prices(["g4dn.xlarge"], cached=True)
+        self.assertEqual(df.values.tolist(), [["eu-central-1", "g4dn.xlarge",
+                                               "eu-central-1a", 0.3]])
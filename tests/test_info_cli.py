@@ -1,5 +1,5 @@
 import pathlib
-import json
+import shutil
 import tempfile
 import unittest
 import unittest.mock
@@ -7,9 +7,11 @@ import unittest.mock
 import pytest
 
 # from click.testing import CliRunner
-from moto import mock_ec2
+from moto import mock_ec2, mock_sts
+from tchotcho import catalog
 from tchotcho.config import set_settings, Settings
 from tchotcho.__main__ import cli
+from tchotcho.action.info import InfoManager
 
 HERE = pathlib.Path(__file__).absolute().parent
 
@@ -19,18 +21,30 @@ INSTANCES = HERE / "instances-slim.json"
 
 def mocked_requests_get(*args, **kwargs):
     class MockResponse:
-        def __init__(self, json_data, status_code):
-            self.json_data = json_data
+        def __init__(self, data, status_code):
+            self.data = data
             self.status_code = status_code
+            self.headers = {"ETag": '"slim"'}
 
-        def json(self):
-            return self.json_data
+        def __enter__(self):
+            return self
 
-    with open(INSTANCES, "r") as f:
-        data = json.load(f)
+        def __exit__(self, *args):
+            ...
+
+        def raise_for_status(self):
+            ...
+
+        def iter_content(self, chunk_size):
+            for i in range(0, len(self.data), chunk_size):
+                yield self.data[i : i + chunk_size]
+
+    with open(INSTANCES, "rb") as f:
+        data = f.read()
     return MockResponse(data, 200)
 
 
+@mock_sts
 @mock_ec2
 class TestInfoKey(unittest.TestCase):
     @pytest.fixture(autouse=True)
@@ -42,15 +56,24 @@ class TestInfoKey(unittest.TestCase):
 
         # reset moto or we have to many keys
         requests.post("http://motoapi.amazonaws.com/moto-api/reset")
+        # the cache must not serve moto answers to real runs
+        self.tmp_dir = tempfile.TemporaryDirectory()
         settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
         settings.GPU_INFO_FILE = GPU_INFO_FILE
         set_settings(settings)
 
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
     @unittest.mock.patch("requests.get", side_effect=mocked_requests_get)
     def test_create(self, mock_get):
-        with tempfile.NamedTemporaryFile() as tmp_gpu_info:
+        with tempfile.NamedTemporaryFile() as tmp_gpu_info, \
+                tempfile.TemporaryDirectory() as tmp_dir:
             settings = Settings()
+            settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
             settings.GPU_INFO_FILE = tmp_gpu_info.name
+            settings.INSTANCES_FILE = pathlib.Path(tmp_dir) / "instances.json.gz"
             set_settings(settings)
 
             with pytest.raises(SystemExit) as ex:
@@ -72,6 +95,16 @@ class TestInfoKey(unittest.TestCase):
             out, err = self.capsys.readouterr()
             self.assertTrue("p2.8xlarge,8,,96,NVIDIA Tesla K80,3.7,,32,488.0,True" in out)
 
+            # list is served from the columnar catalog
+            cols = catalog.catalog_path(tmp_gpu_info.name)
+            self.addCleanup(shutil.rmtree, cols)
+            self.assertTrue(catalog.load(tmp_gpu_info.name))
+            with pytest.raises(SystemExit) as ex:
+                cli(["info", "list", "--region", "us-east-2", "--csv"])
+            self.assertEqual(ex.value.code, 0)
+            out, err = self.capsys.readouterr()
+            self.assertTrue("p2.8xlarge,8,,96,NVIDIA Tesla K80,3.7,,32,488.0,True" in out)
+
     def test_list(self):
         with pytest.raises(SystemExit) as ex:
             cli(["info", "list", "--region", "eu-central-1", "--csv"])
@@ -85,3 +118,88 @@ class TestInfoKey(unittest.TestCase):
         self.assertEqual(ex.value.code, 0)
         out, err = self.capsys.readouterr()
         self.assertTrue("\x1b[43m2.85\x1b[49m" in out)
+
+    def test_list_regions(self):
+        with pytest.raises(SystemExit) as ex:
+            cli(
+                [
+                    "info", "list", "--region", "eu-central-1", "--region",
+                    "us-east-1", "--cheapest", "--sort", "price", "--csv",
+                ]
+            )
+        self.assertEqual(ex.value.code, 0)
+        out, err = self.capsys.readouterr()
+        lines = out.split("\n")
+        self.assertTrue(
+            lines[0].endswith("eu-central-1,us-east-1,cheapest_region,cheapest_price")
+        )
+        # sorted by price in the first region
+        self.assertTrue(lines[1].startswith("3,t2.medium,0,"), lines[1])
+        self.assertTrue(lines[2].startswith("0,g2.2xlarge,1,"), lines[2])
+        self.assertTrue(lines[2].endswith(",0.772,0.65,us-east-1,0.65"), lines[2])
+
+    def test_query(self):
+        with pytest.raises(SystemExit) as ex:
+            cli(
+                [
+                    "info", "query", "--region", "eu-central-1", "--min-cpu", "16",
+                    "--names",
+                ]
+            )
+        self.assertEqual(ex.value.code, 0)
+        out, err = self.capsys.readouterr()
+        self.assertEqual(out, "g3.8xlarge\n")
+
+    def test_ami(self):
+        with pytest.raises(SystemExit) as ex:
+            cli(["info", "ami", "--region", "eu-central-1"])
+        self.assertEqual(ex.value.code, 0)
+        out, err = self.capsys.readouterr()
+        self.assertEqual(out, "ami-062a3145bcf312c71\n")
+
+
+class TestInfoAmi(unittest.TestCase):
+    def setUp(self):
+        settings = Settings()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        set_settings(settings)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_filter_pairs(self):
+        pairs = InfoManager._filter_pairs("1", ["a*", "b*"])
+        self.assertEqual(pairs, [("1", "a*"), ("1", "b*")])
+        with self.assertRaises(ValueError):
+            InfoManager._filter_pairs(["1", "2"], ["a*", "b*", "c*"])
+
+    def test_get_ami_paginated(self):
+        pages = [
+            {
+                "Images": [
+                    {
+                        "Name": f"img-{p}-{i}",
+                        "ImageId": f"ami-{p}{i}",
+                        "CreationDate": f"2020-0{p + 1}-0{i + 1}T10:00:00.000Z",
+                    }
+                    for i in range(3)
+                ]
+            }
+            for p in range(3)
+        ]
+        ec2 = unittest.mock.Mock()
+        ec2.can_paginate.return_value = True
+        ec2.get_paginator.return_value.paginate.return_value = pages
+
+        mgr = InfoManager()
+        mgr._client = unittest.mock.Mock(return_value=ec2)
+        ret = mgr._get_ami("eu-central-1", [("1", "img*")], 2)
+        self.assertEqual([x["ami"] for x in ret], ["ami-22", "ami-21"])
+        index = mgr.ami_index(ret)
+        self.assertEqual(index["eu-central-1"]["img*"]["ami"], "ami-22")
+
+        # served from the ami cache
+        mgr._client.reset_mock()
+        self.assertEqual(mgr._get_ami("eu-central-1", [("1", "img*")], 2), ret)
+        self.assertFalse(mgr._client.called)
@@ -6,13 +6,14 @@ import pytest
 
 # from click.testing import CliRunner
 
-from moto import mock_ec2
+from moto import mock_ec2, mock_sts
 from tchotcho.config import set_settings, Settings
 from tchotcho.__main__ import cli
 
 IMPORT_KEY = pathlib.Path(__file__).absolute().parent / "dummy.pub"
 
 
+@mock_sts
 @mock_ec2
 class TestCliKey(unittest.TestCase):
     @pytest.fixture(autouse=True)
@@ -44,7 +45,7 @@ class TestCliKey(unittest.TestCase):
         out, err = self.capsys.readouterr()
         self.assertEqual(out, "Succesfully created key test-key\n")
         self.assertEqual(
-            sorted([x.name for x in self.tmp_dir.iterdir()]),
+            sorted([x.name for x in self.tmp_dir.iterdir() if x.is_file()]),
             ["test-key", "test-key.pub"],
         )
 
@@ -0,0 +1,37 @@
+import subprocess
+import sys
+import unittest
+
+# modules that must not be imported to run a light command
+HEAVY = ("pandas", "boto3", "botocore", "troposphere", "awacs", "Crypto", "tabulate")
+
+SCRIPT = """
+import sys
+from tchotcho.__main__ import cli
+try:
+    cli(%r)
+except SystemExit:
+    pass
+print("loaded:" + ",".join(sorted(set(sys.modules) & set(%r))))
+"""
+
+
+class TestStartup(unittest.TestCase):
+    def _loaded(self, args):
+        proc = subprocess.run(
+            [sys.executable, "-c", SCRIPT % (args, HEAVY)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        return proc.stdout.split("loaded:")[-1].strip()
+
+    def test_help(self):
+        self.assertEqual(self._loaded(["--help"]), "")
+
+    def test_shell(self):
+        self.assertEqual(self._loaded(["shell", "ssh", "--help"]), "")
+
+    def test_info(self):
+        self.assertIn("pandas", self._loaded(["info", "list", "--help"]))
@@ -0,0 +1,137 @@
+import json
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_ec2, mock_sts
+
+from tchotcho import catalog, placement
+from tchotcho.__main__ import cli
+from tchotcho.action.info import InfoManager
+from tchotcho.action.place import PlacementManager
+from tchotcho.action.spot import SpotManager
+from tchotcho.config import set_settings, Settings
+from tchotcho.query import InstanceIndex
+
+INSTANCES = pathlib.Path(__file__).absolute().parent / "instances-slim.json"
+
+SPOT = pd.DataFrame(
+    [
+        ("eu-central-1", "g4dn.12xlarge", "eu-central-1a", 1.6),
+        ("eu-central-1", "g4dn.12xlarge", "eu-central-1b", 1.4),
+        ("eu-central-1", "g3.16xlarge", "eu-central-1a", 1.7),
+        ("eu-central-1", "p3.8xlarge", "eu-central-1a", 4.6),
+        ("eu-central-1", "g4dn.xlarge", "eu-central-1a", 0.2),
+        ("eu-central-1", "unknown.xlarge", "eu-central-1a", 0.1),
+    ],
+    columns=["region", "instance_type", "az", "price"],
+)
+
+
+class TestPlacement(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    @classmethod
+    def setUpClass(cls):
+        with open(INSTANCES) as f:
+            instances = [InfoManager._parse_instance(x) for x in json.load(f)]
+        ami = [
+            {
+                "region": "eu-central-1",
+                "name": "ubuntu",
+                "date": "2020-06-01T00:00:00.000Z",
+                "ami": "ami-12345678",
+                "filter": "ubuntu*",
+            }
+        ]
+        cls.data = {"instance": instances, "ami": ami}
+
+    def setUp(self):
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        self.index = InstanceIndex.from_data(self.data, catalog.prices(self.data))
+        settings = Settings()
+        settings.PROG_HOME = self.tmp_dir
+        settings.GPU_INFO_FILE = self.tmp_dir / "gpu_info.json"
+        set_settings(settings)
+        with open(settings.GPU_INFO_FILE, "w") as f:
+            json.dump(self.data, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_spot(self):
+        ret = placement.solve(self.index, SPOT, gpus=4, gpu_memory=64)
+        # g3.16xlarge has only 32 GB, unknown types are not in the catalog
+        self.assertEqual(
+            ret[["name", "az"]].values.tolist(),
+            [
+                ["g4dn.12xlarge", "eu-central-1b"],
+                ["g4dn.12xlarge", "eu-central-1a"],
+                ["p3.8xlarge", "eu-central-1a"],
+            ],
+        )
+        self.assertAlmostEqual(ret["price_per_gpu"][0], 1.4 / 4)
+        self.assertAlmostEqual(ret["price_per_gpu_gb"][0], 1.4 / 64)
+        ret = placement.solve(self.index, SPOT, gpus=4, gpu_memory=64, budget=1.5)
+        self.assertEqual(ret["name"].tolist(), ["g4dn.12xlarge"])
+
+    def test_ondemand(self):
+        ret = placement.solve(
+            self.index, market="ondemand", gpus=4, min_compute_capability=7,
+            regions=["eu-central-1"], top=2,
+        )
+        self.assertEqual(ret["name"].tolist(), ["g4dn.12xlarge", "p3.16xlarge"])
+        self.assertTrue((ret["az"] == "").all())
+        self.assertTrue((ret["region"] == "eu-central-1").all())
+        with self.assertRaises(ValueError):
+            placement.solve(self.index, market="reserved")
+
+    @mock_sts
+    @mock_ec2
+    @patch.object(SpotManager, "current_prices", return_value=SPOT)
+    def test_manager(self, mocked_method):
+        mgr = PlacementManager()
+        ret = mgr.solve(gpus=4, gpu_memory=64, top=1)
+        names = mocked_method.call_args[0][0]
+        self.assertIn("p3.8xlarge", names)
+        self.assertNotIn("g3.16xlarge", names)
+        self.assertEqual(ret["ami"].tolist(), ["ami-12345678"])
+        self.assertAlmostEqual(ret["ondemand"][0], 4.89)
+        args = mgr.stack_args(ret.iloc[0])
+        subnet = boto3.client("ec2").describe_subnets(SubnetIds=[args.pop("subnet")])
+        # launched in the ranked zone, bidding the on demand price
+        self.assertEqual(subnet["Subnets"][0]["AvailabilityZone"], "eu-central-1b")
+        self.assertEqual(
+            args,
+            {
+                "region": "eu-central-1",
+                "ami": "ami-12345678",
+                "inst": "g4dn.12xlarge",
+                "price": 4.89,
+            },
+        )
+        row = ret.iloc[0].copy()
+        row["ondemand"] = float("nan")
+        self.assertAlmostEqual(mgr.stack_args(row)["price"], 1.75)
+        row["az"] = "eu-central-1x"
+        with self.assertRaises(ValueError):
+            mgr.stack_args(row)
+        row["market"] = "ondemand"
+        self.assertNotIn("price", mgr.stack_args(row))
+
+    @patch.object(SpotManager, "current_prices", return_value=SPOT)
+    def test_cli(self, mocked_method):
+        with pytest.raises(SystemExit) as ex:
+            cli(["place", "--gpus", "4", "--cached", "--csv"])
+        self.assertEqual(ex.value.code, 0)
+        self.assertTrue(mocked_method.call_args[1]["cached"])
+        out = self.capsys.readouterr().out
+        self.assertTrue(out.startswith("name,region,az,market,price"))
+        self.assertIn("g4dn.12xlarge,eu-central-1,eu-central-1b,spot,1.4", out)
@@ -0,0 +1,65 @@
+import json
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+
+from tchotcho import catalog
+from tchotcho.action.info import InfoManager
+from tchotcho.query import InstanceIndex
+
+INSTANCES = pathlib.Path(__file__).absolute().parent / "instances-slim.json"
+
+
+class TestQuery(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(INSTANCES) as f:
+            instances = [InfoManager._parse_instance(x) for x in json.load(f)]
+        cls.data = {"instance": instances, "ami": []}
+        cls.df = pd.DataFrame(instances)
+        cls.df["price"] = [x["pricing"].get("eu-central-1") for x in instances]
+
+    def setUp(self):
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        self.index = InstanceIndex.from_data(self.data, catalog.prices(self.data))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_filters(self):
+        df = self.df
+        ret = self.index.query(
+            "eu-central-1", min_gpu_memory=16, min_cpu=8, max_memory=300, supported=True
+        )
+        expected = df[
+            (df.gpu > 0)
+            & (df.gpu_memory >= 16)
+            & (df.cpu >= 8)
+            & (df.memory <= 300)
+            & df.supported
+        ]
+        self.assertEqual(sorted(ret["name"]), sorted(expected["name"]))
+        per_gpu = ret["price_per_gpu"].dropna().tolist()
+        self.assertEqual(per_gpu, sorted(per_gpu))
+
+    def test_model_price_top(self):
+        ret = self.index.query("eu-central-1", gpu_model="v100", max_price=15)
+        self.assertTrue(len(ret))
+        self.assertTrue(ret["gpu_model"].str.contains("V100").all())
+        self.assertTrue((ret["price"] <= 15).all())
+
+        top = self.index.query("eu-central-1", top_k=3)
+        ranked = self.index.query("eu-central-1")
+        self.assertEqual(top["name"].tolist(), ranked["name"].tolist()[:3])
+
+    def test_catalog_index(self):
+        path = catalog.write(self.tmp_dir / "gpu_info.cols", self.data)
+        index = catalog.Catalog(path).index()
+        kwargs = {"min_compute_capability": 7, "top_k": 5}
+        pd.testing.assert_frame_equal(
+            index.query("eu-central-1", **kwargs),
+            self.index.query("eu-central-1", **kwargs),
+        )
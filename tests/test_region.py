@@ -0,0 +1,56 @@
+import pathlib
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_ec2, mock_sts
+
+from tchotcho.config import set_settings, Settings
+from tchotcho.region import RegionInventory
+
+
+@mock_sts
+@mock_ec2
+class TestRegionInventory(unittest.TestCase):
+    def setUp(self):
+        settings = Settings()
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        settings.PROG_HOME = self.tmp_dir
+        set_settings(settings)
+        self.clients = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _client(self, region):
+        self.clients.append(region)
+        return boto3.client("ec2", region_name=region)
+
+    def test_regions(self):
+        inv = RegionInventory(self._client)
+        regions = inv.regions()
+        self.assertTrue(all("OptInStatus" in x for x in regions))
+        self.assertIn("eu-central-1", inv.enabled_regions())
+        self.assertTrue(any((self.tmp_dir / "cache" / "regions").glob("*.json")))
+
+        # served from the cache
+        self.clients.clear()
+        self.assertEqual(RegionInventory(self._client).regions(), regions)
+        self.assertEqual(self.clients, [])
+
+        # expired
+        RegionInventory(self._client, ttl=0).regions()
+        self.assertEqual(self.clients, [None])
+
+    def test_match(self):
+        inv = RegionInventory(self._client)
+        regions = ["eu-central-1", "us-east-1"]
+        ret = inv.match(["t2.micro", "not.offered"], regions)
+        self.assertEqual(ret, {"eu-central-1": ["t2.micro"], "us-east-1": ["t2.micro"]})
+        self.assertEqual(inv.match(["not.offered"], regions), {})
+
+        with mock.patch.object(RegionInventory, "_fetch_offerings") as fetch:
+            self.assertEqual(len(inv.offerings(regions)), 2)
+            self.assertFalse(fetch.called)
@@ -1,23 +1,40 @@
+import datetime
+import json
 import pathlib
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 from unittest.mock import patch
 import pytest
 
 # from click.testing import CliRunner
 
-from moto import mock_ec2
+from moto import mock_ec2, mock_sts
 from tchotcho.__main__ import cli
+from tchotcho.config import set_settings, Settings
+from tchotcho.action import spot
 from tchotcho.action.spot import SpotManager
 
 IMPORT_KEY = pathlib.Path(__file__).absolute().parent / "dummy.pub"
 
 
+@mock_sts
 @mock_ec2
 class TestCliSpot(unittest.TestCase):
     @pytest.fixture(autouse=True)
     def capsys(self, capsys):
         self.capsys = capsys
 
+    def setUp(self):
+        settings = Settings()
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        settings.PROG_HOME = self.tmp_dir
+        set_settings(settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
     @patch.object(SpotManager, "_spot_history")
     def test_list(self, mocked_method):
         # XXX in moto describe_spot_price_history is not implemented and we
@@ -68,3 +85,125 @@ class TestCliSpot(unittest.TestCase):
         self.assertEqual(ex.value.code, 0)
         out, err = self.capsys.readouterr()
         self.assertTrue("\x1b[42m0.2814\x1b[49m" in out)
+
+
+class TestSpotHistory(unittest.TestCase):
+    def test_paginated(self):
+        def record(inst, az, day, price):
+            return {
+                "AvailabilityZone": az,
+                "InstanceType": inst,
+                "ProductDescription": "Linux/UNIX",
+                "SpotPrice": price,
+                "Timestamp": datetime.datetime(2020, 1, day),
+            }
+
+        def paginate(InstanceTypes, **kwargs):
+            # two pages per chunk
+            return [
+                {"SpotPriceHistory": [record(x, "a", 1, "0.1") for x in InstanceTypes]},
+                {"SpotPriceHistory": [record(x, "a", 2, "0.2") for x in InstanceTypes]},
+            ]
+
+        ec2 = mock.Mock()
+        ec2.get_paginator.return_value.paginate.side_effect = paginate
+        mgr = SpotManager()
+        mgr._client = mock.Mock(return_value=ec2)
+
+        inst = ["i%s" % x for x in range(spot.INSTANCE_CHUNK + 5)]
+        ret = list(mgr.iter_spot_history(inst, "eu-central-1"))
+        self.assertEqual(len(ret), len(inst) * 2)
+        calls = ec2.get_paginator.return_value.paginate.call_args_list
+        self.assertEqual([len(x[1]["InstanceTypes"]) for x in calls], [100, 5])
+
+        latest = mgr.latest(ret)
+        self.assertEqual(len(latest), len(inst))
+        self.assertTrue(all(x["SpotPrice"] == "0.2" for x in latest))
+
+
+class TestSpotWatch(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        settings = Settings()
+        self.tmp_dir = pathlib.Path(tempfile.mkdtemp())
+        settings.PROG_HOME = self.tmp_dir
+        set_settings(settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_delta(self):
+        previous = {("eu-central-1", "g4dn.xlarge", "eu-central-1b"): 0.25,
+                    ("eu-central-1", "g4dn.xlarge", "eu-central-1a"): 0.3}
+        current = {("eu-central-1", "g4dn.xlarge", "eu-central-1b"): 0.19,
+                   ("eu-central-1", "g3s.xlarge", "eu-central-1a"): 0.4}
+        events = SpotManager.delta(previous, current, below=0.2)
+        self.assertEqual(
+            [(x["instance_type"], x["az"], x["event"], x["threshold"]) for x in events],
+            [
+                ("g3s.xlarge", "eu-central-1a", "new", None),
+                ("g4dn.xlarge", "eu-central-1a", "removed", None),
+                ("g4dn.xlarge", "eu-central-1b", "down", "below"),
+            ],
+        )
+        self.assertEqual(
+            SpotManager.message(events[2]),
+            "g4dn.xlarge in eu-central-1b dropped below $0.20 at $0.1900",
+        )
+        self.assertEqual(SpotManager.delta(current, current), [])
+
+    def test_watch(self):
+        polls = iter([
+            [("eu-central-1", [{"InstanceType": "g4dn.xlarge",
+                                "AvailabilityZone": "eu-central-1b",
+                                "SpotPrice": 0.25}])],
+            [("eu-central-1", [{"InstanceType": "g4dn.xlarge",
+                                "AvailabilityZone": "eu-central-1b",
+                                "SpotPrice": 0.25}])],
+            [("eu-central-1", [{"InstanceType": "g4dn.xlarge",
+                                "AvailabilityZone": "eu-central-1b",
+                                "SpotPrice": 0.19}])],
+        ])
+        matches = {"eu-central-1": ["g4dn.xlarge"]}
+        with patch.object(spot, "fan_out", side_effect=lambda *args: next(polls)), \
+                patch.object(spot.RegionInventory, "match", return_value=matches) as m, \
+                patch.object(spot.RegionInventory, "enabled_regions",
+                             return_value=["eu-central-1"]), \
+                patch.object(spot.time, "sleep") as sleep, \
+                patch.object(spot.subprocess, "run") as run:
+            run.return_value.returncode = 0
+            with pytest.raises(SystemExit) as ex:
+                cli(["spot", "watch", "--inst", "g4dn.xlarge", "--count", "3",
+                     "--below", "0.2", "--output", "ndjson", "--hook", "cat"])
+        self.assertEqual(ex.value.code, 0)
+        # regions are resolved once, not per poll
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(sleep.call_count, 2)
+        out = [json.loads(x) for x in self.capsys.readouterr().out.splitlines()]
+        self.assertEqual([x["event"] for x in out], ["new", "down"])
+        self.assertEqual(out[1]["threshold"], "below")
+        self.assertEqual(run.call_count, 2)
+        self.assertEqual(json.loads(run.call_args[1]["input"]), out[1])
+
+    def test_watch_failed_region(self):
+        def prices(price):
+            return "eu-central-1", [
+                {"InstanceType": "g4dn.xlarge",
+                 "AvailabilityZone": "eu-central-1b",
+                 "SpotPrice": price}
+            ]
+
+        polls = [prices(0.25), Exception("throttled"), prices(0.19)]
+        matches = {"eu-central-1": ["g4dn.xlarge"]}
+        with patch.object(SpotManager, "_region_prices", side_effect=polls), \
+                patch.object(spot.RegionInventory, "match", return_value=matches), \
+                patch.object(spot.RegionInventory, "enabled_regions",
+                             return_value=["eu-central-1"]), \
+                patch.object(spot.time, "sleep"):
+            events = list(SpotManager().watch(False, inst=["g4dn.xlarge"], count=3))
+        # the failed poll keeps the last prices, nothing is removed
+        self.assertEqual([x["event"] for x in events], ["new", "down"])
+        self.assertEqual(events[1]["previous"], 0.25)
@@ -1,14 +1,27 @@
+import itertools
+import json
+import pathlib
+import sys
+import tempfile
+import time
 import unittest
+from unittest import mock
+
+import pandas as pd
 import pytest
 
 # from click.testing import CliRunner
 
-from moto import mock_cloudformation, mock_ec2
+from moto import mock_cloudformation, mock_ec2, mock_sts
+from tchotcho import aws, bake, events, tropo
 from tchotcho.__main__ import cli
+from tchotcho.action.stack import StackManager
+from tchotcho.config import set_settings, Settings
 
 # from tchotcho.action.stack import StackManager
 
 
+@mock_sts
 @mock_cloudformation
 @mock_ec2
 class TestCliStack(unittest.TestCase):
@@ -21,6 +34,15 @@ class TestCliStack(unittest.TestCase):
 
         # reset moto or we have to many clouds
         requests.post("http://motoapi.amazonaws.com/moto-api/reset")
+        # the cache must not serve moto answers to real runs
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        settings.BAKED_AMI_FILE = settings.PROG_HOME / "baked_amis.json"
+        set_settings(settings)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
 
     def test_create_dry(self):
         with pytest.raises(SystemExit) as ex:
@@ -50,3 +72,1050 @@ class TestCliStack(unittest.TestCase):
         self.assertEqual(ex.value.code, 0)
         out, err = self.capsys.readouterr()
         self.assertEqual("No stacks found!\n", out)
+
+
+TEMPLATE = {
+    "Resources": {
+        "Group": {
+            "Type": "AWS::EC2::SecurityGroup",
+            "Properties": {"GroupDescription": "test"},
+        }
+    },
+    "Outputs": {"Group": {"Value": {"Ref": "Group"}}},
+}
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestCliFleet(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        set_settings(settings)
+        self.sleep = mock.patch.object(events.time, "sleep")
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.tmp_dir.cleanup()
+
+    def test_fleet(self):
+        calls = []
+
+        def start_create(mgr, name, inst, **kwargs):
+            # moto can not create the instance template, use a small one
+            calls.append((name, inst, kwargs))
+            if name == "sweep-bad":
+                raise ValueError("bad config")
+            resp = mgr.cf.create_stack(
+                StackName=name, TemplateBody=json.dumps(TEMPLATE)
+            )
+            return resp["StackId"]
+
+        config = pathlib.Path(self.tmp_dir.name) / "sweep.json"
+        specs = [
+            {"name": f"sweep-{x}", "extra_user_data": f"train --lr {x}"}
+            for x in ("0.1", "0.01", "bad")
+        ]
+        specs[1]["inst"] = "p3.2xlarge"
+        config.write_text(json.dumps(specs))
+
+        with mock.patch.object(
+            StackManager, "_start_create", autospec=True, side_effect=start_create
+        ):
+            with pytest.raises(SystemExit) as ex:
+                cli(
+                    [
+                        "stack",
+                        "fleet",
+                        "--config",
+                        str(config),
+                        "--inst",
+                        "g4dn.xlarge",
+                        "--key",
+                        "sweep",
+                        "--max-workers",
+                        "2",
+                        "--csv",
+                    ]
+                )
+        # the failed stack does not stop the others but fails the command
+        self.assertEqual(ex.value.code, 1)
+        self.assertEqual(
+            sorted((x[0], x[1], x[2]["key_name"]) for x in calls),
+            [
+                ("sweep-0.01", "p3.2xlarge", "sweep"),
+                ("sweep-0.1", "g4dn.xlarge", "sweep"),
+                ("sweep-bad", "g4dn.xlarge", "sweep"),
+            ],
+        )
+        out = self.capsys.readouterr().out.splitlines()
+        self.assertEqual(out[0], "name,status,seconds,error,outputs")
+        self.assertTrue(out[1].startswith("sweep-0.1,CREATE_COMPLETE,"))
+        self.assertTrue(out[2].startswith("sweep-0.01,CREATE_COMPLETE,"))
+        self.assertTrue(out[3].startswith("sweep-bad,FAILED,"))
+        self.assertIn("bad config", out[3])
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_vpc_per_account(self):
+        # environment credentials of every account have the same profile
+        with mock.patch.object(aws, "account", return_value="111111111111"):
+            vpc = tropo.get_default_vpc_id("eu-central-1")
+        with mock.patch.object(
+            aws, "account", return_value="222222222222"
+        ), mock.patch.object(tropo, "_fetch_default_vpc_id", return_value="vpc-b"):
+            self.assertEqual(tropo.get_default_vpc_id("eu-central-1"), "vpc-b")
+        with mock.patch.object(aws, "account", return_value="111111111111"):
+            self.assertEqual(tropo.get_default_vpc_id("eu-central-1"), vpc)
+        self.assertNotEqual(vpc, "vpc-b")
+
+    def test_create_cloudformation(self):
+        ec2 = self.pool.client("ec2")
+        args = ("key", "ami-1e749f67", "t2.medium")
+        with mock.patch.object(
+            ec2, "describe_vpcs", wraps=ec2.describe_vpcs
+        ) as vpcs, mock.patch.object(
+            tropo, "_build_cloudformation", wraps=tropo._build_cloudformation
+        ) as build:
+            template = tropo.create_cloudformation(*args, price=0.02)
+            self.assertEqual(tropo.create_cloudformation(*args, price=0.02), template)
+            self.assertEqual(build.call_count, 1)
+            # other parameters are another template, the VPC is still cached
+            other = tropo.create_cloudformation(*args, price=0.03)
+            self.assertNotEqual(other, template)
+            self.assertEqual(build.call_count, 2)
+            self.assertEqual(vpcs.call_count, 1)
+        vpc_id = json.loads(template)["Resources"]["InstanceSecurityGroup"][
+            "Properties"
+        ]
+        self.assertEqual(vpc_id["VpcId"], tropo.get_default_vpc_id())
+
+    def test_validate_once(self):
+        mgr = StackManager()
+        template = tropo.create_cloudformation("key", "ami-1e749f67", "t2.medium")
+        with mock.patch.object(
+            mgr.cf, "validate_template", wraps=mgr.cf.validate_template
+        ) as validate:
+            self.assertEqual(mgr._parse_template(template), template)
+            self.assertEqual(StackManager()._parse_template(template), template)
+            self.assertEqual(validate.call_count, 1)
+            mgr._parse_template(json.dumps(TEMPLATE))
+            self.assertEqual(validate.call_count, 2)
+
+
+INSTANCE_TEMPLATE = {
+    "Resources": {
+        "TchoTchoInstance": {
+            "Type": "AWS::EC2::Instance",
+            "Properties": {"ImageId": "ami-1e749f67", "InstanceType": "t2.medium"},
+        }
+    },
+    "Outputs": {"InstanceId": {"Value": {"Ref": "TchoTchoInstance"}}},
+}
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestBake(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        settings.BAKED_AMI_FILE = settings.PROG_HOME / "baked_amis.json"
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+        self.sleep = mock.patch.object(events.time, "sleep")
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_bake(self):
+        mgr = StackManager()
+        requirements = "torch==1.5.0\nnumpy"
+        templates = []
+
+        def start_create(mgr, name, **kwargs):
+            # moto can not create the instance template, only keep it
+            templates.append(json.loads(mgr._template(name, **kwargs)))
+            resp = mgr.cf.create_stack(
+                StackName=name, TemplateBody=json.dumps(INSTANCE_TEMPLATE)
+            )
+            return resp["StackId"]
+
+        with mock.patch.object(
+            StackManager, "_start_create", autospec=True, side_effect=start_create
+        ):
+            record = mgr.bake("ami-1e749f67", "t2.medium", requirements, key_name="k")
+            # baked once, the bake stack is gone
+            self.assertEqual(
+                mgr.bake("ami-1e749f67", "t2.medium", requirements), record
+            )
+        self.assertEqual(len(templates), 1)
+        self.assertEqual(record["base_ami"], "ami-1e749f67")
+        self.assertEqual(mgr.baked.all(), [record])
+        self.assertFalse(mgr.stack_exists("tchotcho-bake-" + record["key"][:8]))
+
+        def launch(template):
+            data = template["Resources"]["InstanceLaunchTemplate"]["Properties"]
+            data = data["LaunchTemplateData"]
+            return data["ImageId"], json.dumps(data["UserData"])
+
+        ami, user_data = launch(templates[0])
+        self.assertEqual(ami, "ami-1e749f67")
+        self.assertIn("pip install -r /tmp/tchotcho-requirements.txt", user_data)
+        self.assertIn("torch==1.5.0", user_data)
+
+        # the same ami and requirements start from the baked image
+        args = ("run", "ami-1e749f67", "t2.medium", None, None, None, 120, True)
+        baked = json.loads(mgr.create(*args, requirements=requirements))
+        ami, user_data = launch(baked)
+        self.assertEqual(ami, record["ami"])
+        self.assertNotIn("apt install", user_data)
+        self.assertIn("hello.txt", user_data)
+        self.assertIn("cfn-signal", user_data)
+        # other requirements or no baked image use the full bootstrap
+        for kwargs in (
+            {"requirements": "pandas"},
+            {"requirements": requirements, "baked": False},
+        ):
+            ami, user_data = launch(json.loads(mgr.create(*args, **kwargs)))
+            self.assertEqual(ami, "ami-1e749f67")
+            self.assertIn("apt install", user_data)
+
+        # a deregistered image is dropped from the catalog
+        mgr.ec2.deregister_image(ImageId=record["ami"])
+        self.assertIsNone(mgr.baked_image("ami-1e749f67", requirements))
+        self.assertEqual(mgr.baked.all(), [])
+
+    def test_cli_stack_exists(self):
+        requirements = pathlib.Path(self.tmp_dir.name) / "requirements.txt"
+        requirements.write_text("numpy")
+        key = bake.bake_key("ami-1e749f67", tropo.USER_SCRIPT_DEFAULT, "numpy")
+        mgr = StackManager()
+        mgr.cf.create_stack(
+            StackName="tchotcho-bake-" + key[:8], TemplateBody=json.dumps(TEMPLATE)
+        )
+        with pytest.raises(SystemExit) as ex:
+            cli(
+                [
+                    "stack",
+                    "bake",
+                    "--ami",
+                    "ami-1e749f67",
+                    "--inst",
+                    "t2.medium",
+                    "--requirements",
+                    str(requirements),
+                ]
+            )
+        self.assertEqual(ex.value.code, 1)
+        self.assertIn("already exists", self.capsys.readouterr().err)
+        self.assertEqual(mgr.baked.all(), [])
+
+    def test_bake_key(self):
+        key = bake.bake_key("ami-1", tropo.USER_SCRIPT_DEFAULT, "numpy")
+        self.assertEqual(
+            key, bake.bake_key("ami-1", tropo.USER_SCRIPT_DEFAULT, "numpy")
+        )
+        self.assertNotEqual(
+            key, bake.bake_key("ami-2", tropo.USER_SCRIPT_DEFAULT, "numpy")
+        )
+        self.assertNotEqual(
+            key, bake.bake_key("ami-1", tropo.USER_SCRIPT_BAKED, "numpy")
+        )
+        self.assertEqual(bake.requirements_script(" \n"), "")
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestFleetTemplate(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        settings.BAKED_AMI_FILE = settings.PROG_HOME / "baked_amis.json"
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_template(self):
+        template = tropo.create_cloudformation(
+            "key",
+            "ami-1e749f67",
+            ["g4dn.2xlarge", "g4dn.xlarge"],
+            subnet_id=["subnet-a", "subnet-b"],
+            price=0.5,
+        )
+        self.assertEqual(tropo.lint(template), [])
+        resources = json.loads(template)["Resources"]
+        self.assertNotIn("TchoTchoInstance", resources)
+        fleet = resources["TchoTchoFleet"]["Properties"]
+        self.assertEqual(
+            fleet["SpotOptions"]["AllocationStrategy"], "price-capacity-optimized"
+        )
+        self.assertEqual(
+            [
+                (x["InstanceType"], x["SubnetId"], x["Priority"])
+                for x in fleet["LaunchTemplateConfigs"][0]["Overrides"]
+            ],
+            [
+                ("g4dn.2xlarge", "subnet-a", 0),
+                ("g4dn.2xlarge", "subnet-b", 0),
+                ("g4dn.xlarge", "subnet-a", 1),
+                ("g4dn.xlarge", "subnet-b", 1),
+            ],
+        )
+        # the instance signals the wait condition of the stack
+        self.assertEqual(
+            resources["TchoTchoWaitCondition"]["Properties"]["Handle"],
+            {"Ref": "TchoTchoWaitHandle"},
+        )
+        self.assertIn("${TchoTchoWaitHandle}", template)
+        self.assertNotIn(
+            "--resource TchoTchoInstance --region", template.split("cfn-signal")[-1]
+        )
+
+        # one instance type is the single instance template, on demand fleets
+        # are prioritized
+        single = json.loads(
+            tropo.create_cloudformation("key", "ami-1", ["g4dn.xlarge"])
+        )
+        self.assertIn("TchoTchoInstance", single["Resources"])
+        ondemand = json.loads(
+            tropo.create_cloudformation(
+                "key",
+                "ami-1",
+                "g4dn.xlarge",
+                allocation="capacity-optimized-prioritized",
+            )
+        )
+        fleet = ondemand["Resources"]["TchoTchoFleet"]["Properties"]
+        self.assertEqual(fleet["OnDemandOptions"]["AllocationStrategy"], "prioritized")
+        with self.assertRaises(ValueError):
+            tropo.create_cloudformation(
+                "key", "ami-1", "g4dn.xlarge", allocation="cheap"
+            )
+
+    def test_create_dry_offline(self):
+        with mock.patch.object(StackManager, "_validate") as validate:
+            with pytest.raises(SystemExit) as ex:
+                cli(
+                    [
+                        "stack",
+                        "create",
+                        "--name",
+                        "test",
+                        "--ami",
+                        "ami-1e749f67",
+                        "--inst",
+                        "g4dn.2xlarge",
+                        "--inst",
+                        "g4dn.xlarge",
+                        "--price",
+                        "0.5",
+                        "--dry",
+                        "--offline",
+                    ]
+                )
+        self.assertEqual(ex.value.code, 0)
+        validate.assert_not_called()
+        self.assertIn("TchoTchoFleet", self.capsys.readouterr().out)
+
+    def test_fleet_outputs(self):
+        mgr = StackManager()
+        # moto does not parse overrides, the instance type is in the template
+        mgr.ec2.create_launch_template(
+            LaunchTemplateName="test",
+            LaunchTemplateData={
+                "ImageId": "ami-1e749f67",
+                "InstanceType": "g4dn.xlarge",
+            },
+        )
+        fleet_id = mgr.ec2.create_fleet(
+            LaunchTemplateConfigs=[
+                {
+                    "LaunchTemplateSpecification": {
+                        "LaunchTemplateName": "test",
+                        "Version": "1",
+                    },
+                }
+            ],
+            TargetCapacitySpecification={
+                "TotalTargetCapacity": 1,
+                "DefaultTargetCapacityType": "on-demand",
+            },
+            Type="maintain",
+        )["FleetId"]
+        template = dict(TEMPLATE, Outputs={"FleetId": {"Value": fleet_id}})
+        stack_id = mgr.cf.create_stack(
+            StackName="test", TemplateBody=json.dumps(template)
+        )
+        outputs = {
+            x["OutputKey"]: x["OutputValue"] for x in mgr._outputs(stack_id["StackId"])
+        }
+        self.assertEqual(outputs["FleetId"], fleet_id)
+        self.assertEqual(outputs["InstanceType"], "g4dn.xlarge")
+        self.assertTrue(outputs["InstanceId"].startswith("i-"))
+        self.assertIn("AZ", outputs)
+
+
+class TestOffline(unittest.TestCase):
+    """No moto, a dry offline run must not call AWS at all"""
+
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        settings.BAKED_AMI_FILE = settings.PROG_HOME / "baked_amis.json"
+        set_settings(settings)
+        self.patch = mock.patch.object(aws, "_POOL", aws.ClientPool())
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_create_dry_offline(self):
+        with mock.patch.object(
+            aws.CallPolicy, "call", side_effect=AssertionError("AWS called")
+        ) as call:
+            with pytest.raises(SystemExit) as ex:
+                cli(
+                    [
+                        "stack",
+                        "create",
+                        "--name",
+                        "test",
+                        "--ami",
+                        "ami-1e749f67",
+                        "--inst",
+                        "g4dn.xlarge",
+                        "--price",
+                        "0.5",
+                        "--dry",
+                        "--offline",
+                    ]
+                )
+        self.assertEqual(ex.value.code, 0)
+        call.assert_not_called()
+        template = json.loads(self.capsys.readouterr().out.strip().split("\n\n")[0])
+        group = template["Resources"]["InstanceSecurityGroup"]["Properties"]
+        # the default VPC is not looked up, it is a parameter
+        self.assertEqual(group["VpcId"], {"Ref": "VpcId"})
+        self.assertIn("VpcId", template["Parameters"])
+
+        with pytest.raises(SystemExit) as ex:
+            cli(
+                [
+                    "stack",
+                    "create",
+                    "--name",
+                    "test",
+                    "--ami",
+                    "ami-1e749f67",
+                    "--inst",
+                    "g4dn.xlarge",
+                    "--vpc",
+                    "vpc-12345678",
+                    "--dry",
+                    "--offline",
+                ]
+            )
+        self.assertEqual(ex.value.code, 0)
+        template = json.loads(self.capsys.readouterr().out.strip().split("\n\n")[0])
+        group = template["Resources"]["InstanceSecurityGroup"]["Properties"]
+        self.assertEqual(group["VpcId"], "vpc-12345678")
+        self.assertNotIn("Parameters", template)
+
+    def test_lint_import(self):
+        for missing, message in (
+            ("cfnlint", "needs cfn-lint"),
+            ("cfnlint.core", "needs cfn-lint<1"),
+        ):
+            with mock.patch.dict(sys.modules, {missing: None}):
+                with self.assertRaisesRegex(RuntimeError, message):
+                    tropo.lint("{}")
+        # a broken install is no missing cfn-lint
+        with mock.patch.dict(sys.modules, {"cfnlint.api": None}):
+            with self.assertRaises(ImportError):
+                tropo.lint("{}")
+
+
+def capacity_event(
+    reason="We currently do not have sufficient p3.2xlarge capacity "
+    "(Error Code: InsufficientInstanceCapacity)",
+):
+    return {
+        "time": "2020-06-01T00:00:00+00:00",
+        "resource": "TchoTchoInstance",
+        "type": "AWS::EC2::Instance",
+        "status": "CREATE_FAILED",
+        "reason": reason,
+        "duration": None,
+    }
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestLaunch(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        settings.BAKED_AMI_FILE = settings.PROG_HOME / "baked_amis.json"
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+        self.sleep = mock.patch.object(events.time, "sleep")
+        self.sleep.start()
+        self.started = []
+        # what the stack of (region, instance type) does
+        self.plan = {}
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def start_create(self, mgr, name, inst, **kwargs):
+        # moto can not create the instance template, use a small one
+        region = mgr.cf.meta.region_name
+        self.started.append((region, name, inst))
+        resp = mgr.cf.create_stack(StackName=name, TemplateBody=json.dumps(TEMPLATE))
+        mgr._plan = self.plan.get((region, inst), "ok")
+        return resp["StackId"]
+
+    @staticmethod
+    def follow(mgr, stack_id, last_event_id=None, on_event=None, stop=None):
+        if mgr._plan == "capacity":
+            on_event(capacity_event())
+            return "CREATE_IN_PROGRESS", [capacity_event()]
+        if mgr._plan == "timeout":
+            raise TimeoutError("Stack not done after 3600s")
+        if mgr._plan == "slow":
+            # runs until it lost
+            while not stop():
+                time.sleep(0.01)
+            return "CREATE_IN_PROGRESS", []
+        return "CREATE_COMPLETE", []
+
+    def launch(self, candidates, race=1):
+        with mock.patch.object(
+            StackManager, "_start_create", autospec=True, side_effect=self.start_create
+        ), mock.patch.object(
+            StackManager, "_follow", autospec=True, side_effect=self.follow
+        ):
+            return StackManager().launch("train", candidates, race, ami="ami-1")
+
+    def test_fallback(self):
+        self.plan[("eu-central-1", "p3.2xlarge")] = "capacity"
+        candidates = [
+            {"region": "eu-central-1", "inst": "p3.2xlarge"},
+            {"region": "eu-central-1", "inst": "g4dn.xlarge"},
+            {"region": "us-east-1", "inst": "p3.2xlarge"},
+        ]
+        ret = self.launch(candidates)
+        self.assertEqual(
+            [(x["name"], x["region"], x["status"]) for x in ret["attempts"]],
+            [
+                ("train", "eu-central-1", "CAPACITY"),
+                ("train-1", "eu-central-1", "CREATE_COMPLETE"),
+                ("train", "us-east-1", "SKIPPED"),
+            ],
+        )
+        self.assertIn("InsufficientInstanceCapacity", ret["attempts"][0]["reason"])
+        self.assertEqual(ret["winner"]["name"], "train-1")
+        self.assertEqual(ret["winner"]["outputs"], {"group": mock.ANY})
+        # the failed candidate is rolled back, the winner is kept
+        mgr = StackManager("eu-central-1")
+        self.assertFalse(mgr.stack_exists("train"))
+        self.assertTrue(mgr.stack_exists("train-1"))
+        self.assertEqual(len(self.started), 2)
+
+    def test_follow_failed(self):
+        self.plan[("eu-central-1", "p3.2xlarge")] = "timeout"
+        candidates = [
+            {"region": "eu-central-1", "inst": "p3.2xlarge"},
+            {"region": "us-east-1", "inst": "g4dn.xlarge"},
+        ]
+        ret = self.launch(candidates)
+        self.assertEqual(
+            [x["status"] for x in ret["attempts"]], ["FAILED", "CREATE_COMPLETE"]
+        )
+        self.assertIn("3600s", ret["attempts"][0]["reason"])
+        # the created stack of the failed candidate is not left behind
+        self.assertFalse(StackManager("eu-central-1").stack_exists("train"))
+
+    def test_race(self):
+        self.plan[("eu-central-1", "p3.2xlarge")] = "slow"
+        candidates = [
+            {"region": "eu-central-1", "inst": "p3.2xlarge"},
+            {"region": "us-east-1", "inst": "g4dn.xlarge"},
+        ]
+        ret = self.launch(candidates, race=2)
+        self.assertEqual(
+            [x["status"] for x in ret["attempts"]], ["CANCELLED", "CREATE_COMPLETE"]
+        )
+        self.assertEqual(ret["winner"]["region"], "us-east-1")
+        self.assertFalse(StackManager("eu-central-1").stack_exists("train"))
+
+    def test_cli_no_capacity(self):
+        self.plan[("eu-central-1", "p3.2xlarge")] = "capacity"
+        config = pathlib.Path(self.tmp_dir.name) / "candidates.json"
+        config.write_text(json.dumps([{"region": "eu-central-1"}]))
+        with mock.patch.object(
+            StackManager, "_start_create", autospec=True, side_effect=self.start_create
+        ), mock.patch.object(
+            StackManager, "_follow", autospec=True, side_effect=self.follow
+        ):
+            with pytest.raises(SystemExit) as ex:
+                cli(
+                    [
+                        "stack",
+                        "launch",
+                        "--name",
+                        "train",
+                        "--candidates",
+                        str(config),
+                        "--inst",
+                        "p3.2xlarge",
+                        "--csv",
+                    ]
+                )
+        self.assertEqual(ex.value.code, 1)
+        out = self.capsys.readouterr().out.splitlines()
+        self.assertEqual(out[0], "name,region,inst,subnet,status,reason")
+        self.assertTrue(out[1].startswith("train,eu-central-1,p3.2xlarge,,CAPACITY,"))
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestWarm(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+        self.mgr = StackManager()
+        self.mgr.cf.create_stack(
+            StackName="warm", TemplateBody=json.dumps(INSTANCE_TEMPLATE)
+        )
+
+    def tearDown(self):
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def outputs(self):
+        return {x["OutputKey"]: x["OutputValue"] for x in self.mgr._outputs("warm")}
+
+    def test_stop_start(self):
+        instance_id = self.outputs()["InstanceId"]
+        self.assertEqual(self.outputs()["State"], "running")
+        with pytest.raises(SystemExit) as ex:
+            cli(["stack", "stop", "--name", "warm"])
+        self.assertEqual(ex.value.code, 0)
+        self.assertEqual(self.outputs()["State"], "stopped")
+
+        with pytest.raises(SystemExit) as ex:
+            cli(["stack", "start", "--name", "warm"])
+        self.assertEqual(ex.value.code, 0)
+        # the same instance is running again, its outputs are the live ones
+        self.assertEqual(self.outputs()["InstanceId"], instance_id)
+        self.assertEqual(self.outputs()["State"], "running")
+        self.assertIn("running", self.capsys.readouterr().out)
+
+    def test_spot(self):
+        instance_id = self.outputs()["InstanceId"]
+        spot = dict(self.mgr._instance(instance_id), InstanceLifecycle="spot")
+        with mock.patch.object(self.mgr, "_instance", return_value=spot):
+            with self.assertRaisesRegex(ValueError, "spot"):
+                self.mgr._warm_instance("warm")
+        self.mgr.cf.create_stack(StackName="group", TemplateBody=json.dumps(TEMPLATE))
+        with self.assertRaisesRegex(ValueError, "no instance"):
+            self.mgr._warm_instance("group")
+
+    def test_gone(self):
+        # the instance of the stack was terminated and is not found anymore
+        template = json.loads(json.dumps(TEMPLATE))
+        template["Outputs"].update(
+            InstanceId={"Value": "i-0123456789abcdef0"},
+            PublicIP={"Value": "1.2.3.4"},
+        )
+        self.mgr.cf.create_stack(StackName="gone", TemplateBody=json.dumps(template))
+        outputs = {x["OutputKey"]: x["OutputValue"] for x in self.mgr._outputs("gone")}
+        self.assertEqual(outputs["InstanceId"], "i-0123456789abcdef0")
+        self.assertEqual(outputs["PublicIP"], "1.2.3.4")
+
+        for command in ["stop", "start"]:
+            with pytest.raises(SystemExit) as ex:
+                cli(["stack", command, "--name", "gone"])
+            self.assertEqual(ex.value.code, 1)
+            self.assertIn("terminated", self.capsys.readouterr().err)
+
+
+def update_template(mgr, name, **args):
+    # moto can not update the instance template, the description is the type
+    template = json.loads(json.dumps(TEMPLATE))
+    inst = args["inst"]
+    template["Resources"]["Group"]["Properties"]["GroupDescription"] = (
+        inst if isinstance(inst, str) else ",".join(inst)
+    )
+    template["Metadata"] = {"TchoTcho": {"args": args}}
+    return json.dumps(template)
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestUpdate(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+        self.sleep = mock.patch.object(events.time, "sleep")
+        self.sleep.start()
+        self.mgr = StackManager()
+        self.mgr.cf.create_stack(
+            StackName="train",
+            TemplateBody=update_template(
+                self.mgr, "train", ami="ami-1", inst="t2.medium"
+            ),
+        )
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def description(self):
+        body = self.mgr.cf.get_template(StackName="train")["TemplateBody"]
+        return body["Resources"]["Group"]["Properties"]["GroupDescription"]
+
+    def status(self):
+        return self.mgr.cf.describe_stacks(StackName="train")["Stacks"][0][
+            "StackStatus"
+        ]
+
+    def test_update(self):
+        with mock.patch.object(
+            StackManager, "_template", autospec=True, side_effect=update_template
+        ) as template:
+            changes = self.mgr.update("train", dry=True, inst="p3.2xlarge", size=None)
+            # the other arguments are the ones of the create
+            template.assert_called_with(
+                self.mgr, "train", ami="ami-1", inst="p3.2xlarge", baked=False
+            )
+            self.assertEqual(
+                [(x["action"], x["resource"]) for x in changes], [("Modify", "Group")]
+            )
+            self.assertEqual(self.description(), "t2.medium")
+            self.assertIn("Modify", self.capsys.readouterr().out)
+
+            with pytest.raises(SystemExit) as ex:
+                cli(["stack", "update", "--name", "train", "--inst", "p3.2xlarge"])
+            self.assertEqual(ex.value.code, 0)
+            self.assertEqual(self.description(), "p3.2xlarge")
+            self.assertEqual(self.status(), "UPDATE_COMPLETE")
+
+            # nothing changed, nothing to do
+            self.assertEqual(self.mgr.update("train", inst=["p3.2xlarge"]), [])
+
+    def test_change_set_failed(self):
+        failed = ("FAILED", "Requires capabilities : [CAPABILITY_NAMED_IAM]", [])
+        with mock.patch.object(
+            StackManager, "_template", autospec=True, side_effect=update_template
+        ), mock.patch.object(StackManager, "_describe_change_set", return_value=failed):
+            # a failure without changes is no empty update
+            with self.assertRaisesRegex(ValueError, "CAPABILITY_NAMED_IAM"):
+                self.mgr.update("train", inst="p3.2xlarge")
+            with pytest.raises(SystemExit) as ex:
+                cli(["stack", "update", "--name", "train", "--inst", "p3.2xlarge"])
+            self.assertEqual(ex.value.code, 1)
+        self.assertEqual(self.description(), "t2.medium")
+        # the failed change sets are deleted
+        self.assertEqual(
+            self.mgr.cf.list_change_sets(StackName="train")["Summaries"], []
+        )
+
+    def test_baked_image(self):
+        template = json.loads(
+            update_template(self.mgr, "baked", ami="ami-1", inst="t2.medium")
+        )
+        template["Metadata"]["TchoTcho"]["baked_image"] = "ami-b"
+        self.mgr.cf.create_stack(StackName="baked", TemplateBody=json.dumps(template))
+        with mock.patch.object(
+            StackManager, "_template", autospec=True, side_effect=update_template
+        ) as template:
+            # the stack keeps the baked image it was created with
+            self.mgr.update("baked", dry=True, inst="p3.2xlarge")
+            template.assert_called_with(
+                self.mgr,
+                "baked",
+                ami="ami-1",
+                inst="p3.2xlarge",
+                baked=False,
+                baked_image="ami-b",
+            )
+            # the image of another ami is not the baked one
+            self.mgr.update("baked", dry=True, ami="ami-2")
+            template.assert_called_with(
+                self.mgr, "baked", ami="ami-2", inst="t2.medium", baked=False
+            )
+
+        image = self.mgr.ec2.describe_images()["Images"][0]["ImageId"]
+        template = json.loads(
+            self.mgr._template("baked", "ami-1", "t2.medium", baked_image=image)
+        )
+        data = template["Resources"]["InstanceLaunchTemplate"]["Properties"]
+        self.assertEqual(data["LaunchTemplateData"]["ImageId"], image)
+        self.assertEqual(template["Metadata"]["TchoTcho"]["baked_image"], image)
+        # no fallback to the base ami nor another bake
+        with self.assertRaisesRegex(ValueError, "gone"):
+            self.mgr._template(
+                "baked", "ami-1", "t2.medium", baked_image="ami-12345678"
+            )
+
+    def test_change_set_timeout(self):
+        cf = mock.Mock()
+        cf.describe_change_set.return_value = {"Status": "CREATE_PENDING"}
+        self.mgr._cf = cf
+        clock = itertools.count(0, 60)
+        with mock.patch.object(time, "monotonic", side_effect=lambda: next(clock)):
+            status, reason, changes = self.mgr._describe_change_set("train", "cs", 300)
+        self.assertEqual((status, changes), ("TIMEOUT", []))
+        # polled once a minute until the deadline
+        self.assertEqual(cf.describe_change_set.call_count, 5)
+
+    def test_not_tchotcho(self):
+        self.mgr.cf.create_stack(StackName="other", TemplateBody=json.dumps(TEMPLATE))
+        with self.assertRaisesRegex(ValueError, "metadata"):
+            self.mgr._created_with("other")
+
+    def test_template(self):
+        mgr = StackManager()
+        template = json.loads(
+            mgr._template("train", "ami-1e749f67", "t2.medium", size=50)
+        )
+        # a new type modifies the instance, the launch template stays
+        instance = template["Resources"]["TchoTchoInstance"]["Properties"]
+        self.assertEqual(instance["InstanceType"], "t2.medium")
+        data = template["Resources"]["InstanceLaunchTemplate"]["Properties"]
+        self.assertNotIn("InstanceType", data["LaunchTemplateData"])
+        self.assertEqual(template["Metadata"]["TchoTcho"]["args"]["size"], 50)
+        self.assertNotIn("price", template["Metadata"]["TchoTcho"]["args"])
+
+
+@mock_sts
+@mock_cloudformation
+@mock_ec2
+class TestInventory(unittest.TestCase):
+    @pytest.fixture(autouse=True)
+    def capsys(self, capsys):
+        self.capsys = capsys
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        settings = Settings()
+        settings.PROG_HOME = pathlib.Path(self.tmp_dir.name)
+        set_settings(settings)
+        self.pool = aws.ClientPool(policy=aws.CallPolicy())
+        self.patch = mock.patch.object(aws, "_POOL", self.pool)
+        self.patch.start()
+        self.sleep = mock.patch.object(events.time, "sleep")
+        self.sleep.start()
+        self.regions = ["eu-central-1", "us-east-1"]
+        stacks = [
+            ("eu-central-1", "train", True),
+            ("eu-central-1", "tchotcho-bake-1", False),
+            ("eu-central-1", "other", False),
+            ("us-east-1", "train", True),
+        ]
+        for region, name, tagged in stacks:
+            tags = [{"Key": "tchotcho", "Value": name}] if tagged else []
+            StackManager(region).cf.create_stack(
+                StackName=name, TemplateBody=json.dumps(TEMPLATE), Tags=tags
+            )
+
+    def tearDown(self):
+        self.sleep.stop()
+        self.patch.stop()
+        self.tmp_dir.cleanup()
+
+    def test_inventory(self):
+        mgr = StackManager()
+        df = mgr.inventory(self.regions)
+        # tagged or named by the prefix
+        self.assertEqual(
+            [(x.region, x.name) for x in df.itertuples()],
+            [
+                ("eu-central-1", "tchotcho-bake-1"),
+                ("eu-central-1", "train"),
+                ("us-east-1", "train"),
+            ],
+        )
+        self.assertTrue((df["age_hours"] < 1).all())
+        self.assertIn(
+            "other", mgr.inventory(self.regions, all_stacks=True)["name"].tolist()
+        )
+        self.assertTrue(StackManager("us-east-1").stack_exists("train"))
+        self.assertFalse(StackManager("us-east-1").stack_exists("other"))
+
+    def test_stale(self):
+        mgr = StackManager()
+        df = pd.DataFrame(
+            {
+                "status": [
+                    "CREATE_COMPLETE",
+                    "ROLLBACK_COMPLETE",
+                    "DELETE_FAILED",
+                    "DELETE_IN_PROGRESS",
+                ],
+                "age_hours": [30.0, 1.0, 2.0, 40.0],
+            }
+        )
+        with mock.patch.object(mgr, "inventory", return_value=df):
+            self.assertEqual(
+                mgr.stale()["status"].tolist(), ["ROLLBACK_COMPLETE", "DELETE_FAILED"]
+            )
+            self.assertEqual(
+                mgr.stale(older_than=24)["status"].tolist(),
+                ["CREATE_COMPLETE", "ROLLBACK_COMPLETE", "DELETE_FAILED"],
+            )
+            self.assertEqual(
+                mgr.stale(older_than=24, failed=False)["status"].tolist(),
+                ["CREATE_COMPLETE"],
+            )
+
+    def test_gc(self):
+        args = [
+            "stack",
+            "gc",
+            "--region",
+            "eu-central-1",
+            "--region",
+            "us-east-1",
+            "--older-than",
+            "0",
+            "--csv",
+        ]
+        with pytest.raises(SystemExit) as ex:
+            cli(args + ["--dry"])
+        self.assertEqual(ex.value.code, 0)
+        self.assertEqual(len(StackManager().inventory(self.regions)), 3)
+
+        with pytest.raises(SystemExit) as ex:
+            cli(args + ["--yes"])
+        self.assertEqual(ex.value.code, 0)
+        out = self.capsys.readouterr().out
+        self.assertIn("us-east-1,train,DELETE_COMPLETE", out)
+        self.assertTrue(StackManager().inventory(self.regions).empty)
+        # only stacks of tchotcho are deleted
+        self.assertTrue(StackManager("eu-central-1").stack_exists("other"))
+
+    @staticmethod
+    def deleting(statuses, events=()):
+        """Marked events of a delete, the stack has statuses one per poll"""
+        ret = mock.Mock()
+        ret.cf.describe_stacks.side_effect = [
+            {"Stacks": [{"StackStatus": x}]} for x in statuses
+        ]
+        ret.new_events.side_effect = list(events)
+        return ret
+
+    def test_wait_deleted(self):
+        failed = {
+            "ResourceType": events.STACK_TYPE,
+            "LogicalResourceId": "b",
+            "StackName": "b",
+            "ResourceStatus": "DELETE_FAILED",
+        }
+        rows = [{"id": x, "region": "eu-central-1", "name": x} for x in "abc"]
+        deletes = {
+            # still the DELETE_FAILED of gc, then the new delete
+            "a": self.deleting(
+                ["DELETE_FAILED", "DELETE_IN_PROGRESS", "DELETE_COMPLETE"], [[]]
+            ),
+            # the new delete failed again between two polls
+            "b": self.deleting(["DELETE_FAILED", "DELETE_FAILED"], [[], [failed]]),
+            "c": self.deleting(["DELETE_IN_PROGRESS", "DELETE_COMPLETE"]),
+        }
+        ret = StackManager()._wait_deleted(rows, deletes)
+        self.assertEqual(
+            ret, {"a": "DELETE_COMPLETE", "b": "DELETE_FAILED", "c": "DELETE_COMPLETE"}
+        )
+        self.assertEqual(deletes["a"].cf.describe_stacks.call_count, 3)
+        self.assertEqual(deletes["b"].new_events.call_count, 2)
+
+        # gives up after the timeout with the last status
+        deletes = {"a": self.deleting(["DELETE_IN_PROGRESS"])}
+        ret = StackManager()._wait_deleted(rows[:1], deletes, timeout=0)
+        self.assertEqual(ret, {"a": "DELETE_IN_PROGRESS"})